@@ -1,23 +1,91 @@
-from flask import Flask, request, jsonify, send_from_directory, abort
+from flask import Flask, Response, request, jsonify, send_from_directory, abort, g
 from flask_cors import CORS
-import sqlite3, json, os
+import sqlite3, json, os, io, re, struct, itertools, operator, hashlib, threading, time, uuid, tempfile, shutil, zipfile
+from concurrent.futures import ThreadPoolExecutor
+from html import escape
+from collections import OrderedDict
 import numpy as np
 from datetime import datetime
+from fractions import Fraction
 import gunicorn
+from history_store import HistoryStore, decode_blob, utc_timestamp
+from metrics import Metrics, SamplingProfiler, SIZE_BUCKETS
+from operations import OPERATIONS, get_operation, result_to_json, take, whole_number
+from compute_pool import ComputePool, PoolSaturated, JobTimeout, WorkerDied
+from exact_ops import EXACT_KERNELS, integer_matrix, run_exact
+from blocked_ops import BLOCKED_KERNELS, MatrixFiles, UploadTooLarge, is_stored_ref, result_shape, run_blocked
+from delta_ops import DELTA_OPS, DeltaSessions, recompute
+from sparse_ops import is_sparse_payload, parse_sparse, choose_sparse, run_sparse, to_dense, to_payload, issparse
+from structured_ops import PRECISIONS, STRUCTURED_OPS, plan, describe, run_structured
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SAVED = os.path.join(BASE_DIR, "saved_pages")
-DB = os.path.join(BASE_DIR, "history.db")
+DB = os.environ.get("HISTORY_DB", os.path.join(BASE_DIR, "history.db"))
 os.makedirs(SAVED, exist_ok=True)
 
+# History writes are group-committed: see HistoryStore
+store = HistoryStore(DB, flush_rows=int(os.environ.get("HISTORY_FLUSH_ROWS", 64)))
+
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["X-Entry-Id", "X-Entry-Time", "X-Session-Version", "Server-Timing"])
+
+# ---------- Metrics ----------
+# Served at /metrics in the Prometheus text format, summed over all workers
+# through per-process snapshots in METRICS_DIR (see metrics.Metrics). Requests
+# with ?timing=1 or an "X-Server-Timing: 1" header (or every request with
+# SERVER_TIMING=1) get a Server-Timing header with their stage durations.
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "matrix-calculator-metrics"))
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") not in ("0", "false", "")
+
+metrics = Metrics(METRICS_DIR, flush_seconds=float(os.environ.get("METRICS_FLUSH_SECONDS", 5)))
+profiler = SamplingProfiler(METRICS_DIR)
+metrics.counter("matrix_requests_total", "HTTP requests by endpoint and status code.")
+metrics.histogram("matrix_request_duration_seconds", "Time to build the response, by endpoint.")
+metrics.histogram("matrix_operation_duration_seconds", "Time spent computing, by operation.")
+metrics.histogram("matrix_stage_duration_seconds",
+                  "Time per stage: decode, parse, compute, serialize, history, respond, render.")
+metrics.histogram("matrix_operand_cells", "Cells per operand, by operation.", SIZE_BUCKETS)
+metrics.counter("matrix_db_operations_total", "History database operations by kind (rows for reads and inserts).")
+metrics.counter("matrix_file_operations_total", "Stored matrix and saved page file operations by kind.")
+metrics.counter("matrix_file_bytes_total", "Bytes uploaded and downloaded as stored matrices.")
+metrics.counter("matrix_kernel_total", "Calculations by operation and the kernel that computed them.")
+metrics.gauge("matrix_pool_in_flight", "Jobs running in the worker pool.")
+metrics.gauge("matrix_pool_queued", "Jobs waiting for a worker pool process.")
+
+def wants_server_timing():
+    return (SERVER_TIMING or request.args.get("timing") == "1"
+            or request.headers.get("X-Server-Timing") == "1")
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    metrics.begin_request()
+    g.profiled = profiler.enter(request.endpoint)
+
+@app.after_request
+def finish_request(resp):
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or "unknown"
+    metrics.observe("matrix_request_duration_seconds", elapsed, {"endpoint": endpoint})
+    metrics.inc("matrix_requests_total", {"endpoint": endpoint, "status": resp.status_code})
+    timings = metrics.end_request()
+    if wants_server_timing():
+        resp.headers["Server-Timing"] = ", ".join(
+            [f"{name};dur={t * 1000:.3f}" for name, t in timings.items()] + [f"total;dur={elapsed * 1000:.3f}"])
+    pool = compute_pool.stats()
+    metrics.set("matrix_pool_in_flight", pool["in_flight"])
+    metrics.set("matrix_pool_queued", pool["queued"])
+    metrics.maybe_flush()
+    return resp
+
+@app.teardown_request
+def end_profile(exc):
+    if g.pop("profiled", False):
+        profiler.leave()
 
 # ---------- DB helpers ----------
 def init_db():
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("""
+    store.write("""
       CREATE TABLE IF NOT EXISTS history (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         operation TEXT NOT NULL,
@@ -27,180 +95,1375 @@ def init_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
       )
     """)
-    conn.commit()
-    conn.close()
+    store.write("CREATE INDEX IF NOT EXISTS history_operation ON history (operation, id)")
+    store.write("CREATE INDEX IF NOT EXISTS history_created_at ON history (created_at, id)")
+    # matrixA, matrixB and result hold blob hashes, see HistoryStore
+    store.migrate()
 
 def save_history(operation, A, B, result):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("INSERT INTO history (operation, matrixA, matrixB, result) VALUES (?,?,?,?)",
-              (operation, json.dumps(A), json.dumps(B), json.dumps(result)))
-    conn.commit()
-    nid = c.lastrowid
-    c.execute("SELECT created_at FROM history WHERE id=?", (nid,))
-    ts = c.fetchone()[0]
-    conn.close()
-    create_saved_page(nid, operation, A, B, result, ts)
-    return nid, ts
-
-def fetch_history(limit=500):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("SELECT id, operation, matrixA, matrixB, result, created_at FROM history ORDER BY id ASC LIMIT ?",
-              (limit,))
-    rows = c.fetchall()
-    conn.close()
-    out = []
-    for r in rows:
-        out.append({
-            "id": r[0],
-            "operation": r[1],
-            "A": json.loads(r[2]),
-            "B": json.loads(r[3]),
-            "result": json.loads(r[4]),
-            "time": r[5]
-        })
-    return out
+    metrics.inc("matrix_db_operations_total", {"kind": "insert"})
+    return store.insert((operation, A, B, result))
+
+def save_history_many(entries):
+    """Inserts (operation, A, B, result) entries in a single transaction.
+    Returns (id, created_at) for each entry, in order."""
+    if not entries:
+        return []
+    metrics.inc("matrix_db_operations_total", {"kind": "insert"}, len(entries))
+    return store.insert_many(entries)
+
+def history_query(limit=None, before=None, after=None, operations=None, since=None, until=None, summary=False,
+                  ascending=None):
+    """Builds a keyset-paginated history SELECT and returns (sql, params).
+    Entries come newest first, or oldest first when paging forward with
+    `after` alone (or with `ascending`). `since`/`until` compare against created_at
+    ('YYYY-MM-DD HH:MM:SS', UTC). With `summary` the matrix columns are not read."""
+    where, params = [], []
+    if before is not None:
+        where.append("id < ?")
+        params.append(before)
+    if after is not None:
+        where.append("id > ?")
+        params.append(after)
+    if operations:
+        where.append(f"operation IN ({','.join('?' * len(operations))})")
+        params += operations
+    if since:
+        where.append("created_at >= ?")
+        params.append(since)
+    if until:
+        where.append("created_at <= ?")
+        params.append(until)
+    cols = "id, operation, created_at" if summary else "id, operation, created_at, matrixA, matrixB, result"
+    sql = f"SELECT {cols} FROM history"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if ascending is None:
+        ascending = after is not None and before is None
+    sql += " ORDER BY id " + ("ASC" if ascending else "DESC")
+    if limit:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+def iter_history_json(sql, params, summary=False, batch=500):
+    """Yields each history row as a JSON object string, reading `batch` rows at
+    a time from its own connection. The JSON text of each matrix blob is
+    spliced in as is instead of being decoded and encoded again."""
+    conn = store.connect()
+    try:
+        c = conn.execute(sql, params)
+        while True:
+            rows = c.fetchmany(batch)
+            if not rows:
+                break
+            metrics.inc("matrix_db_operations_total", {"kind": "read"}, len(rows))
+            for r in rows:
+                if summary:
+                    yield json.dumps({"id": r[0], "operation": r[1], "time": r[2]})
+                else:
+                    A, B, result = (store.blob_json(key, conn) for key in r[3:])
+                    yield (f'{{"id": {r[0]}, "operation": {json.dumps(r[1])}, "time": {json.dumps(r[2])}, '
+                           f'"A": {A}, "B": {B}, "result": {result}}}')
+    finally:
+        conn.close()
+
+def fetch_history(limit=500, **filters):
+    sql, params = history_query(limit, **filters)
+    return [json.loads(line) for line in iter_history_json(sql, params, filters.get("summary", False))]
+
+def fetch_entry(eid):
+    metrics.inc("matrix_db_operations_total", {"kind": "read"})
+    c = store.connection().cursor()
+    c.execute("SELECT id, operation, matrixA, matrixB, result, created_at FROM history WHERE id=?", (eid,))
+    r = c.fetchone()
+    if not r:
+        return None
+    A, B, result = (json.loads(store.blob_json(key)) for key in r[2:5])
+    return {"id": r[0], "operation": r[1], "A": A, "B": B, "result": result, "time": r[5]}
 
 def delete_entry(eid):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("DELETE FROM history WHERE id=?", (eid,))
-    conn.commit()
-    conn.close()
-    for fn in os.listdir(SAVED):
-        if fn.startswith(f"entry_{eid}_"):
-            try:
-                os.remove(os.path.join(SAVED, fn))
-            except Exception:
-                pass
+    c = store.connection().cursor()
+    c.execute("SELECT created_at FROM history WHERE id=?", (eid,))
+    r = c.fetchone()
+    results = stored_results("WHERE id=?", (eid,))
+    store.delete("WHERE id=?", (eid,))
+    delete_stored_results(results)
+    metrics.inc("matrix_db_operations_total", {"kind": "delete"})
+    drop_cached_pages(eid)
+    if r:
+        # pages written to disk before they were rendered on demand
+        try:
+            os.remove(os.path.join(SAVED, saved_page_name(eid, r[0])))
+        except OSError:
+            pass
+
+# ---------- Saved pages ----------
+# /saved_pages/entry_<id>_<ts>.html is rendered from the history row when it is
+# requested. Rendered pages up to SAVED_PAGE_MAX_BYTES are kept in a small LRU
+# (SAVED_PAGE_CACHE pages per worker, 0 disables it).
+SAVED_PAGE_CACHE = int(os.environ.get("SAVED_PAGE_CACHE", 256))
+SAVED_PAGE_MAX_BYTES = 256 * 1024
+SAVED_PAGE_RE = re.compile(r"entry_(\d+)_(\d{8}_\d{6})\.html")
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
 
-def create_saved_page(id_, operation, A, B, result, ts):
+def saved_page_name(id_, ts):
     safe_ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d_%H%M%S")
-    filename = f"entry_{id_}_{safe_ts}.html"
-    path = os.path.join(SAVED, filename)
-    html = f"""<!doctype html><html lang="en"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Saved Entry #{id_}</title></head>
+    return f"entry_{id_}_{safe_ts}.html"
+
+def cached_page(key):
+    with _page_cache_lock:
+        page = _page_cache.get(key)
+        if page is not None:
+            _page_cache.move_to_end(key)
+        return page
+
+def cache_page(key, page):
+    if not SAVED_PAGE_CACHE:
+        return
+    with _page_cache_lock:
+        _page_cache[key] = page
+        while len(_page_cache) > SAVED_PAGE_CACHE:
+            _page_cache.popitem(last=False)
+
+def drop_cached_pages(eid=None):
+    with _page_cache_lock:
+        if eid is None:
+            _page_cache.clear()
+        else:
+            for key in [k for k in _page_cache if k[0] == eid]:
+                del _page_cache[key]
+
+def iter_saved_page(entry):
+    """Yields the HTML of a saved entry piece by piece, one table row at a time."""
+    id_, operation, ts = entry["id"], escape(entry["operation"]), entry["time"]
+    yield f"""<!doctype html><html lang="en"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Saved Entry #{id_}</title></head>
     <body style="font-family:system-ui,Arial;padding:24px;background:#081126;color:#eaf4ff">
       <h1>Saved Entry #{id_}</h1>
       <p style="color:#9fb1c9">{operation} — {ts}</p>
-      <h3>Matrix A</h3>{render_matrix_html(A)}
-      <h3>Matrix B</h3>{render_matrix_html(B)}
-      <h3>Result</h3>{render_matrix_html(result)}
+      <h3>Matrix A</h3>"""
+    yield from iter_matrix_html(entry["A"])
+    yield "\n      <h3>Matrix B</h3>"
+    yield from iter_matrix_html(entry["B"])
+    yield "\n      <h3>Result</h3>"
+    yield from iter_matrix_html(entry["result"])
+    yield """
       <p><a href="/">Back</a></p>
     </body></html>"""
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(html)
 
-def render_matrix_html(mat):
+def iter_matrix_html(mat):
+    if isinstance(mat, dict) and "ref" in mat:
+        ref = escape(str(mat["ref"]))
+        yield f'<p><a href="/matrices/{ref}">Stored matrix {ref}</a></p>'
+        return
+    if not isinstance(mat, list) or not all(isinstance(row, list) for row in mat):
+        yield f"<pre>{escape(str(mat))}</pre>"
+        return
+    yield '<table style="border-collapse:collapse">'
+    for row in mat:
+        yield "<tr>" + "".join(f'<td style="border:1px solid rgba(0,0,0,0.12);padding:6px">{escape(str(val))}</td>' for val in row) + "</tr>"
+    yield "</table>"
+
+def stream_saved_page(key, entry):
+    """Streams a rendered page and caches it afterwards if it is small enough."""
+    chunks, size = [], 0
+    metrics.inc("matrix_file_operations_total", {"kind": "render"})
+    pieces, rendering = iter_saved_page(entry), 0.0
+    while True:
+        # time spent rendering only, not waiting for the client to read
+        t0 = time.perf_counter()
+        chunk = next(pieces, None)
+        rendering += time.perf_counter() - t0
+        if chunk is None:
+            break
+        yield chunk
+        if chunks is not None:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > SAVED_PAGE_MAX_BYTES:
+                chunks = None
+    metrics.observe("matrix_stage_duration_seconds", rendering, {"stage": "render"})
+    if chunks is not None:
+        cache_page(key, "".join(chunks))
+
+# ---------- Parsing ----------
+MAX_REPORTED_CELLS = 10
+
+def _parse_cell(val):
+    """Scalar parser for a single cell, used to locate bad cells and for the
+    cells of a delta."""
+    val_str = str(val)
+    if '/' in val_str:
+        num, den = map(float, val_str.split('/'))
+        return num / den
+    return float(val_str)
+
+def _flatten_grid(name, grid):
+    """Returns the cells of a list-of-rows matrix as one flat list plus its shape."""
+    if not isinstance(grid, list) or not all(isinstance(row, list) for row in grid):
+        raise ValueError(f"Matrix {name} must be a list of rows.")
+    cols = len(grid[0])
+    if any(len(row) != cols for row in grid):
+        raise ValueError(f"All rows of matrix {name} must have the same number of columns.")
+    return list(itertools.chain.from_iterable(grid)), (len(grid), cols)
+
+def _scalar_fill(values, cells, idx):
+    """Fills values[idx] with the scalar parser and returns the positions that fail.
+    Only used once the bulk conversion has hit a bad cell."""
+    bad = []
+    for i in idx:
+        try:
+            values[i] = _parse_cell(cells[i])
+        except (ValueError, TypeError, ZeroDivisionError):
+            bad.append(i)
+    return bad
+
+def _fraction_mask(cells, joined):
+    """Boolean mask of the cells containing '/'. When `joined` (the cells
+    joined by NUL) is ASCII, the slashes are found in its bytes and mapped to
+    their cells with one searchsorted, instead of testing cell by cell."""
+    if joined is not None and joined.isascii():
+        buf = np.frombuffer(joined.encode("ascii"), dtype=np.uint8)
+        ends = np.flatnonzero(buf == 0)
+        if len(ends) == len(cells) - 1:  # else some cell holds a NUL itself
+            frac = np.zeros(len(cells), dtype=bool)
+            frac[np.searchsorted(ends, np.flatnonzero(buf == ord('/')))] = True
+            return frac
+    # numbers mixed with fraction strings
+    return np.fromiter(map(operator.contains, map(str, cells), itertools.repeat('/')), bool, len(cells))
+
+def _convert_cells(cells, finite=True):
+    """Converts a flat list of cells to float64 and returns (values, bad_indices).
+    Plain numbers go through a single NumPy conversion. Cells containing '/'
+    are picked out with one mask, only their numerators and denominators are
+    converted and divided, and the quotients are scattered back in one
+    assignment. With `finite`, nan, inf and numbers beyond float64 count as
+    bad cells too."""
+    try:
+        joined = "\0".join(cells)
+    except TypeError:
+        joined = None  # non-string cells such as JSON numbers
+    if joined is None or '/' not in joined:
+        try:
+            values = np.array(cells, dtype=np.float64)
+        except (ValueError, TypeError):
+            pass
+        else:
+            # NumPy turns None into nan; reject it like any other non-number
+            if finite:
+                return values, np.flatnonzero(~np.isfinite(values)).tolist()
+            return values, [i for i in np.flatnonzero(np.isnan(values)).tolist() if cells[i] is None]
+
+    frac = _fraction_mask(cells, joined)
+    plain = np.fromiter(cells, object, len(cells))
+    frac_cells = plain[frac].tolist()
+    plain[frac] = 0.0
+
     try:
-        html = '<table style="border-collapse:collapse">'
-        for row in mat:
-            html += "<tr>" + "".join(f'<td style="border:1px solid rgba(0,0,0,0.12);padding:6px">{val}</td>' for val in row) + "</tr>"
-        html += "</table>"
-        return html
-    except Exception:
-        return f"<pre>{mat}</pre>"
+        values = plain.astype(np.float64)
+    except (ValueError, TypeError):
+        values = np.zeros(len(cells))
+        bad = _scalar_fill(values, plain, range(len(plain)))
+    else:
+        bad = [i for i in np.flatnonzero(np.isnan(values)).tolist() if plain[i] is None]
 
-def process_matrix_for_numpy(matrix_list):
+    if frac_cells:
+        parts = "/".join(frac_cells).split("/")
+        try:
+            if len(parts) != 2 * len(frac_cells):
+                raise ValueError("fraction with more than one '/'")
+            nd = np.array(parts, dtype=np.float64).reshape(-1, 2)
+        except ValueError:
+            bad += _scalar_fill(values, cells, np.flatnonzero(frac).tolist())
+        else:
+            bad += np.flatnonzero(frac)[nd[:, 1] == 0].tolist()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values[frac] = nd[:, 0] / nd[:, 1]
+    if finite:
+        bad = set(bad).union(np.flatnonzero(~np.isfinite(values)).tolist())
+    return values, sorted(bad)
+
+def parse_matrices(finite=True, **grids):
+    """Parses several named matrices (lists of rows of strings like '2', '-1.5'
+    or '3/4') into float64 arrays in one pass. All cells are flattened and
+    converted together; invalid cells from every matrix are reported in a
+    single ValueError with their row and column, which include nan, inf and
+    numbers beyond float64 unless `finite` is false. ndarrays are passed
+    through unchanged. Returns the arrays in the order the matrices were given."""
+    cells, shapes, ready = [], [], {}
+    for name, grid in grids.items():
+        if isinstance(grid, np.ndarray):
+            # already decoded from a binary request body
+            if grid.ndim != 2:
+                raise ValueError(f"Matrix {name} must be 2-dimensional.")
+            ready[name] = grid
+            shapes.append((name, None, len(cells)))
+            continue
+        if not grid:
+            shapes.append((name, None, len(cells)))
+            continue
+        flat, shape = _flatten_grid(name, grid)
+        shapes.append((name, shape, len(cells)))
+        cells += flat
+
+    values, bad = _convert_cells(cells, finite)
+    if bad:
+        msgs = []
+        for i in bad[:MAX_REPORTED_CELLS]:
+            name, shape, start = next(s for s in reversed(shapes) if s[1] and s[2] <= i)
+            r, c = divmod(i - start, shape[1])
+            msgs.append(f"'{cells[i]}' in {name} at row {r + 1}, column {c + 1}")
+        more = len(bad) - MAX_REPORTED_CELLS
+        if more > 0:
+            msgs.append(f"and {more} more")
+        raise ValueError(f"Invalid input {'; '.join(msgs)}. Please use valid numbers.")
+
+    out = []
+    for name, shape, start in shapes:
+        if name in ready:
+            out.append(ready[name])
+        elif shape is None:
+            out.append(np.array([]))
+        else:
+            out.append(values[start:start + shape[0] * shape[1]].reshape(shape))
+    return tuple(out)
+
+def process_matrix_for_numpy(matrix_list, name="A"):
     """Converts a list of lists of strings into a NumPy array of floats,
     handling fractions like '3/4'."""
-    if not matrix_list:
-      return np.array([])
-    
-    processed_matrix = []
-    for row in matrix_list:
-      processed_row = []
-      for val_str in row:
-          try:
-              if '/' in val_str:
-                  num, den = map(float, val_str.split('/'))
-                  processed_row.append(num / den)
-              else:
-                  processed_row.append(float(val_str))
-          except ValueError as e:
-              raise ValueError(f"Invalid input '{val_str}' found. Please use valid numbers.")
-      processed_matrix.append(processed_row)
-    return np.array(processed_matrix)
+    return parse_matrices(**{name: matrix_list})[0]
+
+# ---------- Wire formats ----------
+# Besides JSON, /calculate speaks NumPy's .npy format: the request body is the
+# .npy bytes of A followed by those of B (operation in the query string), and
+# the result comes back as a single .npy array when the client asks for it in
+# the Accept header. A .npy file is a small header (dtype, shape, order)
+# followed by the raw little-endian buffer, so operands are used in place.
+NPY_MIMETYPE = "application/x-npy"
+
+def read_npy_arrays(buf):
+    """Reads the .npy arrays concatenated in buf without copying their data."""
+    arrays, pos = [], 0
+    while pos < len(buf):
+        if buf[pos:pos + 6] != b"\x93NUMPY":
+            raise ValueError("Request body is not a sequence of .npy arrays.")
+        if pos + 8 > len(buf):
+            raise ValueError("Truncated .npy header in request body.")
+        major = buf[pos + 6]
+        size_fmt = "<H" if major == 1 else "<I"
+        prefix = 8 + struct.calcsize(size_fmt)
+        if pos + prefix > len(buf):
+            raise ValueError("Truncated .npy header in request body.")
+        header_len, = struct.unpack_from(size_fmt, buf, pos + 8)
+        if pos + prefix + header_len > len(buf):
+            raise ValueError("Truncated .npy header in request body.")
+        header = io.BytesIO(buf[pos:pos + prefix + header_len])
+        version = np.lib.format.read_magic(header)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+        else:
+            raise ValueError(f"Unsupported .npy version {version}.")
+        if dtype.kind not in "biuf":
+            raise ValueError(f"Unsupported dtype {dtype} in .npy array.")
+
+        start = pos + prefix + header_len
+        count = int(np.prod(shape))
+        pos = start + count * dtype.itemsize
+        if pos > len(buf):
+            raise ValueError("Truncated .npy array in request body.")
+        arr = np.frombuffer(buf, dtype=dtype, count=count, offset=start)
+        arr = arr.reshape(shape, order="F" if fortran_order else "C")
+        if arr.dtype != np.float64:
+            arr = arr.astype(np.float64)
+        arrays.append(arr)
+    return arrays
+
+def npy_bytes(arr):
+    buf = io.BytesIO()
+    np.save(buf, np.asarray(arr, dtype=np.float64), allow_pickle=False)
+    return buf.getvalue()
+
+def wants_npy():
+    return request.accept_mimetypes.best_match(["application/json", NPY_MIMETYPE]) == NPY_MIMETYPE
+
+def _history_value(mat):
+    return mat.tolist() if isinstance(mat, np.ndarray) else mat
+
+# ---------- Result cache ----------
+# Identical requests (retries, the random 3x3 defaults of the Streamlit client)
+# are answered from a cache keyed on the operation and a hash of the parsed
+# operands. Configured through the environment:
+#   MATRIX_CACHE_BYTES         in-process LRU budget, 0 disables it (default 64 MiB)
+#   MATRIX_CACHE_SHARED        path of an SQLite file shared by all workers (off by default)
+#   MATRIX_CACHE_SHARED_BYTES  budget of the shared tier (default 256 MiB)
+class ResultCache:
+    def __init__(self, max_bytes, shared_path=None, shared_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.shared_path = shared_path
+        self.shared_max_bytes = shared_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.shared_hits = 0
+        if shared_path:
+            conn = sqlite3.connect(shared_path)
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                         "size INTEGER NOT NULL, used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+            conn.commit()
+            conn.close()
+
+    @property
+    def enabled(self):
+        return bool(self.max_bytes or self.shared_path)
+
+    @staticmethod
+    def key(op, mats):
+        h = hashlib.blake2b(str(op).encode(), digest_size=20)
+        for M in mats:
+            M = np.ascontiguousarray(M, dtype=np.float64)
+            h.update(repr(M.shape).encode())
+            h.update(M.data)
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        value = self._shared_get(key) if self.shared_path else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.shared_hits += 1
+        self._local_put(key, value)
+        return value
+
+    def put(self, key, res):
+        value = np.asarray(res)
+        if value.base is not None:
+            value = value.copy()  # don't pin the operands a view points into
+        value.flags.writeable = False
+        self._local_put(key, value)
+        if self.shared_path:
+            self._shared_put(key, value)
+        return value
+
+    def get_or_compute(self, op, mats, compute):
+        if not self.enabled:
+            return compute()
+        key = self.key(op, mats)
+        res = self.get(key)
+        if res is None:
+            res = compute()
+            if self.cacheable(res):
+                res = self.put(key, res)
+        return res
+
+    @staticmethod
+    def cacheable(res):
+        # decompositions (dicts of arrays) and complex results are not cached
+        return not isinstance(res, dict) and np.asarray(res).dtype.kind in "biuf"
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.shared_path:
+            conn = sqlite3.connect(self.shared_path)
+            conn.execute("DELETE FROM cache")
+            conn.commit()
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            out = {"pid": os.getpid(), "hits": self.hits, "misses": self.misses,
+                   "shared_hits": self.shared_hits, "entries": len(self._entries),
+                   "bytes": self._bytes, "max_bytes": self.max_bytes}
+        if self.shared_path:
+            conn = sqlite3.connect(self.shared_path)
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+            conn.close()
+            out["shared"] = {"entries": entries, "bytes": size, "max_bytes": self.shared_max_bytes}
+        return out
+
+    def _local_put(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[key] = value
+            self._bytes += value.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def _shared_get(self, key):
+        conn = sqlite3.connect(self.shared_path)
+        row = conn.execute("SELECT value FROM cache WHERE key=?", (key,)).fetchone()
+        if row:
+            conn.execute("UPDATE cache SET used=? WHERE key=?", (time.time(), key))
+            conn.commit()
+        conn.close()
+        if not row:
+            return None
+        value = read_npy_arrays(row[0])[0]
+        value.flags.writeable = False
+        return value
+
+    def _shared_put(self, key, value):
+        blob = npy_bytes(value)
+        if len(blob) > self.shared_max_bytes:
+            return
+        conn = sqlite3.connect(self.shared_path)
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, size, used) VALUES (?,?,?,?)",
+                     (key, blob, len(blob), time.time()))
+        # evict least recently used rows beyond the byte budget
+        conn.execute("""DELETE FROM cache WHERE key IN (
+                          SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used DESC) AS total FROM cache)
+                          WHERE total > ?)""", (self.shared_max_bytes,))
+        conn.commit()
+        conn.close()
+
+result_cache = ResultCache(
+    int(os.environ.get("MATRIX_CACHE_BYTES", 64 * 2**20)),
+    shared_path=os.environ.get("MATRIX_CACHE_SHARED") or None,
+    shared_max_bytes=int(os.environ.get("MATRIX_CACHE_SHARED_BYTES", 256 * 2**20)),
+)
+
+# ---------- Worker pool ----------
+# Operations estimated above HEAVY_FLOPS run in a separate process so a big
+# determinant or product cannot hold a sync gunicorn worker on the CPU for
+# long: the request waits on a pipe, is killed after POOL_TIMEOUT seconds, and
+# gets a 503 with Retry-After when every pool worker is busy and POOL_QUEUE
+# more requests are already waiting. Everything cheaper runs inline.
+HEAVY_FLOPS = float(os.environ.get("HEAVY_FLOPS", 2e8))
+
+compute_pool = ComputePool(
+    workers=int(os.environ.get("POOL_WORKERS", 2)),
+    timeout=float(os.environ.get("POOL_TIMEOUT", 60)),
+    max_queue=int(os.environ.get("POOL_QUEUE", 8)),
+    blas_threads=int(os.environ.get("POOL_BLAS_THREADS", 1)),
+    retry_after=int(os.environ.get("POOL_RETRY_AFTER", 2)),
+)
+
+def compute(operation, mats, params):
+    if operation.flops(*mats, **params) >= HEAVY_FLOPS:
+        return compute_pool.run(operation.name, mats, params)
+    return operation(*mats, **params)
+
+def compute_structured(p, mats):
+    if p.flops >= HEAVY_FLOPS:
+        return compute_pool.call(run_structured, p, mats)
+    return run_structured(p, mats)
+
+# ---------- Stored matrices ----------
+# Large operands uploaded with POST /matrices, see blocked_ops. Blocked
+# operations always run in the worker pool, with their own timeout, and
+# keep at most BLOCKED_MEMORY_BYTES of tiles in memory.
+MATRIX_DIR = os.environ.get("MATRIX_DIR", os.path.join(BASE_DIR, "matrices"))
+BLOCKED_MEMORY_BYTES = int(os.environ.get("BLOCKED_MEMORY_BYTES", 256 * 2**20))
+BLOCKED_TIMEOUT = float(os.environ.get("BLOCKED_TIMEOUT", 3600))
+MATRIX_UPLOAD_MAX_BYTES = int(os.environ.get("MATRIX_UPLOAD_MAX_BYTES", 4 * 2**30))
+
+matrix_files = MatrixFiles(MATRIX_DIR)
+
+# A result computed on stored matrices is itself a stored matrix, kept while
+# a history entry holds it: its file goes when the last entry with that
+# result (the last reference to its blob) is deleted.
+def stored_results(where="", params=()):
+    """(blob hash, ref) for each stored matrix held as the result of the
+    history rows matching `where`."""
+    # {"ref": ..., "shape": [m, n]} compresses to well under 256 bytes
+    rows = store.connection().execute(
+        f"""SELECT hash, codec, dtype, shape, data FROM blobs WHERE codec='json' AND length(data) < 256
+            AND hash IN (SELECT result FROM history {where})""", params)
+    found = []
+    for key, *blob in rows:
+        value = decode_blob(*blob)
+        if is_stored_ref(value):
+            found.append((key, value["ref"]))
+    return found
+
+def delete_stored_results(found):
+    """Deletes the files of stored_results() that no history row refers to any more."""
+    conn = store.connection()
+    for key, ref in found:
+        if conn.execute("SELECT 1 FROM blobs WHERE hash=?", (key,)).fetchone() is None:
+            try:
+                matrix_files.delete(ref)
+            except ValueError:
+                pass  # not a reference this server made
+
+def run_stored(operation, raw):
+    """Computes `operation` on stored matrices into a new stored matrix and
+    returns its reference."""
+    if operation.name not in BLOCKED_KERNELS:
+        raise CalculationError(f"{operation.name} is not available for stored matrices, "
+                               f"use one of: {', '.join(BLOCKED_KERNELS)}")
+    if not all(is_stored_ref(raw[name]) for name in operation.operands):
+        raise CalculationError("Either all operands or none must be stored matrices")
+    mats = tuple(matrix_files.open(raw[name]["ref"]) for name in operation.operands)
+    error = operation.validate(*mats)
+    if error:
+        raise CalculationError(error)
+    ref, path = matrix_files.new_ref()
+    try:
+        compute_pool.call(run_blocked, operation.name, [M.filename for M in mats], path, BLOCKED_MEMORY_BYTES,
+                          timeout=BLOCKED_TIMEOUT)
+    finally:
+        # a worker killed on timeout leaves its partial output behind
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+    return {"ref": ref, "shape": list(result_shape(operation.name, mats))}
+
+# ---------- Exact mode ----------
+# "exact": true computes with integers and fractions, see exact_ops. Big
+# integer arithmetic costs far more than a float operation, so the FLOP
+# estimate is scaled by EXACT_COST_FACTOR before choosing the worker pool.
+EXACT_COST_FACTOR = 1000
+
+def wants_exact(source):
+    return str(source.get("exact", "")).lower() in ("1", "true", "yes", "on")
+
+def run_exact_calculation(operation, raw):
+    """Returns the exact result of `operation` as fraction strings."""
+    if operation.name not in EXACT_KERNELS:
+        raise CalculationError(f"Exact mode is available for: {', '.join(EXACT_KERNELS)}")
+    if any(is_sparse_payload(raw[name]) or is_stored_ref(raw[name]) for name in operation.operands):
+        raise CalculationError("Exact mode needs the matrices sent as rows of numbers or fractions")
+    # the float parser reports bad cells with their position, and the shape checks need arrays;
+    # integers beyond float64 are fine here, integer_matrix checks the cells itself
+    floats = parse_matrices(finite=False, **{name: raw[name] for name in operation.operands})
+    error = operation.validate(*floats)
+    if error:
+        raise CalculationError(error)
+    mats = tuple(integer_matrix(name, raw[name]) for name in operation.operands)
+    if operation.flops(*floats) * EXACT_COST_FACTOR >= HEAVY_FLOPS:
+        return compute_pool.call(run_exact, operation.name, mats)
+    return run_exact(operation.name, mats)
+
+# ---------- Delta sessions ----------
+# Incremental what-if analysis, see delta_ops: POST /sessions sends A and B
+# once, PATCH /sessions/<id> only the cells that changed, and gets back what
+# changed in each result. Sessions live in SESSION_DIR and are deleted
+# SESSION_TTL seconds after their last use. An inverse updated with
+# Sherman-Morrison is recomputed when its drift exceeds DELTA_TOLERANCE.
+SESSION_DIR = os.environ.get("SESSION_DIR", os.path.join(BASE_DIR, "sessions"))
+SESSION_TTL = float(os.environ.get("SESSION_TTL", 3600))
+DELTA_TOLERANCE = float(os.environ.get("DELTA_TOLERANCE", 1e-8))
+
+delta_sessions = DeltaSessions(SESSION_DIR, ttl=SESSION_TTL)
+
+def session_operand(name, value):
+    if is_stored_ref(value):
+        return np.asarray(matrix_files.open(value["ref"]), dtype=np.float64)
+    return parse_matrices(**{name: value})[0]
+
+def parse_delta(name, cells):
+    """[[row, column, value], ...] -> (rows, cols, values); when a cell is
+    listed twice, its last value wins."""
+    if not isinstance(cells, list):
+        raise CalculationError(f"{name} must be a list of [row, column, value] cells")
+    latest = {}
+    for cell in cells:
+        try:
+            i, j, value = cell
+            value = _parse_cell(value)
+            if not np.isfinite(value):
+                raise ValueError("not a finite number")
+            latest[(whole_number(i), whole_number(j))] = value
+        except (TypeError, ValueError, ZeroDivisionError):
+            raise CalculationError(f"Invalid cell {cell!r} in {name}, expected [row, column, value]")
+    idx = np.array(list(latest), dtype=np.int64).reshape(-1, 2)
+    return idx[:, 0], idx[:, 1], np.array(list(latest.values()), dtype=np.float64)
+
+def rebuild_session(session, names):
+    """Recomputes the results `names` of a session from scratch, in the
+    worker pool when that is heavy."""
+    if not names:
+        return
+    mats = {"A": session.array("A"), "B": session.array("B")}
+    flops = 0
+    for name in names:
+        operation = get_operation({"A": "inv-a", "B": "inv-b"}.get(name, name))
+        flops += operation.flops(*(mats[o] for o in operation.operands))
+    if flops >= HEAVY_FLOPS:
+        logdet = compute_pool.call(recompute, session.directory, names)
+    else:
+        logdet = recompute(session.directory, names)
+    session.meta["logdet"].update(logdet)
+
+def pool_busy(e):
+    resp = jsonify({"error": str(e)})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
+
+# ---------- Batch ----------
+MAX_BATCH_JOBS = 10000
+
+def _history_operands(operation, job):
+    """Operands recorded in history: only those the operation reads."""
+    return (_history_value(job.get("A", [])) if "A" in operation.operands else [],
+            _history_value(job.get("B", [])) if "B" in operation.operands else [])
+
+def _attempt(operation, mats, params):
+    """The result of one batch item, or the exception computing it raised."""
+    try:
+        return compute(operation, mats, params)
+    except Exception as e:
+        return e
+
+def run_batch(jobs):
+    """Evaluates a list of {operation, A, B} jobs. Jobs sharing an operation,
+    parameters and operand shapes are stacked and computed together, and all
+    history rows are written in one transaction. Returns one result or error
+    dict per job."""
+    results = [None] * len(jobs)
+    groups = {}
+    done = []
+    for i, job in enumerate(jobs):
+        try:
+            if not isinstance(job, dict):
+                raise ValueError("Each job must be an object with operation, A and B.")
+            operation = get_operation(job.get("operation"))
+            if operation is None:
+                raise ValueError("Invalid operation")
+            params = operation.read_params(job)
+            mats = parse_matrices(**{name: job.get(name, []) for name in operation.operands})
+            error = operation.validate(*mats)
+            if error:
+                raise ValueError(error)
+        except Exception as e:
+            results[i] = {"error": str(e)}
+            continue
+        key = None
+        if result_cache.enabled and operation.cached:
+            key = result_cache.key(operation.cache_name(params), mats)
+            cached = result_cache.get(key)
+            if cached is not None:
+                done.append((i, operation, cached))
+                continue
+        group = (operation.name, tuple(sorted(params.items()))) + tuple(M.shape for M in mats)
+        if not operation.stackable:
+            group += (i,)
+        groups.setdefault(group, []).append((i, key, mats, params))
+
+    for (name, *_), items in groups.items():
+        operation = get_operation(name)
+        params = items[0][3]
+        try:
+            if operation.stackable:
+                out = compute(operation, tuple(np.stack(ms) for ms in zip(*(item[2] for item in items))), params)
+                out = [take(out, n) for n in range(len(items))]
+            else:
+                out = [compute(operation, item[2], params) for item in items]
+        except Exception as e:
+            # one bad item (a singular solve, say) fails the whole stack:
+            # compute the items one by one so only that one gets the error
+            out = [e] if len(items) == 1 else [_attempt(operation, item[2], params) for item in items]
+        for (i, key, _, _), res in zip(items, out):
+            if isinstance(res, Exception):
+                results[i] = {"error": str(res)}
+                continue
+            if key is not None and result_cache.cacheable(res):
+                result_cache.put(key, res)
+            done.append((i, operation, res))
+
+    done.sort(key=lambda d: d[0])  # history ids follow job order
+    entries = [(operation.name, *_history_operands(operation, jobs[i]), result_to_json(res))
+               for i, operation, res in done]
+    saved = save_history_many(entries)
+    for (i, _, _), entry, (nid, ts) in zip(done, entries, saved):
+        results[i] = {"result": entry[3], "id": nid, "time": ts}
+    return results
+
+# ---------- Jobs ----------
+# POST /jobs takes the same JSON body as /calculate and returns at once; the
+# calculation runs on a background thread of the web worker that accepted it
+# (heavy kernels still go to the worker pool). Job state lives in the jobs
+# table of the history database, next to the history entry holding the
+# result, so any web worker can answer GET /jobs/<id> and results outlive the
+# process. The worker holding a queued or running job keeps a lease on it by
+# refreshing its updated_at every third of JOB_LEASE_SECONDS; a job whose
+# lease ran out belongs to a worker that died, and is taken over and run
+# again by the first worker to notice: at startup, at its own next beat, or
+# when asked about the job.
+JOB_THREADS = int(os.environ.get("JOB_THREADS", 2))
+JOB_POLL_SECONDS = 0.25
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 30))
+
+_job_executor = None
+_job_executor_pid = None
+_job_heartbeat_pid = None
+_active_jobs = set()
+_job_lock = threading.Lock()
+
+def init_jobs_table():
+    store.write("""
+      CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        operation TEXT NOT NULL,
+        request TEXT NOT NULL,
+        status TEXT NOT NULL,
+        progress REAL NOT NULL DEFAULT 0,
+        entry_id INTEGER,
+        error TEXT,
+        owner INTEGER,
+        created_at TIMESTAMP NOT NULL,
+        updated_at TIMESTAMP NOT NULL
+      )
+    """)
+    store.write("CREATE INDEX IF NOT EXISTS jobs_lease ON jobs (status, updated_at)")
+
+def job_executor():
+    global _job_executor, _job_executor_pid
+    with _job_lock:
+        if _job_executor_pid != os.getpid():
+            _job_executor = ThreadPoolExecutor(JOB_THREADS, thread_name_prefix="job")
+            _job_executor_pid = os.getpid()
+        return _job_executor
+
+def update_job(job_id, **fields):
+    """Updates a job this process owns; a job another worker has taken over
+    is left alone."""
+    fields["updated_at"] = utc_timestamp()
+    metrics.inc("matrix_db_operations_total", {"kind": "write"})
+    store.write(f"UPDATE jobs SET {', '.join(f'{k}=?' for k in fields)} WHERE id=? AND owner=?",
+                (*fields.values(), job_id, os.getpid()))
+
+def run_job(job_id, body):
+    try:
+        update_job(job_id, status="running", progress=0.1)
+        while True:
+            try:
+                operation, _, out, _ = run_calculation(body.get("operation"), body.get("A", []), body.get("B", []),
+                                                       body)
+                break
+            except PoolSaturated as e:
+                # a job has no client waiting on it: wait for a pool worker instead of failing
+                time.sleep(e.retry_after)
+        update_job(job_id, progress=0.9)
+        hist_A, hist_B = _history_operands(operation, body)
+        nid, _ = save_history(operation.name, hist_A, hist_B, out)
+    except Exception as e:
+        update_job(job_id, status="error", error=str(e) or type(e).__name__, progress=1.0)
+    else:
+        update_job(job_id, status="done", progress=1.0, entry_id=nid)
+    finally:
+        with _job_lock:
+            _active_jobs.discard(job_id)
+
+def submit_job(job_id, body):
+    with _job_lock:
+        _active_jobs.add(job_id)
+    start_job_heartbeat()
+    job_executor().submit(run_job, job_id, body)
+
+def reclaim_jobs(job_id=None):
+    """Takes over the queued or running jobs whose lease ran out (only
+    `job_id` when given) and runs them here. Returns the ids taken."""
+    sql = "SELECT id, request, owner, updated_at FROM jobs WHERE status IN ('queued', 'running') AND updated_at < ?"
+    params = [utc_timestamp(-JOB_LEASE_SECONDS)]
+    if job_id is not None:
+        sql += " AND id=?"
+        params.append(job_id)
+    taken = []
+    for jid, req, owner, updated in store.connection().execute(sql, params).fetchall():
+        with _job_lock:
+            if jid in _active_jobs:
+                continue  # running here, its lease is only late
+        # the worker whose update still finds the row as it was read wins the job
+        if store.write("""UPDATE jobs SET owner=?, status='queued', progress=0, updated_at=?
+                          WHERE id=? AND owner IS ? AND updated_at=?""",
+                       (os.getpid(), utc_timestamp(), jid, owner, updated)):
+            submit_job(jid, json.loads(req))
+            taken.append(jid)
+    return taken
+
+def _job_heartbeat():
+    while True:
+        try:
+            reclaim_jobs()
+            with _job_lock:
+                ids = list(_active_jobs)
+            if ids:
+                store.write(f"""UPDATE jobs SET updated_at=? WHERE owner=? AND status IN ('queued', 'running')
+                                AND id IN ({', '.join('?' * len(ids))})""", (utc_timestamp(), os.getpid(), *ids))
+        except sqlite3.Error:
+            pass  # a busy database: the next beat comes well within the lease
+        time.sleep(JOB_LEASE_SECONDS / 3)
+
+def start_job_heartbeat():
+    """Starts the thread that renews this process's leases and takes over
+    orphaned jobs, once per process."""
+    global _job_heartbeat_pid
+    with _job_lock:
+        if _job_heartbeat_pid == os.getpid():
+            return
+        _job_heartbeat_pid = os.getpid()
+    threading.Thread(target=_job_heartbeat, name="job-heartbeat", daemon=True).start()
+
+def fetch_job(job_id):
+    """The job as returned by GET /jobs/<id>, or None. Finished jobs carry
+    the history entry with their result."""
+    row = store.connection().execute(
+        """SELECT j.id, j.operation, j.status, j.progress, j.error,
+                  j.created_at, j.updated_at, h.id, h.result, h.created_at
+           FROM jobs j LEFT JOIN history h ON h.id = j.entry_id WHERE j.id=?""", (job_id,)).fetchone()
+    if row is None:
+        return None
+    jid, operation, status, progress, error, created, updated, eid, result, ts = row
+    if status in ("queued", "running") and updated < utc_timestamp(-JOB_LEASE_SECONDS) and reclaim_jobs(jid):
+        status, progress = "queued", 0.0
+    job = {"id": jid, "operation": operation, "status": status, "progress": progress,
+           "created_at": created, "updated_at": updated}
+    if status == "done":
+        if eid is None:
+            job["error"] = "The history entry with this result was deleted"
+        else:
+            job.update(result=json.loads(store.blob_json(result)), entry_id=eid, time=ts)
+    elif status == "error":
+        job["error"] = error
+    return job
 
 # ---------- Routes ----------
+class CalculationError(ValueError):
+    pass
+
+def parse_operands(operation, raw, finite=True):
+    """Parses the operands of `operation` from `raw` ({"A": ..., "B": ...}),
+    lists of rows or {"format": "coo"|"csr", ...} payloads that become CSR
+    matrices, and checks that they fit it. Returns (mats, sent_sparse,
+    sparse), `sparse` telling whether the operation runs on sparse kernels."""
+    sent_sparse = any(is_sparse_payload(raw[name]) for name in operation.operands)
+    dense_names = [name for name in operation.operands if not is_sparse_payload(raw[name])]
+    parsed = dict(zip(dense_names, parse_matrices(finite, **{name: raw[name] for name in dense_names})))
+    mats = tuple(parsed[name] if name in parsed else parse_sparse(name, raw[name], _convert_cells)
+                 for name in operation.operands)
+    sparse = choose_sparse(operation.name, mats)
+    if not sparse:
+        mats = to_dense(mats)
+    error = operation.validate(*mats)
+    if error:
+        raise CalculationError(error)
+    return mats, sent_sparse, sparse
+
+def run_calculation(op, A_list, B_list, params_source):
+    """Parses, validates and computes one /calculate request. Returns
+    (operation, res, out, path): the raw result, its JSON form and how it was
+    computed (see structured_ops; {"kernel": "cache"} when it came from the
+    result cache). Bad input raises ValueError (or CalculationError), pool
+    limits PoolSaturated/JobTimeout/WorkerDied."""
+    operation = get_operation(op)
+    if operation is None:
+        raise CalculationError("Invalid operation")
+    params = operation.read_params(params_source)
+    # float32 when the caller accepts ~7 significant digits, for the kernels that have it
+    precision = str(params_source.get("precision", "float64")).lower()
+    if precision not in PRECISIONS:
+        raise CalculationError(f"precision must be one of: {', '.join(PRECISIONS)}")
+    raw = {"A": A_list, "B": B_list}
+    if wants_exact(params_source):
+        with metrics.stage("compute"):
+            res = run_exact_calculation(operation, raw)
+        return operation, res, res, {"kernel": "exact"}
+    if any(is_stored_ref(raw[name]) for name in operation.operands):
+        with metrics.stage("compute"):
+            res = run_stored(operation, raw)
+        return operation, res, res, {"kernel": "blocked"}
+    # each operand is parsed and validated once, whatever the operation
+    with metrics.stage("parse"):
+        mats, sent_sparse, sparse = parse_operands(operation, raw)
+    for M in mats:
+        metrics.observe("matrix_operand_cells", M.shape[0] * M.shape[1], {"operation": op})
+    # the callbacks only run on a cache miss, so a hit skips planning as well
+    path = {"kernel": "cache"}
+
+    def computed(kernel_path, res):
+        nonlocal path
+        path = kernel_path
+        return res
+
+    def structured():
+        p = plan(op, mats, precision)
+        return computed(describe(p), compute_structured(p, mats))
+
+    t0 = time.perf_counter()
+    with metrics.stage("compute"):
+        if sparse:
+            res = computed({"kernel": "sparse"}, run_sparse(op, mats))
+        elif op in STRUCTURED_OPS:
+            # a name of its own: the generic and batch kernels cache the same
+            # operation with a different (less exact) kernel
+            name = operation.cache_name({**params, "kernel": "structured", "precision": precision})
+            res = result_cache.get_or_compute(name, mats, structured)
+        elif operation.cached:
+            res = result_cache.get_or_compute(operation.cache_name(params), mats,
+                                              lambda: computed({"kernel": "dense"}, compute(operation, mats, params)))
+        else:
+            res = computed({"kernel": "dense"}, compute(operation, mats, params))
+    metrics.observe("matrix_operation_duration_seconds", time.perf_counter() - t0, {"operation": op})
+    metrics.inc("matrix_kernel_total", {"operation": op, "kernel": path["kernel"]})
+
+    with metrics.stage("serialize"):
+        # sparse in, sparse out; dense callers get back the dense result they sent
+        if sent_sparse and (issparse(res) or np.ndim(res) == 2):
+            res = to_payload(res)
+        elif issparse(res):
+            res = res.toarray()
+        out = result_to_json(res)
+    return operation, res, out, path
+
 @app.route("/calculate", methods=["POST"])
 def calculate():
+    if request.mimetype == NPY_MIMETYPE:
+        op = request.args.get("operation")
+        params_source = request.args
+        try:
+            with metrics.stage("decode"):
+                A_list, B_list = (read_npy_arrays(request.get_data()) + [[], []])[:2]
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        with metrics.stage("decode"):
+            body = request.get_json(force=True)
+
+        try:
+            A_list = body.get("A", [])
+            B_list = body.get("B", [])
+            op = body.get("operation")
+            params_source = body
+        except (AttributeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+
+    try:
+        operation, res, out, path = run_calculation(op, A_list, B_list, params_source)
+    except (PoolSaturated, WorkerDied) as e:
+        return pool_busy(e)
+    except JobTimeout as e:
+        return jsonify({"error": str(e)}), 504
+    except Exception as e:
+        return jsonify({"error":str(e)}), 400
+
+    with metrics.stage("history"):
+        hist_A, hist_B = _history_operands(operation, {"A": A_list, "B": B_list})
+        nid, ts = save_history(op, hist_A, hist_B, out)
+    with metrics.stage("respond"):
+        # decompositions, stored references and exact fractions are always JSON
+        if wants_npy() and not isinstance(out, dict) and np.asarray(res).dtype.kind in "biuf":
+            resp = Response(npy_bytes(res), mimetype=NPY_MIMETYPE)
+            resp.headers["X-Entry-Id"] = str(nid)
+            resp.headers["X-Entry-Time"] = ts
+            resp.headers["X-Kernel"] = path["kernel"]
+            return resp
+        return jsonify({"result": out, "id": nid, "time": ts, "path": path})
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """Queues a calculation; the body is the JSON body of /calculate. Returns
+    202 with the job id, to be followed with GET /jobs/<id> or
+    GET /jobs/<id>/events."""
     body = request.get_json(force=True)
-    
+    if not isinstance(body, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    if get_operation(body.get("operation")) is None:
+        return jsonify({"error": "Invalid operation"}), 400
+    job_id = uuid.uuid4().hex
+    now = utc_timestamp()
+    store.write("""INSERT INTO jobs (id, operation, request, status, progress, owner, created_at, updated_at)
+                   VALUES (?,?,?,'queued',0,?,?,?)""",
+                (job_id, body["operation"], json.dumps(body), os.getpid(), now, now))
+    submit_job(job_id, body)
+    resp = jsonify({"id": job_id, "status": "queued"})
+    resp.status_code = 202
+    resp.headers["Location"] = f"/jobs/{job_id}"
+    return resp
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    job = fetch_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    """Server-Sent Events: a "progress" event whenever the status or progress
+    changes, then one "done" or "error" event with the finished job."""
+    if fetch_job(job_id) is None:
+        abort(404)
+
+    def events():
+        last, idle = None, 0.0
+        while True:
+            job = fetch_job(job_id)
+            state = (job["status"], job["progress"])
+            if job["status"] in ("done", "error"):
+                yield f"event: {job['status']}\ndata: {json.dumps(job)}\n\n"
+                return
+            if state != last:
+                last, idle = state, 0.0
+                yield f"event: progress\ndata: {json.dumps(job)}\n\n"
+            elif idle >= 15:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+            time.sleep(JOB_POLL_SECONDS)
+            idle += JOB_POLL_SECONDS
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/matrices", methods=["POST"])
+def upload_matrix():
+    """Stores a matrix sent as a single .npy file (Content-Type
+    application/x-npy) for use as {"ref": ...} in /calculate."""
+    if request.mimetype != NPY_MIMETYPE:
+        return jsonify({"error": f"Send the matrix as {NPY_MIMETYPE}"}), 415
+    too_large = {"error": f"A stored matrix can be at most {MATRIX_UPLOAD_MAX_BYTES} bytes."}
+    if (request.content_length or 0) > MATRIX_UPLOAD_MAX_BYTES:
+        return jsonify(too_large), 413
     try:
-        A_list = body.get("A", [])
-        B_list = body.get("B", [])
-        op = body.get("operation")
+        ref, M = matrix_files.save(request.stream, MATRIX_UPLOAD_MAX_BYTES)
+    except UploadTooLarge:
+        return jsonify(too_large), 413
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
+    metrics.inc("matrix_file_operations_total", {"kind": "upload"})
+    metrics.inc("matrix_file_bytes_total", {"direction": "upload"}, os.path.getsize(M.filename))
+    resp = jsonify({"ref": ref, "shape": list(M.shape), "dtype": str(M.dtype)})
+    resp.status_code = 201
+    resp.headers["Location"] = f"/matrices/{ref}"
+    return resp
 
+@app.route("/matrices/<ref>")
+def download_matrix(ref):
+    """Streams a stored matrix back as a .npy file."""
     try:
-        # Define the lists that will be saved to history
-        hist_A = A_list
-        hist_B = B_list
-
-        if op == "add":
-            A = process_matrix_for_numpy(A_list)
-            B = process_matrix_for_numpy(B_list)
-            if A.shape != B.shape:
-                return jsonify({"error":"Matrix sizes must match for addition"}), 400
-            res = (A + B).tolist()
-        elif op == "sub":
-            A = process_matrix_for_numpy(A_list)
-            B = process_matrix_for_numpy(B_list)
-            if A.shape != B.shape:
-                return jsonify({"error":"Matrix sizes must match for subtraction"}), 400
-            res = (A - B).tolist()
-        elif op == "mul":
-            A = process_matrix_for_numpy(A_list)
-            B = process_matrix_for_numpy(B_list)
-            if A.shape[1] != B.shape[0]:
-                return jsonify({"error":"For multiplication: cols(A) must equal rows(B)"}), 400
-            res = (A @ B).tolist()
-        elif op == "a2":
-            A = process_matrix_for_numpy(A_list)
-            if A.shape[0] != A.shape[1]:
-                return jsonify({"error":"Matrix A must be square for A^2"}), 400
-            res = (A @ A).tolist()
-            hist_B = [] # Set Matrix B to empty for this operation
-        elif op == "b2":
-            B = process_matrix_for_numpy(B_list)
-            if B.shape[0] != B.shape[1]:
-                return jsonify({"error":"Matrix B must be square for B^2"}), 400
-            res = (B @ B).tolist()
-            hist_A = [] # Set Matrix A to empty for this operation
-        elif op == "ta":
-            A = process_matrix_for_numpy(A_list)
-            res = A.T.tolist()
-            hist_B = [] # Set Matrix B to empty for this operation
-        elif op == "tb":
-            B = process_matrix_for_numpy(B_list)
-            res = B.T.tolist()
-            hist_A = [] # Set Matrix A to empty for this operation
-        elif op == "det-a":
-            A = process_matrix_for_numpy(A_list)
-            if A.shape[0] != A.shape[1]:
-                return jsonify({"error": "Matrix A must be square to calculate the determinant"}), 400
-            res = np.linalg.det(A).tolist()
-            hist_B = [] # Set Matrix B to empty for this operation
-        elif op == "det-b":
-            B = process_matrix_for_numpy(B_list)
-            if B.shape[0] != B.shape[1]:
-                return jsonify({"error": "Matrix B must be square to calculate the determinant"}), 400
-            res = np.linalg.det(B).tolist()
-            hist_A = [] # Set Matrix A to empty for this operation
-        else:
-            return jsonify({"error":"Invalid operation"}), 400
-    except Exception as e:
-        return jsonify({"error":str(e)}), 400
+        path = matrix_files.path(ref)
+    except ValueError:
+        abort(404)
+    if os.path.exists(path):
+        metrics.inc("matrix_file_operations_total", {"kind": "download"})
+        metrics.inc("matrix_file_bytes_total", {"direction": "download"}, os.path.getsize(path))
+    return send_from_directory(MATRIX_DIR, os.path.basename(path), mimetype=NPY_MIMETYPE,
+                               as_attachment=True, download_name=f"{ref}.npy")
+
+@app.route("/delete-matrix/<ref>", methods=["POST"])
+def delete_matrix(ref):
+    try:
+        deleted = matrix_files.delete(ref)
+    except ValueError:
+        deleted = False
+    if not deleted:
+        abort(404)
+    return jsonify({"ok": True})
+
+@app.route("/sessions", methods=["POST"])
+def create_session():
+    """Starts a delta session. Body: {"operations": ["mul", "det-a", ...],
+    "A": ..., "B": ...} with the operands as rows or stored {"ref": ...}
+    matrices. Returns 201 with the session id and scalar results; matrix
+    results are read with GET /sessions/<id>/<operation>."""
+    body = request.get_json(force=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    ops = body.get("operations")
+    if not isinstance(ops, list) or not ops or any(op not in DELTA_OPS for op in ops):
+        return jsonify({"error": f"operations must be a list of: {', '.join(DELTA_OPS)}"}), 400
+    used = {o for op in ops for o in get_operation(op).operands}
+    try:
+        # an operand no operation reads may be left out
+        mats = {name: session_operand(name, body.get(name)) if name in used else np.zeros((0, 0))
+                for name in "AB"}
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    for op in ops:
+        operation = get_operation(op)
+        error = operation.validate(*(mats[o] for o in operation.operands))
+        if error:
+            return jsonify({"error": error}), 400
+
+    sid = delta_sessions.create(mats["A"], mats["B"], dict.fromkeys(ops))
+    try:
+        with delta_sessions.open(sid, exclusive=True) as session:
+            with metrics.stage("compute"):
+                rebuild_session(session, session.results_needed())
+            session.meta["dirty"] = False
+            session.save_meta()
+            out = session.describe(stale=session.results_needed())
+    except (PoolSaturated, WorkerDied, JobTimeout) as e:
+        delta_sessions.delete(sid)
+        if not isinstance(e, JobTimeout):
+            return pool_busy(e)
+        return jsonify({"error": str(e)}), 504
+    resp = jsonify(out)
+    resp.status_code = 201
+    resp.headers["Location"] = f"/sessions/{sid}"
+    return resp
+
+@app.route("/sessions/<sid>", methods=["PATCH"])
+def update_session(sid):
+    """Changes cells of a session. Body: {"A": [[row, column, value], ...],
+    "B": [...], "version": n}, rows and columns counted from 0; with
+    "version", a session changed since then answers 409. Returns per result
+    what changed in it, or "recomputed" when it has to be fetched again."""
+    body = request.get_json(force=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    try:
+        changes = {name: parse_delta(name, body[name]) for name in "AB" if name in body}
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        with delta_sessions.open(sid, exclusive=True) as session:
+            version = session.meta["version"]
+            if body.get("version", version) != version:
+                return jsonify({"error": f"Session was changed, it is at version {version}",
+                                "version": version}), 409
+            t0 = time.perf_counter()
+            with metrics.stage("compute"):
+                # a change that was interrupted half-way leaves the session dirty
+                rebuilt = session.results_needed() if session.meta["dirty"] else []
+                rebuild_session(session, rebuilt)
+                report, stale = session.apply(changes, DELTA_TOLERANCE, np.random.default_rng())
+                rebuild_session(session, stale)
+            metrics.observe("matrix_operation_duration_seconds", time.perf_counter() - t0, {"operation": "delta"})
+            session.meta["version"] += 1
+            session.meta["dirty"] = False
+            session.save_meta()
+            return jsonify(session.describe(report, rebuilt + stale))
+    except KeyError:
+        abort(404)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except (PoolSaturated, WorkerDied) as e:
+        return pool_busy(e)
+    except JobTimeout as e:
+        return jsonify({"error": str(e)}), 504
 
-    nid, ts = save_history(op, hist_A, hist_B, res)
-    return jsonify({"result": res, "id": nid, "time": ts})
+@app.route("/sessions/<sid>/<op>")
+def session_result(sid, op):
+    """The current result of one operation of a session, as JSON or .npy."""
+    try:
+        with delta_sessions.open(sid) as session:
+            if op not in session.meta["operations"]:
+                abort(404)
+            version = session.meta["version"]
+            try:
+                res = session.result(op)
+            except ValueError as e:
+                return jsonify({"error": str(e), "version": version}), 400
+            if isinstance(res, dict):
+                return jsonify(dict(res, version=version))
+            if wants_npy():
+                resp = Response(npy_bytes(res), mimetype=NPY_MIMETYPE)
+                resp.headers["X-Session-Version"] = str(version)
+                return resp
+            return jsonify({"result": res.tolist(), "version": version})
+    except KeyError:
+        abort(404)
+
+@app.route("/delete-session/<sid>", methods=["POST"])
+def delete_session(sid):
+    if not delta_sessions.delete(sid):
+        abort(404)
+    return jsonify({"ok": True})
+
+@app.route("/calculate-batch", methods=["POST"])
+def calculate_batch():
+    body = request.get_json(force=True)
+    jobs = body.get("jobs") if isinstance(body, dict) else body
+    if not isinstance(jobs, list):
+        return jsonify({"error": "Expected a list of jobs"}), 400
+    if len(jobs) > MAX_BATCH_JOBS:
+        return jsonify({"error": f"A batch may contain at most {MAX_BATCH_JOBS} jobs"}), 400
+    return jsonify({"results": run_batch(jobs)})
+
+@app.route("/operations")
+def list_operations():
+    """The registered operations with their parameters, whether they have an
+    exact kernel and the precisions they compute in."""
+    return jsonify([dict(operation.describe(), exact=name in EXACT_KERNELS,
+                         precisions=list(PRECISIONS) if name in STRUCTURED_OPS else ["float64"])
+                    for name, operation in OPERATIONS.items()])
+
+@app.route("/cache-stats")
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route("/pool-stats")
+def pool_stats():
+    """Worker pool load in this web worker: in_flight jobs, queued jobs
+    waiting for a free process, and completed/failed/timeouts/rejected counts."""
+    return jsonify(dict(compute_pool.stats(), pid=os.getpid(), heavy_flops=HEAVY_FLOPS))
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/profile", methods=["POST"])
+def start_profile():
+    """Samples the Python stacks of requests to one endpoint for a while, in
+    every worker. Body: {"endpoint": "calculate", "seconds": 60,
+    "interval_ms": 5}; "seconds": 0 stops. GET /profile returns the samples."""
+    body = request.get_json(force=True) or {}
+    endpoint = body.get("endpoint")
+    if endpoint not in app.view_functions:
+        return jsonify({"error": f"Unknown endpoint, use one of: {', '.join(sorted(app.view_functions))}"}), 400
+    try:
+        seconds = min(float(body.get("seconds", 60)), 3600)
+        interval = max(float(body.get("interval_ms", 5)), 1) / 1000
+    except (TypeError, ValueError):
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    return jsonify(profiler.configure(endpoint, seconds, interval))
+
+@app.route("/profile")
+def profile_samples():
+    """Samples of the current or last profile, as folded stacks ("a;b;c count")."""
+    return Response(profiler.folded(), mimetype="text/plain")
 
 @app.route("/history")
 def history():
-    limit = request.args.get("limit", 5, type=int)
-    return jsonify(fetch_history(limit=limit))
+    """Newest entries first. Query parameters:
+    limit (0 = no limit), before/after (entry id cursors), operation (repeat
+    or comma-separate), since/until (created_at bounds), summary=1 (id,
+    operation and time only), format=ndjson (one entry per line)."""
+    args = request.args
+    operations = [op for value in args.getlist("operation") for op in value.split(",") if op]
+    summary = args.get("summary", "0") not in ("0", "false", "")
+    sql, params = history_query(limit=args.get("limit", 5, type=int),
+                                before=args.get("before", type=int),
+                                after=args.get("after", type=int),
+                                operations=operations,
+                                since=args.get("since"),
+                                until=args.get("until"),
+                                summary=summary)
+    lines = iter_history_json(sql, params, summary)
+
+    ndjson = (args.get("format") == "ndjson"
+              or request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE)
+    if ndjson:
+        return Response((line + "\n" for line in lines), mimetype=NDJSON_MIMETYPE)
+
+    def json_array():
+        yield "["
+        for i, line in enumerate(lines):
+            yield line if i == 0 else ", " + line
+        yield "]"
+    return Response(json_array(), mimetype="application/json")
 
 @app.route("/delete-entry/<int:entry_id>", methods=["POST"])
 def api_delete(entry_id):
@@ -209,27 +1472,273 @@ def api_delete(entry_id):
 
 @app.route("/export-entry/<int:entry_id>")
 def api_export(entry_id):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("SELECT id, operation, matrixA, matrixB, result, created_at FROM history WHERE id=?", (entry_id,))
-    r = c.fetchone()
-    conn.close()
-    if not r:
+    out = fetch_entry(entry_id)
+    if not out:
         abort(404)
-    out = {"id": r[0], "operation": r[1], "A": json.loads(r[2]), "B": json.loads(r[3]), "result": json.loads(r[4]), "time": r[5]}
     return jsonify(out)
 
+# ---------- Bulk export / import ----------
+# /export-history streams the whole table (or a filtered range) oldest first,
+# reading it through a cursor so memory use does not grow with the table:
+#   - as NDJSON, one /history entry per line (the default), or
+#   - as a zip archive (format=npz) holding matrices/<id>.npz with the
+#     array-valued A, B and result of each entry, and manifest.ndjson with one
+#     line per entry: its id, operation, time, the names of its arrays and
+#     the other values inline. The manifest is the last member.
+# /import-history takes either format back and inserts every entry in one
+# transaction: all of them or, on the first invalid entry, none. Entries get
+# new ids, so an export can be imported next to existing history.
+# Imported values are checked like /calculate input: the operands of each
+# entry must parse and fit its operation, and its result must have the form of
+# a result (see check_result).
+ZIP_MIMETYPE = "application/zip"
+HISTORY_VALUES = ("A", "B", "result")
+
+class _ZipSink:
+    """Unseekable file that collects what zipfile writes until drained."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+def iter_history_zip(sql, params, batch=500):
+    """Yields a zip archive of the history rows of `sql` (see above) in pieces."""
+    sink = _ZipSink()
+    with tempfile.TemporaryFile() as manifest:
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+            conn = store.connect()
+            try:
+                c = conn.execute(sql, params)
+                while True:
+                    rows = c.fetchmany(batch)
+                    if not rows:
+                        break
+                    metrics.inc("matrix_db_operations_total", {"kind": "read"}, len(rows))
+                    for eid, op, ts, *keys in rows:
+                        entry, arrays = {"id": eid, "operation": op, "time": ts}, {}
+                        for name, key in zip(HISTORY_VALUES, keys):
+                            value = store.blob_value(key, conn)
+                            if isinstance(value, np.ndarray):
+                                arrays[name] = value
+                            else:
+                                entry[name] = value
+                        if arrays:
+                            buf = io.BytesIO()
+                            np.savez_compressed(buf, **arrays)
+                            # already compressed, deflating again would only cost time
+                            zf.writestr(f"matrices/{eid}.npz", buf.getvalue(), zipfile.ZIP_STORED)
+                            entry["arrays"] = list(arrays)
+                        manifest.write(json.dumps(entry).encode() + b"\n")
+                        yield sink.drain()
+            finally:
+                conn.close()
+            manifest.seek(0)
+            with zf.open("manifest.ndjson", "w", force_zip64=True) as out:
+                for chunk in iter(lambda: manifest.read(1 << 16), b""):
+                    out.write(chunk)
+                    yield sink.drain()
+    yield sink.drain()
+
+def parse_import_entry(entry):
+    """Checks one imported entry and returns its (operation, A, B, result, created_at) row."""
+    if not isinstance(entry, dict):
+        raise ValueError("must be a JSON object")
+    op = entry.get("operation")
+    if not isinstance(op, str) or get_operation(op) is None:
+        raise ValueError(f"unknown operation {op!r}")
+    missing = [name for name in HISTORY_VALUES if name not in entry]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    ts = entry.get("time") or utc_timestamp()
+    try:
+        datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        raise ValueError(f"time must be 'YYYY-MM-DD HH:MM:SS', got {ts!r}")
+    values = [entry[name] for name in HISTORY_VALUES]
+    check_import_values(get_operation(op), *values)
+    return (op, *values, ts)
+
+def _listed(value):
+    return value.tolist() if isinstance(value, np.ndarray) else value
+
+def _cells(value):
+    value = _listed(value)
+    if isinstance(value, list):
+        return itertools.chain.from_iterable(row if isinstance(row, list) else [row] for row in value)
+    return [value]
+
+def check_result(value, name="result"):
+    """Raises ValueError unless `value` has the form of a stored result: a
+    number, a fraction string (exact mode), a 1-D or rectangular 2-D list of
+    them, a stored matrix reference, a sparse payload, or an object of such
+    values (decompositions, complex results)."""
+    value = _listed(value)
+    if isinstance(value, dict):
+        if is_stored_ref(value):
+            matrix_files.path(value["ref"])
+        elif is_sparse_payload(value):
+            # results may overflow to inf, operands may not
+            parse_sparse(name, value, lambda cells: _convert_cells(cells, finite=False))
+        elif not value:
+            raise ValueError(f"{name} must not be empty")
+        else:
+            for key, part in value.items():
+                check_result(part, f"{name}.{key}")
+        return
+    if isinstance(value, list):
+        if not value:
+            raise ValueError(f"{name} must not be empty")
+        rows = value if isinstance(value[0], list) else [value]
+        if not all(isinstance(row, list) for row in rows) or len({len(row) for row in rows}) != 1:
+            raise ValueError(f"{name} must be a list of numbers or of rows of the same length")
+        cells = itertools.chain.from_iterable(rows)
+    else:
+        cells = [value]
+    for cell in cells:
+        if isinstance(cell, str):
+            try:
+                Fraction(cell)
+            except (ValueError, ZeroDivisionError):
+                raise ValueError(f"{name} holds {cell!r}, which is not a number or fraction")
+        elif isinstance(cell, bool) or not isinstance(cell, (int, float)):
+            raise ValueError(f"{name} holds {cell!r}, which is not a number")
+
+def check_import_values(operation, A, B, result):
+    """Checks the operands and result of an imported entry; operands the
+    operation does not read only need to be lists."""
+    raw = {"A": _listed(A), "B": _listed(B)}
+    for name in "AB":
+        if name not in operation.operands and not isinstance(raw[name], list):
+            raise ValueError(f"{name} must be a list, {operation.name} does not read it")
+    if any(is_stored_ref(raw[name]) for name in operation.operands):
+        for name in operation.operands:
+            if not is_stored_ref(raw[name]):
+                raise ValueError("Either all operands or none must be stored matrices")
+            matrix_files.path(raw[name]["ref"])
+    else:
+        # exact results come as fraction strings; their integers may lie beyond float64
+        exact = any(isinstance(cell, str) for cell in _cells(result))
+        parse_operands(operation, raw, finite=not exact)
+    check_result(result)
+
+def iter_import_ndjson(stream):
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+def iter_import_zip(zf):
+    try:
+        manifest = zf.open("manifest.ndjson")
+    except KeyError:
+        raise ValueError("The archive has no manifest.ndjson")
+    with manifest:
+        for entry in iter_import_ndjson(manifest):
+            arrays = entry.pop("arrays", None) if isinstance(entry, dict) else None
+            if arrays:
+                try:
+                    data = zf.read(f"matrices/{entry.get('id')}.npz")
+                except KeyError:
+                    raise ValueError(f"matrices/{entry.get('id')}.npz is missing")
+                with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+                    entry.update((name, npz[name]) for name in arrays)
+            yield entry
+
+def import_rows(entries):
+    """The rows of the parsed entries; a bad entry (or line) raises
+    ValueError with its number, which rolls the whole import back."""
+    entries = iter(entries)
+    for n in itertools.count(1):
+        try:
+            entry = next(entries, None)
+            if entry is None:
+                return
+            row = parse_import_entry(entry)
+        except (ValueError, KeyError) as e:
+            raise ValueError(f"Entry {n}: {e}") from None
+        yield row
+
+@app.route("/export-history")
+def export_history():
+    """All entries oldest first, as NDJSON or format=npz (a zip archive).
+    Takes the filters of /history: operation, since/until, before/after and
+    limit (default 0 = no limit)."""
+    args = request.args
+    operations = [op for value in args.getlist("operation") for op in value.split(",") if op]
+    sql, params = history_query(limit=args.get("limit", 0, type=int),
+                                before=args.get("before", type=int),
+                                after=args.get("after", type=int),
+                                operations=operations,
+                                since=args.get("since"),
+                                until=args.get("until"),
+                                ascending=True)
+    stamp = datetime.strptime(utc_timestamp(), "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d_%H%M%S")
+    if args.get("format") == "npz":
+        resp = Response(iter_history_zip(sql, params), mimetype=ZIP_MIMETYPE)
+        name = f"history-{stamp}.zip"
+    else:
+        resp = Response((line + "\n" for line in iter_history_json(sql, params)), mimetype=NDJSON_MIMETYPE)
+        name = f"history-{stamp}.ndjson"
+    resp.headers["Content-Disposition"] = f"attachment; filename={name}"
+    return resp
+
+@app.route("/import-history", methods=["POST"])
+def import_history():
+    """Adds the entries of an /export-history download (NDJSON, or the zip
+    archive as application/zip) to the history, under new ids."""
+    if request.mimetype not in (NDJSON_MIMETYPE, ZIP_MIMETYPE):
+        return jsonify({"error": f"Send {NDJSON_MIMETYPE} or {ZIP_MIMETYPE}"}), 415
+    try:
+        # the rows are written in one transaction: the body is spooled to disk
+        # first, so a slow upload never holds the history write lock (zipfile
+        # also needs to seek)
+        with tempfile.TemporaryFile() as spool:
+            shutil.copyfileobj(request.stream, spool, 1 << 20)
+            spool.seek(0)
+            if request.mimetype == NDJSON_MIMETYPE:
+                count, first, last = store.import_rows(import_rows(iter_import_ndjson(spool)))
+            else:
+                with zipfile.ZipFile(spool) as zf:
+                    count, first, last = store.import_rows(import_rows(iter_import_zip(zf)))
+    except (ValueError, zipfile.BadZipFile) as e:
+        return jsonify({"error": str(e)}), 400
+    metrics.inc("matrix_db_operations_total", {"kind": "insert"}, count)
+    return jsonify({"imported": count, "first_id": first, "last_id": last})
+
 @app.route("/saved_pages/<path:fn>")
 def serve_saved(fn):
-    return send_from_directory(SAVED, fn)
+    m = SAVED_PAGE_RE.fullmatch(fn)
+    if not m:
+        return send_from_directory(SAVED, fn)
+    key = (int(m.group(1)), m.group(2))
+    page = cached_page(key)
+    if page is not None:
+        # another worker may have deleted the entry since it was cached
+        c = store.connection().cursor()
+        c.execute("SELECT 1 FROM history WHERE id=?", (key[0],))
+        if c.fetchone():
+            return Response(page, mimetype="text/html")
+        drop_cached_pages(key[0])
+    entry = fetch_entry(key[0])
+    if not entry or saved_page_name(entry["id"], entry["time"]) != fn:
+        abort(404)
+    return Response(stream_saved_page(key, entry), mimetype="text/html")
 
 @app.route("/clear-history", methods=["POST"])
 def clear_history():
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("DELETE FROM history")
-    conn.commit()
-    conn.close()
+    results = stored_results()
+    store.delete()
+    delete_stored_results(results)
+    store.write("DELETE FROM jobs WHERE status IN ('done', 'error')")
+    drop_cached_pages()
     for f in os.listdir(SAVED):
         try:
             os.remove(os.path.join(SAVED, f))
@@ -237,6 +1746,9 @@ def clear_history():
             pass
     return jsonify({"ok": True})
 
+init_db()
+init_jobs_table()
+start_job_heartbeat()
+
 if __name__ == "__main__":
-    init_db()
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
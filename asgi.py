@@ -0,0 +1,232 @@
+import asyncio
+import io
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+
+from app import app as flask_app, metrics, store
+from compute_pool import PoolSaturated
+
+# ---------- ASGI ----------
+# The routes of app.py for an asyncio server, e.g.
+#   uvicorn asgi:app --host 0.0.0.0 --port $PORT
+# (gunicorn app:app keeps serving the same app over WSGI). The event loop only
+# moves bytes: each request runs the Flask app on a thread, so NumPy (whose
+# BLAS calls release the GIL), SQLite and file I/O never block it.
+#   - /calculate, /calculate-batch and the delta session updates run on
+#     COMPUTE_CONCURRENCY threads (default: the number of cores; divide it by
+#     the number of server processes). Up to COMPUTE_QUEUE more requests wait
+#     in the loop without holding a thread, beyond that they get a 503 with
+#     Retry-After like a saturated worker pool.
+#   - Long streams (job events, which last as long as the job, history
+#     exports and stored matrix downloads) run on MAX_STREAMS threads of
+#     their own, so they can never take all the threads of other requests;
+#     one more gets a 503 with Retry-After.
+#   - Everything else (history, saved pages, uploads) runs on IO_THREADS
+#     threads.
+# Responses are sent chunk by chunk as the Flask iterator yields them.
+# Request bodies above BODY_MEMORY_BYTES are spooled to a temporary file.
+COMPUTE_ENDPOINTS = {"calculate", "calculate_batch", "create_session", "update_session"}
+STREAM_ENDPOINTS = {"job_events", "export_history", "download_matrix"}
+COMPUTE_CONCURRENCY = int(os.environ.get("COMPUTE_CONCURRENCY", os.cpu_count() or 1))
+COMPUTE_QUEUE = int(os.environ.get("COMPUTE_QUEUE", 64))
+COMPUTE_RETRY_AFTER = int(os.environ.get("COMPUTE_RETRY_AFTER", 1))
+IO_THREADS = int(os.environ.get("IO_THREADS", 32))
+MAX_STREAMS = int(os.environ.get("MAX_STREAMS", 16))
+BODY_MEMORY_BYTES = 1 << 20
+
+metrics.gauge("matrix_compute_in_flight", "ASGI requests computing on a compute thread.")
+metrics.gauge("matrix_compute_waiting", "ASGI requests waiting for a compute thread.")
+metrics.counter("matrix_compute_rejected_total", "ASGI requests refused because the compute queue was full.")
+metrics.gauge("matrix_streams_open", "ASGI long streams being sent.")
+metrics.counter("matrix_streams_rejected_total", "ASGI long streams refused because MAX_STREAMS were open.")
+
+_DONE = object()
+
+
+def _first_chunk(wsgi_app, environ, start_response):
+    result = wsgi_app(environ, start_response)
+    chunks = iter(result)
+    return result, chunks, next(chunks, _DONE)
+
+
+class AsgiApp:
+    """Serves a WSGI app over ASGI, running it on thread pools."""
+
+    def __init__(self, wsgi_app, compute_concurrency, compute_queue, io_threads, max_streams):
+        self.wsgi_app = wsgi_app
+        self.compute_concurrency = compute_concurrency
+        self.compute_queue = compute_queue
+        self.max_streams = max_streams
+        self.compute = ThreadPoolExecutor(compute_concurrency, thread_name_prefix="compute")
+        self.io = ThreadPoolExecutor(io_threads, thread_name_prefix="io")
+        # one thread per open stream: a stream never waits for a thread
+        self.streams = ThreadPoolExecutor(max_streams, thread_name_prefix="stream")
+        self._slots = asyncio.Semaphore(compute_concurrency)
+        self.in_flight = self.waiting = self.streaming = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            raise RuntimeError(f"Unsupported ASGI scope {scope['type']}")
+        body, size = await self._read_body(receive)
+        environ = self._environ(scope, body, size)
+        endpoint = self._endpoint(environ)
+        if endpoint in STREAM_ENDPOINTS:
+            return await self._stream(environ, receive, send)
+        if endpoint not in COMPUTE_ENDPOINTS:
+            return await self._respond(environ, receive, send, self.io)
+
+        if self._slots.locked() and self.waiting >= self.compute_queue:
+            metrics.inc("matrix_compute_rejected_total")
+            return await self._busy(send)
+        self.waiting += 1
+        metrics.set("matrix_compute_waiting", self.waiting)
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+            metrics.set("matrix_compute_waiting", self.waiting)
+        self.in_flight += 1
+        metrics.set("matrix_compute_in_flight", self.in_flight)
+        try:
+            await self._respond(environ, receive, send, self.compute)
+        finally:
+            self.in_flight -= 1
+            metrics.set("matrix_compute_in_flight", self.in_flight)
+            self._slots.release()
+
+    async def _stream(self, environ, receive, send):
+        if self.streaming >= self.max_streams:
+            metrics.inc("matrix_streams_rejected_total")
+            return await self._busy(send, "Too many open streams, please retry later")
+        self.streaming += 1
+        metrics.set("matrix_streams_open", self.streaming)
+        try:
+            await self._respond(environ, receive, send, self.streams)
+        finally:
+            self.streaming -= 1
+            metrics.set("matrix_streams_open", self.streaming)
+
+    def _endpoint(self, environ):
+        try:
+            return flask_app.url_map.bind_to_environ(environ).match()[0]
+        except HTTPException:
+            return None
+
+    async def _read_body(self, receive):
+        loop = asyncio.get_running_loop()
+        buf, spool, size = io.BytesIO(), None, 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if spool is None and size > BODY_MEMORY_BYTES:
+                spool = await loop.run_in_executor(self.io, tempfile.TemporaryFile)
+                await loop.run_in_executor(self.io, spool.write, buf.getvalue())
+                buf = None
+            elif spool is None:
+                buf.write(chunk)
+            if spool is not None and chunk:
+                await loop.run_in_executor(self.io, spool.write, chunk)
+            if not message.get("more_body"):
+                break
+        body = spool if spool is not None else buf
+        body.seek(0)
+        return body, size
+
+    @staticmethod
+    def _environ(scope, body, size):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+            "REMOTE_ADDR": client[0],
+            "CONTENT_LENGTH": str(size),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope["headers"]:
+            key = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if key == "CONTENT_TYPE":
+                environ[key] = value
+            elif key != "CONTENT_LENGTH":
+                key = "HTTP_" + key
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _respond(self, environ, receive, send, executor):
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"], started["headers"] = status, headers
+            return lambda data: started.setdefault("written", []).append(data)
+
+        result, chunks, chunk = await loop.run_in_executor(
+            executor, _first_chunk, self.wsgi_app, environ, start_response)
+        # an endless stream (job events) stops once the client is gone
+        gone = asyncio.ensure_future(self._disconnected(receive))
+        try:
+            status = int(started["status"].split(" ", 1)[0])
+            headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in started["headers"]]
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            for data in started.get("written", ()):
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+            while chunk is not _DONE and not gone.done():
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await loop.run_in_executor(executor, next, chunks, _DONE)
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            gone.cancel()
+            if hasattr(result, "close"):
+                await loop.run_in_executor(executor, result.close)
+
+    @staticmethod
+    async def _disconnected(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    async def _busy(self, send, error=None):
+        body = json.dumps({"error": error or str(PoolSaturated(COMPUTE_RETRY_AFTER))}).encode()
+        await send({"type": "http.response.start", "status": 503,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"retry-after", str(COMPUTE_RETRY_AFTER).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await asyncio.get_running_loop().run_in_executor(self.io, store.flush)
+                self.compute.shutdown(wait=False)
+                self.io.shutdown(wait=False)
+                self.streams.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+app = AsgiApp(flask_app, COMPUTE_CONCURRENCY, COMPUTE_QUEUE, IO_THREADS, MAX_STREAMS)
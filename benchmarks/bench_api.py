@@ -0,0 +1,368 @@
+"""
+Benchmarks for the Flask API: micro-benchmarks of each stage of /calculate
+and a concurrent load generator, run against the app in-process (Flask test
+client) or against a real gunicorn server.
+
+Run from the repository root:
+    python benchmarks/bench_api.py micro [--sizes 2 10 100 500 1000 2000] [--ops add mul det-a]
+    python benchmarks/bench_api.py load [--gunicorn --workers 2 | --url http://127.0.0.1:5000]
+                                        [--concurrency 8] [--seconds 10]
+    python benchmarks/bench_api.py compare baseline.json current.json
+
+micro and load save their results with --json out.json. With --baseline
+old.json they also compare against an earlier run and exit with status 1
+when a result is more than --tolerance (default 15%) worse. Latencies count
+as worse when higher and throughput when lower. The in-process app and the
+gunicorn server use a temporary history database and matrix directory, so
+the repository's own history.db is never touched.
+
+The load scenarios send the same payloads over and over, so the result cache
+is off (MATRIX_CACHE_BYTES=0, no MATRIX_CACHE_SHARED) and every request is
+computed. Set MATRIX_CACHE_BYTES to measure with the in-process cache; the
+setting is printed with the results and saved with --json.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+SCRATCH = tempfile.mkdtemp(prefix="bench-api-")
+for _var, _name in (("HISTORY_DB", "history.db"), ("MATRIX_DIR", "matrices"), ("SESSION_DIR", "sessions"),
+                    ("METRICS_DIR", "metrics")):
+    os.environ.setdefault(_var, os.path.join(SCRATCH, _name))
+os.environ.setdefault("MATRIX_CACHE_BYTES", "0")
+os.environ.pop("MATRIX_CACHE_SHARED", None)
+
+
+def cache_setting():
+    """The result cache of this run, as reported with the results."""
+    size = int(os.environ["MATRIX_CACHE_BYTES"])
+    return f"result cache: {f'{size} bytes in-process' if size else 'off'} (MATRIX_CACHE_BYTES={size})"
+
+
+# ---------- Micro-benchmarks ----------
+def timed_runs(fn, repeat, min_seconds=0.01):
+    """Seconds per call of fn, `repeat` times. Fast calls are looped until a
+    run lasts at least `min_seconds`."""
+    t0 = time.perf_counter()
+    fn()
+    first = time.perf_counter() - t0
+    number = max(int(min_seconds / first) + 1, 1) if first < min_seconds else 1
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - t0) / number)
+    return runs
+
+
+def default_ops():
+    from operations import OPERATIONS
+    # the operations on B alone run the same kernels as those on A
+    return [name for name, operation in OPERATIONS.items() if operation.operands != "B"]
+
+
+def micro(args):
+    from app import parse_matrices, save_history
+    from operations import get_operation, result_to_json
+
+    rng = np.random.default_rng(0)
+    results = {}
+
+    def record(stage, n, fn):
+        runs = timed_runs(fn, args.repeat)
+        results[f"micro/{stage}/{n}"] = {"median_ms": float(np.median(runs)) * 1e3,
+                                         "min_ms": min(runs) * 1e3}
+        print(f"{n:>6} {stage:>14} {np.median(runs) * 1e3:>11.3f} {min(runs) * 1e3:>11.3f}")
+
+    print(f"{'size':>6} {'stage':>14} {'median ms':>11} {'min ms':>11}")
+    for n in args.sizes:
+        X = rng.uniform(-1, 1, size=(n, n))
+        # symmetric positive definite, so that every operation accepts A
+        A_cells = (X @ X.T + n * np.eye(n)).round(6).astype(str).tolist()
+        B_cells = rng.uniform(-1, 1, size=(n, n)).round(6).astype(str).tolist()
+        record("parse", n, lambda: parse_matrices(A=A_cells, B=B_cells))
+        A, B = parse_matrices(A=A_cells, B=B_cells)
+
+        for name in args.ops:
+            operation = get_operation(name)
+            mats = [A if o == "A" else B for o in operation.operands]
+            params = operation.read_params({})
+            if operation.validate(*mats) or operation.flops(*mats, **params) > args.max_flops:
+                continue
+            record(f"op/{name}", n, lambda: operation(*mats, **params))
+
+        res = A @ B
+        record("serialize", n, lambda: json.dumps({"result": result_to_json(res)}))
+
+        # history blobs are deduplicated, so every write gets an A of its own
+        out = result_to_json(res)
+        variants = iter(range(10**9))
+        record("history", n, lambda: save_history("mul", [[str(next(variants))] + A_cells[0][1:]] + A_cells[1:],
+                                                  B_cells, out))
+    return results
+
+
+# ---------- Load generator ----------
+def grid(n, seed):
+    return np.random.default_rng(seed).integers(-9, 10, size=(n, n)).astype(str).tolist()
+
+
+SCENARIOS = {
+    "calculate-add-10": ("POST", "/calculate", {"operation": "add", "A": grid(10, 1), "B": grid(10, 2)}),
+    "calculate-mul-100": ("POST", "/calculate", {"operation": "mul", "A": grid(100, 3), "B": grid(100, 4)}),
+    "calculate-inv-200": ("POST", "/calculate", {"operation": "inv-a", "A": grid(200, 5), "B": [[]]}),
+    "calculate-mul-400": ("POST", "/calculate", {"operation": "mul", "A": grid(400, 6), "B": grid(400, 7)}),
+    "history": ("GET", "/history?limit=50&summary=1", None),
+    "operations": ("GET", "/operations", None),
+}
+
+
+class TestClientTarget:
+    """Requests through the Flask test client, in this process."""
+
+    def __init__(self):
+        from app import app
+        self.app = app
+
+    def session(self):
+        client = self.app.test_client()
+
+        def send(method, path, body):
+            return client.open(path, method=method, json=body).status_code
+        return send
+
+    def close(self):
+        pass
+
+
+class HttpTarget:
+    """Requests over HTTP, one connection per load thread."""
+
+    def __init__(self, url, process=None):
+        parts = urllib.parse.urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.process = process
+
+    def session(self):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+
+        def send(method, path, body):
+            data = json.dumps(body).encode() if body is not None else None
+            headers = {"Content-Type": "application/json"} if data else {}
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                raise
+            if resp.getheader("Connection", "").lower() == "close":
+                conn.close()
+            return resp.status
+        return send
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(10)
+
+
+def start_server(server, workers, extra=()):
+    """Starts gunicorn (WSGI, app:app) or uvicorn (ASGI, asgi:app) on a free
+    port and returns an HttpTarget for it once it answers."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    if server == "gunicorn":
+        cmd = ["gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(workers), *extra, "app:app"]
+    else:
+        cmd = ["uvicorn", "--port", str(port), "--workers", str(workers), "--log-level", "warning", *extra, "asgi:app"]
+    process = subprocess.Popen([sys.executable, "-m", *cmd], cwd=ROOT, env=os.environ.copy())
+    target = HttpTarget(f"http://127.0.0.1:{port}", process)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{server} exited with status {process.returncode}")
+        try:
+            if target.session()("GET", "/operations", None) == 200:
+                return target
+        except OSError:
+            time.sleep(0.2)
+    target.close()
+    raise SystemExit(f"{server} did not start within 60s")
+
+
+def make_target(args):
+    if args.url:
+        return HttpTarget(args.url)
+    if args.gunicorn:
+        return start_server("gunicorn", args.workers, args.gunicorn_args.split())
+    return TestClientTarget()
+
+
+def load(args, target=None):
+    """Runs the load test against `target` (by default the one chosen by
+    --url / --gunicorn) and stops it afterwards."""
+    target = target or make_target(args)
+    endpoints = args.endpoints or list(SCENARIOS)
+    latencies = {name: [] for name in endpoints}
+    errors = dict.fromkeys(endpoints, 0)
+    lock = threading.Lock()
+    start = time.monotonic()
+    measure_from = start + args.warmup
+    stop = measure_from + args.seconds
+
+    def client(offset):
+        send = target.session()
+        i = offset
+        while True:
+            name = endpoints[i % len(endpoints)]
+            i += 1
+            method, path, body = SCENARIOS[name]
+            t0 = time.monotonic()
+            if t0 >= stop:
+                return
+            try:
+                ok = send(method, path, body) < 400
+            except Exception:
+                ok = False
+            elapsed = time.monotonic() - t0
+            if t0 >= measure_from:
+                with lock:
+                    latencies[name].append(elapsed)
+                    if not ok:
+                        errors[name] += 1
+
+    threads = [threading.Thread(target=client, args=(k,)) for k in range(args.concurrency)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        target.close()
+    duration = max(time.monotonic(), stop) - measure_from
+
+    results = {}
+    print(cache_setting())
+    print(f"{'endpoint':>18} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name in endpoints:
+        lat = np.array(latencies[name]) * 1e3
+        if not len(lat):
+            continue
+        p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+        results[f"load/{name}"] = {"requests": len(lat), "errors": errors[name], "rps": len(lat) / duration,
+                                   "p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+        print(f"{name:>18} {len(lat):>9} {errors[name]:>7} {len(lat) / duration:>8.1f} "
+              f"{p50:>9.2f} {p95:>9.2f} {p99:>9.2f}")
+    return results
+
+
+# ---------- Baselines ----------
+def regressions(baseline, current, tolerance, min_delta_ms):
+    """(key, metric, old, new) for every result worse than the baseline by
+    more than `tolerance`. Millisecond differences below `min_delta_ms` are
+    treated as noise."""
+    worse = []
+    for key, new in current.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        for metric, value in new.items():
+            if metric not in old:
+                continue
+            if metric.endswith("_ms"):
+                if value > old[metric] * (1 + tolerance) and value - old[metric] > min_delta_ms:
+                    worse.append((key, metric, old[metric], value))
+            elif metric == "rps" and value < old[metric] * (1 - tolerance):
+                worse.append((key, metric, old[metric], value))
+    return worse
+
+
+def report(baseline_path, results, args):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    worse = regressions(baseline, results, args.tolerance, args.min_delta_ms)
+    if not worse:
+        print(f"No regressions against {baseline_path} (tolerance {args.tolerance:.0%})")
+        return 0
+    print(f"Regressions against {baseline_path} (tolerance {args.tolerance:.0%}):")
+    for key, metric, old, new in worse:
+        print(f"  {key} {metric}: {old:.3f} -> {new:.3f} ({new / old - 1:+.0%})")
+    return 1
+
+
+def save(path, mode, args, results):
+    meta = {"mode": mode, "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+            "cpus": os.cpu_count(), "result_cache_bytes": int(os.environ["MATRIX_CACHE_BYTES"]),
+            "args": {k: v for k, v in vars(args).items() if k != "func"}}
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = ap.add_subparsers(dest="mode", required=True)
+
+    def with_baseline(p):
+        p.add_argument("--json", help="save the results to this file")
+        p.add_argument("--baseline", help="compare against results saved with --json")
+        p.add_argument("--tolerance", type=float, default=0.15)
+        p.add_argument("--min-delta-ms", type=float, default=0.05)
+        return p
+
+    m = with_baseline(sub.add_parser("micro", help="time parsing, each operation, serialization and history writes"))
+    m.add_argument("--sizes", type=int, nargs="+", default=[2, 10, 100, 500, 1000, 2000])
+    m.add_argument("--ops", nargs="+", help="operations to time (default: all but those on B alone)")
+    m.add_argument("--repeat", type=int, default=5)
+    m.add_argument("--max-flops", type=float, default=2e10, help="skip operations estimated above this")
+
+    ld = with_baseline(sub.add_parser("load", help="concurrent requests, latency percentiles and throughput"))
+    ld.add_argument("--url", help="an already running server")
+    ld.add_argument("--gunicorn", action="store_true", help="start gunicorn on a free port")
+    ld.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    ld.add_argument("--gunicorn-args", default="", help='extra gunicorn options, e.g. "--threads 4"')
+    ld.add_argument("--endpoints", nargs="+", choices=list(SCENARIOS))
+    ld.add_argument("--concurrency", type=int, default=8)
+    ld.add_argument("--seconds", type=float, default=10)
+    ld.add_argument("--warmup", type=float, default=1)
+
+    c = sub.add_parser("compare", help="compare two saved result files")
+    c.add_argument("baseline")
+    c.add_argument("current")
+    c.add_argument("--tolerance", type=float, default=0.15)
+    c.add_argument("--min-delta-ms", type=float, default=0.05)
+    args = ap.parse_args()
+
+    if args.mode == "compare":
+        with open(args.current) as f:
+            sys.exit(report(args.baseline, json.load(f)["results"], args))
+    if args.mode == "micro":
+        args.ops = args.ops or default_ops()
+        results = micro(args)
+    else:
+        results = load(args)
+    if args.json:
+        save(args.json, args.mode, args, results)
+    if args.baseline:
+        sys.exit(report(args.baseline, results, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+The same mixed load against gunicorn serving app:app (WSGI, sync workers)
+and uvicorn serving asgi:app (ASGI), with the same number of processes.
+
+Run from the repository root:
+    python benchmarks/bench_asgi.py [--workers 2] [--concurrency 16] [--seconds 15]
+
+The mix interleaves small requests (a 10x10 addition, a history page, the
+operation list) with large ones (a 400x400 product, a 200x200 inverse), so
+it shows how long small requests wait behind large ones in each server.
+Both servers run with the result cache off, as set up by bench_api, so every
+calculation is computed rather than served from the cache; set
+MATRIX_CACHE_BYTES to measure with it.
+Extra server options go in --gunicorn-args / --uvicorn-args, e.g.
+--gunicorn-args "--threads 4".
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_api import SCENARIOS, cache_setting, load, report, save, start_server  # noqa: E402
+
+MIX = ["calculate-add-10", "history", "calculate-mul-400", "operations", "calculate-inv-200"]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--workers", type=int, default=2, help="server processes")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--seconds", type=float, default=15)
+    ap.add_argument("--warmup", type=float, default=2)
+    ap.add_argument("--endpoints", nargs="+", choices=list(SCENARIOS), default=MIX)
+    ap.add_argument("--gunicorn-args", default="")
+    ap.add_argument("--uvicorn-args", default="")
+    ap.add_argument("--json", help="save both runs to this file")
+    ap.add_argument("--baseline", help="compare against results saved with --json")
+    ap.add_argument("--tolerance", type=float, default=0.15)
+    ap.add_argument("--min-delta-ms", type=float, default=0.05)
+    args = ap.parse_args()
+
+    results = {}
+    for server, extra in (("gunicorn", args.gunicorn_args), ("uvicorn", args.uvicorn_args)):
+        print(f"\n{server} ({'WSGI' if server == 'gunicorn' else 'ASGI'}), {args.workers} workers")
+        target = start_server(server, args.workers, extra.split())
+        for key, value in load(args, target).items():
+            results[f"{server}/{key}"] = value
+
+    print(f"\n{cache_setting()}")
+    print(f"{'endpoint':>18} {'p50 WSGI':>9} {'p50 ASGI':>9} {'p99 WSGI':>9} {'p99 ASGI':>9}")
+    for name in args.endpoints:
+        wsgi, asgi = results.get(f"gunicorn/load/{name}"), results.get(f"uvicorn/load/{name}")
+        if wsgi and asgi:
+            print(f"{name:>18} {wsgi['p50_ms']:>9.1f} {asgi['p50_ms']:>9.1f} {wsgi['p99_ms']:>9.1f} {asgi['p99_ms']:>9.1f}")
+    if args.json:
+        save(args.json, "asgi", args, results)
+    if args.baseline:
+        sys.exit(report(args.baseline, results, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Exact mode against the float64 path for det, inverse and multiply, and
+against plain Fraction object arrays for the smaller sizes.
+
+Run from the repository root:
+    python benchmarks/bench_exact.py [--sizes 10 50 100 200] [--fractions]
+
+Matrices hold random integers in [-9, 9], or with --fractions random p/q
+with q in [1, 9]. "max err" is the largest relative error of the float
+result against the exact one.
+"""
+import argparse
+import os
+import sys
+import time
+from fractions import Fraction
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from exact_ops import EXACT_KERNELS, integer_matrix  # noqa: E402
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - t0
+
+
+def fraction_det(F):
+    """Gaussian elimination on an object array of Fractions."""
+    F = F.copy()
+    n, det = len(F), Fraction(1)
+    for k in range(n):
+        p = next((i for i in range(k, n) if F[i, k] != 0), None)
+        if p is None:
+            return Fraction(0)
+        if p != k:
+            F[[k, p]] = F[[p, k]]
+            det = -det
+        det *= F[k, k]
+        F[k + 1:, k:] -= np.outer(F[k + 1:, k] / F[k, k], F[k, k:])
+    return det
+
+
+def max_rel_err(approx, exact):
+    approx = np.ravel(approx)
+    exact = np.array([float(Fraction(v)) for v in np.ravel(np.array(exact, dtype=object))])
+    return float(np.max(np.abs(approx - exact) / np.maximum(np.abs(exact), 1e-300)))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 100, 200])
+    ap.add_argument("--fractions", action="store_true", help="use p/q entries instead of integers")
+    ap.add_argument("--fraction-max", type=int, default=50, help="largest size timed with Fraction arrays")
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'n':>5} {'op':>6} {'float s':>9} {'exact s':>9} {'Fraction s':>11} {'max err':>9}")
+    for n in args.sizes:
+        if args.fractions:
+            cells = [[f"{rng.integers(-9, 10)}/{rng.integers(1, 10)}" for _ in range(n)] for _ in range(2 * n)]
+        else:
+            cells = rng.integers(-9, 10, size=(2 * n, n)).astype(str).tolist()
+        A_cells, B_cells = cells[:n], cells[n:]
+        A = np.array([[float(Fraction(c)) for c in row] for row in A_cells])
+        B = np.array([[float(Fraction(c)) for c in row] for row in B_cells])
+        exact_A, exact_B = integer_matrix("A", A_cells), integer_matrix("B", B_cells)
+        FA = np.array([[Fraction(c) for c in row] for row in A_cells], dtype=object)
+        FB = np.array([[Fraction(c) for c in row] for row in B_cells], dtype=object)
+
+        cases = [
+            ("det", lambda: np.linalg.det(A), lambda: EXACT_KERNELS["det-a"](exact_A), lambda: fraction_det(FA)),
+            ("inv", lambda: np.linalg.inv(A), lambda: EXACT_KERNELS["inv-a"](exact_A), None),
+            ("mul", lambda: A @ B, lambda: EXACT_KERNELS["mul"](exact_A, exact_B), lambda: FA @ FB),
+        ]
+        for op, float_fn, exact_fn, fraction_fn in cases:
+            approx, float_s = timed(float_fn)
+            exact, exact_s = timed(exact_fn)
+            if fraction_fn is not None and n <= args.fraction_max:
+                fraction_s = f"{timed(fraction_fn)[1]:11.3f}"
+            else:
+                fraction_s = f"{'skipped':>11}"
+            err = max_rel_err(approx, exact)
+            print(f"{n:>5} {op:>6} {float_s:9.4f} {exact_s:9.3f} {fraction_s} {err:9.1e}")
+
+
+if __name__ == "__main__":
+    main()
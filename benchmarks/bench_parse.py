@@ -0,0 +1,80 @@
+"""
+Compares the bulk matrix parser in app.py against the original per-cell loop.
+
+Run from the repository root:
+    python benchmarks/bench_parse.py [--sizes 10 100 500 1000] [--repeat 5]
+
+Importing app opens its history database and data directories, so they
+are pointed at a temporary directory: the repository's own history.db is
+never touched.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SCRATCH = tempfile.mkdtemp(prefix="bench-parse-")
+for _var, _name in (("HISTORY_DB", "history.db"), ("MATRIX_DIR", "matrices"), ("SESSION_DIR", "sessions"),
+                    ("METRICS_DIR", "metrics")):
+    os.environ.setdefault(_var, os.path.join(SCRATCH, _name))
+from app import parse_matrices  # noqa: E402
+
+
+def legacy_process_matrix(matrix_list):
+    """The per-cell parser that app.py used before parse_matrices."""
+    if not matrix_list:
+        return np.array([])
+    processed_matrix = []
+    for row in matrix_list:
+        processed_row = []
+        for val_str in row:
+            if '/' in val_str:
+                num, den = map(float, val_str.split('/'))
+                processed_row.append(num / den)
+            else:
+                processed_row.append(float(val_str))
+        processed_matrix.append(processed_row)
+    return np.array(processed_matrix)
+
+
+def make_grid(n, fraction_ratio, rng):
+    grid = rng.uniform(-100, 100, size=(n, n)).round(3).astype(str)
+    if fraction_ratio:
+        mask = rng.random((n, n)) < fraction_ratio
+        nums = rng.integers(-9, 10, size=(n, n)).astype(str)
+        dens = rng.integers(1, 10, size=(n, n)).astype(str)
+        grid[mask] = np.char.add(np.char.add(nums, "/"), dens)[mask]
+    return grid.tolist()
+
+
+def best_of(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000])
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'size':>6} {'fractions':>9} {'legacy ms':>10} {'bulk ms':>9} {'speedup':>8}")
+    for n in args.sizes:
+        for ratio in (0.0, 0.1):
+            A = make_grid(n, ratio, rng)
+            B = make_grid(n, ratio, rng)
+            expected = (legacy_process_matrix(A), legacy_process_matrix(B))
+            got = parse_matrices(A=A, B=B)
+            assert all(np.allclose(e, g) for e, g in zip(expected, got))
+
+            legacy = best_of(lambda: (legacy_process_matrix(A), legacy_process_matrix(B)), args.repeat)
+            bulk = best_of(lambda: parse_matrices(A=A, B=B), args.repeat)
+            print(f"{n:>6} {ratio:>9.0%} {legacy * 1e3:>10.2f} {bulk * 1e3:>9.2f} {legacy / bulk:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
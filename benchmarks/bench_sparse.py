@@ -0,0 +1,74 @@
+"""
+Memory and time of the sparse kernels against dense NumPy for add, mul,
+transpose and solve, with a finite-difference Laplacian as A and a random
+matrix of the given fill ratio as B.
+
+Run from the repository root:
+    python benchmarks/bench_sparse.py [--sizes 1000 10000] [--density 0.001]
+
+Dense timings are skipped when the dense operands and result would not fit in
+--dense-limit-mb; the memory they would need is still reported.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sparse_ops import SPARSE_KERNELS  # noqa: E402
+
+
+def sparse_bytes(M):
+    M = M.tocsr()
+    return M.data.nbytes + M.indices.nbytes + M.indptr.nbytes
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1024, 10000])
+    ap.add_argument("--density", type=float, default=0.001)
+    ap.add_argument("--dense-limit-mb", type=int, default=2048)
+    args = ap.parse_args()
+
+    print(f"{'n':>6} {'op':>6} {'sparse MB':>10} {'dense MB':>10} {'sparse s':>9} {'dense s':>9}")
+    for n in args.sizes:
+        rng = np.random.default_rng(0)
+        # A: 5-point finite-difference Laplacian on a k x k grid, B: random fill
+        k = int(round(n ** 0.5))
+        n = k * k
+        T = sp.diags([-1.0, 2.0, -1.0], [-1, 0, 1], shape=(k, k))
+        A = (sp.kron(sp.identity(k), T) + sp.kron(T, sp.identity(k))).tocsr()
+        B = sp.random(n, n, density=args.density, format="csr", random_state=rng)
+        rhs = rng.random((n, 1))
+        dense_mb = 3 * n * n * 8 / 2**20
+        run_dense = dense_mb <= args.dense_limit_mb
+        if run_dense:
+            Ad, Bd = A.toarray(), B.toarray()
+
+        cases = [
+            ("add", lambda: SPARSE_KERNELS["add"](A, B), lambda: Ad + Bd),
+            ("mul", lambda: SPARSE_KERNELS["mul"](A, B), lambda: Ad @ Bd),
+            ("ta", lambda: SPARSE_KERNELS["ta"](A), lambda: np.ascontiguousarray(Ad.T)),
+            ("solve", lambda: SPARSE_KERNELS["solve"](A, rhs), lambda: np.linalg.solve(Ad, rhs)),
+        ]
+        for op, sparse_fn, dense_fn in cases:
+            res, sparse_s = timed(sparse_fn)
+            res_bytes = sparse_bytes(res) if sp.issparse(res) else res.nbytes
+            sparse_mb = (sparse_bytes(A) + sparse_bytes(B) + res_bytes) / 2**20
+            dense_s = f"{timed(dense_fn)[1]:9.3f}" if run_dense else f"{'skipped':>9}"
+            print(f"{n:>6} {op:>6} {sparse_mb:10.1f} {dense_mb:10.1f} {sparse_s:9.3f} {dense_s}")
+        if run_dense:
+            del Ad, Bd
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Time and accuracy of the structure-aware kernels (structured_ops) against
+the plain NumPy call each operation used before, per structure class: dense,
+diagonal, triangular, banded, symmetric and integer operands, for mul, a2
+and det-a.
+
+Run from the repository root:
+    python benchmarks/bench_structured.py [--sizes 200 1000 2000] [--bandwidth 4] [--float32]
+
+"detect" is the time spent looking at the operands, included in
+"structured". "rel err" and "plain err" compare both results with an exact
+determinant (up to 20x20) or a product in extended precision (up to
+--exact-limit); beyond that "rel err" compares the two results and
+"plain err" is left out.
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from fractions import Fraction
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from exact_ops import bareiss  # noqa: E402
+from structured_ops import plan, run_structured  # noqa: E402
+
+def plain_det(A):
+    # large random determinants overflow, which is part of the comparison
+    with np.errstate(over="ignore", under="ignore"):
+        return np.linalg.det(A)
+
+
+PLAIN = {
+    "mul": lambda A, B: A @ B,
+    "a2": lambda A: A @ A,
+    "det-a": plain_det,
+}
+
+
+def best_of(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return out, best
+
+
+def operands(kind, n, bandwidth, rng):
+    G = rng.standard_normal((n, n))
+    if kind == "diagonal":
+        return np.diag(np.diag(G))
+    if kind == "triangular":
+        return np.triu(G)
+    if kind == "banded":
+        return np.triu(np.tril(G, bandwidth), -bandwidth)
+    if kind == "symmetric":
+        return G + G.T
+    if kind == "integer":
+        return rng.integers(-9, 10, (n, n)).astype(float)
+    return G
+
+
+def reference(op, mats, limit):
+    """The result in extended precision, or None when that is too slow."""
+    n = mats[0].shape[0]
+    if op == "det-a":
+        if n > 20:
+            return None
+        # every float is a fraction with a power of two below: Bareiss on
+        # the matrix scaled to integers is exact
+        fracs = [Fraction(x) for x in mats[0].ravel().tolist()]
+        scale = math.lcm(*(f.denominator for f in fracs))
+        N = np.empty(n * n, dtype=object)
+        N[:] = [int(f * scale) for f in fracs]
+        reduced, sign = bareiss(N.reshape(n, n))
+        return 0.0 if reduced is None else float(Fraction(sign * reduced[-1, -1], scale ** n))
+    if n > limit:
+        return None
+    ext = [M.astype(np.longdouble) for M in mats]
+    return (ext[0] @ ext[1] if op == "mul" else ext[0] @ ext[0]).astype(np.float64)
+
+
+def as_float(res):
+    """A determinant out of the float64 range, {"sign", "log_abs"}, as the
+    inf or 0 the plain call overflows or underflows to."""
+    if isinstance(res, dict):
+        return res["sign"] * np.inf if res["log_abs"] > 0 else 0.0
+    return res
+
+
+def rel_err(x, ref):
+    x, ref = np.asarray(x, dtype=np.float64), np.asarray(ref, dtype=np.float64)
+    if np.array_equal(x, ref):
+        return 0.0  # also when both overflowed to the same infinity
+    scale = np.max(np.abs(ref)) or 1.0
+    return float(np.max(np.abs(x - ref)) / scale)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--sizes", type=int, nargs="+", default=[12, 200, 1000, 2000])
+    ap.add_argument("--bandwidth", type=int, default=4, help="diagonals above and below in banded operands")
+    ap.add_argument("--kinds", nargs="+",
+                    default=["dense", "diagonal", "triangular", "banded", "symmetric", "integer"])
+    ap.add_argument("--ops", nargs="+", choices=list(PLAIN), default=list(PLAIN))
+    ap.add_argument("--float32", action="store_true", help="run the structured kernels in single precision")
+    ap.add_argument("--exact-limit", type=int, default=500, help="largest n for the extended precision reference")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+    precision = "float32" if args.float32 else "float64"
+
+    print(f"{'n':>6} {'kind':>10} {'op':>6} {'kernel':>16} {'detect ms':>10} {'structured ms':>14} "
+          f"{'plain ms':>9} {'speedup':>8} {'rel err':>9} {'plain err':>9}")
+    for n in args.sizes:
+        rng = np.random.default_rng(0)
+        G = rng.standard_normal((n, n))
+        for kind in args.kinds:
+            M = operands(kind, n, args.bandwidth, rng)
+            for op in args.ops:
+                # the structured operand on the left, a dense one on the right
+                mats = (M, G) if op == "mul" else (M,)
+                p, detect_s = best_of(lambda: plan(op, mats, precision), args.repeat)
+                res, run_s = best_of(lambda: run_structured(p, mats), args.repeat)
+                res = as_float(res)
+                plain, plain_s = best_of(lambda: PLAIN[op](*mats), args.repeat)
+                total = detect_s + run_s
+                ref = reference(op, mats, args.exact_limit)
+                if ref is None:
+                    err, plain_err = f"{rel_err(res, plain):9.1e}", f"{'-':>9}"
+                else:
+                    err, plain_err = f"{rel_err(res, ref):9.1e}", f"{rel_err(plain, ref):9.1e}"
+                print(f"{n:>6} {kind:>10} {op:>6} {p.kernel:>16} {detect_s * 1e3:10.3f} {total * 1e3:14.3f} "
+                      f"{plain_s * 1e3:9.3f} {plain_s / total:7.1f}x {err} {plain_err}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Load test for history writes: the old connect/insert/commit/close per
+calculation against HistoryStore, with several processes writing at once
+the way gunicorn workers do. "store-threads" also splits each worker's
+writes across --threads threads, the way gthread workers serve requests, so
+concurrent inserts share a commit.
+
+Run from the repository root:
+    python benchmarks/load_history.py [--workers 4] [--requests 500] [--threads 8]
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from history_store import HistoryStore  # noqa: E402
+
+SCHEMA = """
+  CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    operation TEXT NOT NULL,
+    matrixA TEXT NOT NULL,
+    matrixB TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+  )
+"""
+
+
+def legacy_save(db, operation, A, B, result):
+    """save_history as it was before HistoryStore."""
+    conn = sqlite3.connect(db, timeout=30)
+    c = conn.cursor()
+    c.execute("INSERT INTO history (operation, matrixA, matrixB, result) VALUES (?,?,?,?)",
+              (operation, json.dumps(A), json.dumps(B), json.dumps(result)))
+    conn.commit()
+    nid = c.lastrowid
+    c.execute("SELECT created_at FROM history WHERE id=?", (nid,))
+    ts = c.fetchone()[0]
+    conn.close()
+    return nid, ts
+
+
+def worker(mode, db, n, threads, start):
+    A = np.random.randint(0, 10, size=(3, 3)).astype(str).tolist()
+    result = np.random.rand(3, 3).tolist()
+    if mode == "legacy":
+        save = lambda: legacy_save(db, "mul", A, A, result)  # noqa: E731
+    else:
+        store = HistoryStore(db)
+        save = lambda: store.insert(("mul", A, A, result))  # noqa: E731
+    if mode != "store-threads":
+        threads = 1
+    loop = lambda count: [save() for _ in range(count)]  # noqa: E731
+    pool = [threading.Thread(target=loop, args=(n // threads + (i < n % threads),)) for i in range(threads)]
+    start.wait()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+
+def run(mode, workers, requests, threads):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "history.db")
+        conn = sqlite3.connect(db)
+        conn.execute(SCHEMA)
+        conn.close()
+        if mode != "legacy":
+            HistoryStore(db).migrate()
+
+        start = mp.Barrier(workers + 1)
+        procs = [mp.Process(target=worker, args=(mode, db, requests, threads, start)) for _ in range(workers)]
+        for p in procs:
+            p.start()
+        start.wait()
+        t0 = time.perf_counter()
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - t0
+
+        conn = sqlite3.connect(db)
+        rows = conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+        conn.close()
+        assert rows == workers * requests, (rows, workers * requests)
+        return rows / elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--requests", type=int, default=500, help="history writes per worker")
+    ap.add_argument("--threads", type=int, default=8, help="threads per worker in store-threads")
+    args = ap.parse_args()
+
+    print(f"{args.workers} workers x {args.requests} writes")
+    for mode in ("legacy", "store", "store-threads"):
+        print(f"{mode:>13}: {run(mode, args.workers, args.requests, args.threads):10.0f} writes/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import re
+import uuid
+
+import numpy as np
+
+# ---------- Stored matrices ----------
+# Operands too large to send as JSON (or to hold in RAM) are uploaded once as
+# .npy files with POST /matrices and then referenced in /calculate as
+#   {"ref": "<id>"}
+# add, sub, mul and transpose on stored matrices read their operands through
+# np.memmap and compute tile by tile, writing the result into another stored
+# .npy file, so only a few tiles are ever resident at once. The tile size
+# follows from a memory budget: a multiply keeps four t x t float64 tiles
+# (two operand tiles, their product and the accumulator), add/sub three row
+# panels, transpose two tiles.
+REF_RE = re.compile(r"[0-9a-f]{32}")
+CHUNK_BYTES = 1 << 20
+MIN_TILE = 64
+
+class UploadTooLarge(ValueError):
+    pass
+
+def is_stored_ref(value):
+    return isinstance(value, dict) and "ref" in value
+
+def tile_size(budget, buffers):
+    return max(int((budget / (buffers * 8)) ** 0.5), MIN_TILE)
+
+def _blocked_add(A, B, out, budget, sign):
+    rows = max(budget // (3 * 8 * A.shape[1]), 1)
+    for i in range(0, A.shape[0], rows):
+        a = np.asarray(A[i:i + rows], dtype=np.float64)
+        b = np.asarray(B[i:i + rows], dtype=np.float64)
+        out[i:i + rows] = a + b if sign > 0 else a - b
+
+def _blocked_matmul(A, B, out, budget):
+    t = tile_size(budget, 4)
+    m, k = A.shape
+    n = B.shape[1]
+    for i in range(0, m, t):
+        for j in range(0, n, t):
+            acc = np.zeros((min(t, m - i), min(t, n - j)))
+            for p in range(0, k, t):
+                a = np.ascontiguousarray(A[i:i + t, p:p + t], dtype=np.float64)
+                b = np.ascontiguousarray(B[p:p + t, j:j + t], dtype=np.float64)
+                acc += a @ b
+            out[i:i + t, j:j + t] = acc
+
+def _blocked_transpose(M, out, budget):
+    t = tile_size(budget, 2)
+    for i in range(0, M.shape[0], t):
+        for j in range(0, M.shape[1], t):
+            out[j:j + t, i:i + t] = np.asarray(M[i:i + t, j:j + t], dtype=np.float64).T
+
+BLOCKED_KERNELS = {
+    "add": (lambda A, B: A.shape, lambda A, B, out, budget: _blocked_add(A, B, out, budget, 1)),
+    "sub": (lambda A, B: A.shape, lambda A, B, out, budget: _blocked_add(A, B, out, budget, -1)),
+    "mul": (lambda A, B: (A.shape[0], B.shape[1]), _blocked_matmul),
+    "ta": (lambda A: A.shape[::-1], _blocked_transpose),
+    "tb": (lambda B: B.shape[::-1], _blocked_transpose),
+}
+
+def result_shape(op, mats):
+    return tuple(BLOCKED_KERNELS[op][0](*mats))
+
+def run_blocked(op, in_paths, out_path, budget):
+    """Computes `op` on the .npy files in_paths into a new .npy file at
+    out_path. Top-level so that it can run in a worker pool process."""
+    mats = [np.load(p, mmap_mode="r") for p in in_paths]
+    part = out_path + ".part"
+    out = np.lib.format.open_memmap(part, mode="w+", dtype=np.float64, shape=result_shape(op, mats))
+    try:
+        BLOCKED_KERNELS[op][1](*mats, out, budget)
+        out.flush()
+    except BaseException:
+        del out
+        os.remove(part)
+        raise
+    del out
+    os.replace(part, out_path)
+
+
+class MatrixFiles:
+    """The directory holding stored matrices, one <ref>.npy file each."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, ref):
+        if not isinstance(ref, str) or not REF_RE.fullmatch(ref):
+            raise ValueError(f"Invalid matrix reference '{ref}'")
+        return os.path.join(self.root, ref + ".npy")
+
+    def new_ref(self):
+        ref = uuid.uuid4().hex
+        return ref, self.path(ref)
+
+    def save(self, stream, max_bytes=None):
+        """Copies an uploaded .npy file from `stream` to disk in chunks and
+        returns (ref, memmap). Only 2-D numeric arrays are accepted, and no
+        more than `max_bytes` bytes are read."""
+        ref, path = self.new_ref()
+        part = path + ".part"
+        size = 0
+        with open(part, "wb") as f:
+            while True:
+                chunk = stream.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    f.close()
+                    os.remove(part)
+                    raise UploadTooLarge(f"A stored matrix can be at most {max_bytes} bytes.")
+                f.write(chunk)
+        try:
+            M = np.lib.format.open_memmap(part, mode="r")
+            if M.ndim != 2 or 0 in M.shape:
+                raise ValueError("A stored matrix must be a non-empty 2-D array.")
+            if M.dtype.kind not in "biuf":
+                raise ValueError(f"Unsupported dtype {M.dtype} in .npy array.")
+        except Exception as e:
+            os.remove(part)
+            raise ValueError(f"Upload is not a valid .npy matrix: {e}")
+        os.replace(part, path)
+        return ref, np.load(path, mmap_mode="r")
+
+    def open(self, ref):
+        path = self.path(ref)
+        if not os.path.exists(path):
+            raise ValueError(f"Unknown matrix reference '{ref}'")
+        return np.load(path, mmap_mode="r")
+
+    def delete(self, ref):
+        try:
+            os.remove(self.path(ref))
+            return True
+        except FileNotFoundError:
+            return False
@@ -0,0 +1,186 @@
+import atexit
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+
+# BLAS reads its thread count once, when NumPy is first imported, so the limit
+# is put in the environment each worker process is spawned with.
+BLAS_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                 "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+_spawn_lock = threading.Lock()
+
+
+class PoolSaturated(Exception):
+    """Raised when every worker is busy and the wait queue is full."""
+
+    def __init__(self, retry_after):
+        super().__init__("Server is busy with other heavy calculations, please retry later")
+        self.retry_after = retry_after
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class WorkerDied(Exception):
+    """Raised when the worker process running a job exits (killed, out of
+    memory). The worker is replaced; the job is not run again."""
+
+    def __init__(self, retry_after):
+        super().__init__("Worker process died while computing, please retry later")
+        self.retry_after = retry_after
+
+
+def run_operation(name, mats, params):
+    from operations import get_operation
+    return get_operation(name)(*mats, **params)
+
+
+def _worker_main(conn):
+    while True:
+        try:
+            fn, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send((True, fn(*args)))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class _Worker:
+    def __init__(self, ctx, blas_threads):
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child,), daemon=True)
+        with _spawn_lock:
+            saved = {var: os.environ.get(var) for var in BLAS_ENV_VARS}
+            os.environ.update({var: str(blas_threads) for var in BLAS_ENV_VARS})
+            try:
+                self.process.start()
+            finally:
+                for var, value in saved.items():
+                    if value is None:
+                        os.environ.pop(var)
+                    else:
+                        os.environ[var] = value
+        child.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ComputePool:
+    """
+    A fixed set of worker processes for operations too expensive to run inside
+    a web worker. Each job runs on one idle process and is killed if it takes
+    longer than `timeout` seconds; the process is then replaced. At most
+    `workers + max_queue` jobs are admitted at once, further ones raise
+    PoolSaturated straight away instead of piling up behind the others.
+    Processes are started on first use with the "spawn" method so that each
+    loads its own BLAS limited to `blas_threads` threads.
+    """
+
+    def __init__(self, workers=2, timeout=60, max_queue=8, blas_threads=1, retry_after=2):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.blas_threads = blas_threads
+        self.retry_after = retry_after
+        self._ctx = mp.get_context("spawn")
+        self._idle = queue.Queue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self.admitted = 0
+        self.in_flight = 0
+        self.completed = self.failed = self.timeouts = self.rejected = 0
+        atexit.register(self.shutdown)
+
+    def _start(self):
+        # a pool created before a fork (gunicorn --preload) starts afresh in the child
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = queue.Queue()
+            self._all = [_Worker(self._ctx, self.blas_threads) for _ in range(self.workers)]
+            for w in self._all:
+                self._idle.put(w)
+
+    def _replace(self, worker):
+        worker.kill()
+        new = _Worker(self._ctx, self.blas_threads)
+        with self._lock:
+            self._all[self._all.index(worker)] = new
+        return new
+
+    def run(self, name, mats, params=None, timeout=None):
+        """Runs the registered operation `name` on `mats` in a worker process
+        and returns its result, waiting at most `timeout` seconds for it."""
+        return self.call(run_operation, name, mats, params or {}, timeout=timeout)
+
+    def call(self, fn, *args, timeout=None):
+        """Runs fn(*args) in a worker process; fn must be a module-level
+        function so that it can be pickled."""
+        timeout = timeout or self.timeout
+        with self._lock:
+            if self.admitted >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise PoolSaturated(self.retry_after)
+            self.admitted += 1
+            self._start()
+        try:
+            deadline = time.monotonic() + timeout
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                with self._lock:
+                    self.timeouts += 1
+                raise JobTimeout(f"Operation did not start within {timeout:g}s")
+            with self._lock:
+                self.in_flight += 1
+            try:
+                worker.conn.send((fn, args))
+                if not worker.conn.poll(max(deadline - time.monotonic(), 0)):
+                    worker = self._replace(worker)
+                    with self._lock:
+                        self.timeouts += 1
+                    raise JobTimeout(f"Operation timed out after {timeout:g}s")
+                ok, value = worker.conn.recv()
+            except (EOFError, OSError, BrokenPipeError):
+                worker = self._replace(worker)
+                with self._lock:
+                    self.failed += 1
+                raise WorkerDied(self.retry_after)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                self._idle.put(worker)
+            with self._lock:
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            if not ok:
+                raise value
+            return value
+        finally:
+            with self._lock:
+                self.admitted -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "in_flight": self.in_flight,
+                    "queued": self.admitted - self.in_flight, "max_queue": self.max_queue,
+                    "completed": self.completed, "failed": self.failed,
+                    "timeouts": self.timeouts, "rejected": self.rejected}
+
+    def shutdown(self):
+        if self._pid != os.getpid():
+            return
+        for w in self._all:
+            w.kill()
+        self._all = []
+        self._pid = None
@@ -0,0 +1,316 @@
+import fcntl
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+from blocked_ops import REF_RE
+
+# ---------- Delta sessions ----------
+# A session holds A, B and the results of some operations on them, and takes
+# changed cells instead of whole matrices. Each result is updated from the
+# change rather than recomputed:
+#   add/sub  only the changed cells
+#   mul      C[i, :] = A[i, :] @ B for each changed row of A and
+#            C[:, j] = A @ B[:, j] for each changed column of B, O(n^2) each
+#   det/inv  each changed row (or column) of M is a rank-1 update u v^T. With
+#            M^-1 at hand, the matrix determinant lemma
+#              det(M + u v^T) = (1 + v^T M^-1 u) det(M)
+#            and Sherman-Morrison
+#              (M + u v^T)^-1 = M^-1 - M^-1 u v^T M^-1 / (1 + v^T M^-1 u)
+#            cost O(n^2) per update instead of O(n^3)
+# The determinant is kept as (sign, log|det|) so that it cannot overflow.
+# Rank-1 updates accumulate rounding error, so after every change the new
+# inverse is probed with a random x: if ||M (M^-1 x) - x|| / ||x|| is above
+# the tolerance, the inverse and determinant are recomputed from scratch.
+# They are also recomputed when an update is (nearly) singular and when so
+# many rows changed that starting over is cheaper.
+#
+# Every array is a .npy file in the session's directory and is opened as a
+# memmap, so all gunicorn workers share the session. A flock on the
+# directory's lock file serializes changes against reads.
+DELTA_OPS = {"add": "AB", "sub": "AB", "mul": "AB", "det-a": "A", "det-b": "B", "inv-a": "A", "inv-b": "B"}
+SINGULAR_FACTOR = 1e-12  # |1 + v^T M^-1 u| below this makes the update singular
+MAX_RANK1_FRACTION = 0.125  # more rank-1 updates than n/8 and a full recompute is cheaper
+
+def inverse_side(op):
+    """"A" or "B" for det and inv, whose results come from that inverse."""
+    return DELTA_OPS[op] if op[:3] in ("det", "inv") else None
+
+def _save(path, M):
+    with open(path + ".part", "wb") as f:
+        np.save(f, M)
+    os.replace(path + ".part", path)
+
+def det_value(sign, log_abs):
+    if not sign:
+        return {"value": 0.0, "sign": 0, "log_abs": None}
+    value = sign * np.exp(log_abs) if log_abs < 709 else None  # beyond the float64 range
+    return {"value": value, "sign": int(sign), "log_abs": log_abs}
+
+def recompute(directory, names):
+    """Computes the results `names` of the session in `directory` from
+    scratch: "add", "sub", "mul", or a side "A" / "B" for its inverse and
+    log-determinant. Returns the log-determinants, {side: [sign, log|det|]}.
+    Top-level so that it can run in a worker pool process."""
+    mats = {side: np.load(os.path.join(directory, f"{side}.npy"), mmap_mode="r") for side in "AB"}
+    kernels = {"add": np.add, "sub": np.subtract, "mul": np.matmul}
+    logdet = {}
+    for name in names:
+        if name in kernels:
+            _save(os.path.join(directory, f"{name}.npy"), kernels[name](mats["A"], mats["B"]))
+            continue
+        M = np.asarray(mats[name])
+        path = os.path.join(directory, f"inv-{name}.npy")
+        sign, log_abs = np.linalg.slogdet(M)
+        try:
+            if not sign:
+                raise np.linalg.LinAlgError
+            _save(path, np.linalg.inv(M))
+            logdet[name] = [float(sign), float(log_abs)]
+        except np.linalg.LinAlgError:
+            if os.path.exists(path):
+                os.remove(path)
+            logdet[name] = [0.0, None]
+    return logdet
+
+
+class DeltaSession:
+    """One session, opened under its lock by DeltaSessions.open()."""
+
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.meta = meta
+
+    def array(self, name, mode="r"):
+        return np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode=mode)
+
+    def has_inverse(self, side):
+        return os.path.exists(os.path.join(self.directory, f"inv-{side}.npy"))
+
+    def save_meta(self):
+        path = os.path.join(self.directory, "meta.json")
+        with open(path + ".part", "w") as f:
+            json.dump(self.meta, f)
+        os.replace(path + ".part", path)
+
+    def results_needed(self):
+        """The names recompute() takes to build every result of this session."""
+        names = [op for op in self.meta["operations"] if op in ("add", "sub", "mul")]
+        return names + sorted({inverse_side(op) for op in self.meta["operations"] if inverse_side(op)})
+
+    def apply(self, changes, tolerance, rng):
+        """
+        Writes `changes`, {"A" or "B": (rows, cols, values)} with each cell
+        listed once, into the operands and updates the results from them.
+        Returns (report, stale): what changed in each result, and the names
+        that need recompute() because they could not be updated.
+        """
+        for side, (rows, cols, _) in changes.items():
+            shape = self.meta["shapes"][side]
+            if rows.size and (min(rows.min(), cols.min()) < 0 or rows.max() >= shape[0] or cols.max() >= shape[1]):
+                raise ValueError(f"Cell out of range for matrix {side} of shape {shape[0]}x{shape[1]}")
+        # a session interrupted between here and the end is rebuilt on next use
+        self.meta["dirty"] = True
+        self.save_meta()
+        deltas = {}
+        for side, (rows, cols, values) in changes.items():
+            M = self.array(side, "r+")
+            deltas[side] = (rows, cols, values - M[rows, cols])
+            M[rows, cols] = values
+            M.flush()
+
+        report, stale = {}, []
+        A, B = self.array("A"), self.array("B")
+        cells = [np.stack([rows, cols]) for rows, cols, _ in deltas.values()]
+        cells = np.unique(np.hstack(cells), axis=1) if cells else np.empty((2, 0), dtype=np.int64)
+        for op in self.meta["operations"]:
+            if op in ("add", "sub"):
+                C = self.array(op, "r+")
+                r, c = cells
+                C[r, c] = A[r, c] + B[r, c] if op == "add" else A[r, c] - B[r, c]
+                C.flush()
+                report[op] = {"update": "incremental",
+                              "cells": [[i, j, v] for i, j, v in zip(r.tolist(), c.tolist(), C[r, c].tolist())]}
+            elif op == "mul":
+                report[op] = self._update_product(deltas, A, B)
+                if report[op] is None:
+                    stale.append(op)
+
+        for side in sorted({inverse_side(op) for op in self.meta["operations"] if inverse_side(op)}):
+            if side not in deltas:
+                continue
+            drift = self._update_inverse(side, deltas[side], tolerance, rng)
+            if drift is None:
+                stale.append(side)
+                continue
+            for op in self.meta["operations"]:
+                if inverse_side(op) == side:
+                    report[op] = {"update": "incremental", "drift": drift}
+        return report, stale
+
+    def _update_product(self, deltas, A, B):
+        rows = np.unique(deltas["A"][0]) if "A" in deltas else np.empty(0, dtype=np.int64)
+        cols = np.unique(deltas["B"][1]) if "B" in deltas else np.empty(0, dtype=np.int64)
+        if len(rows) / A.shape[0] + len(cols) / B.shape[1] > 0.5:
+            return None
+        C = self.array("mul", "r+")
+        if len(rows):
+            C[rows] = np.asarray(A[rows]) @ B
+        if len(cols):
+            C[:, cols] = A @ np.asarray(B[:, cols])
+        C.flush()
+        return {"update": "incremental",
+                "rows": [[i, C[i].tolist()] for i in rows.tolist()],
+                "cols": [[j, C[:, j].tolist()] for j in cols.tolist()]}
+
+    def _update_inverse(self, side, delta, tolerance, rng):
+        """Sherman-Morrison and determinant lemma updates for the changed
+        rows (or columns, when fewer) of `side`. Returns the drift of the
+        new inverse, or None when it must be recomputed instead."""
+        if not self.has_inverse(side):
+            return None
+        rows, cols, d = delta
+        n = self.meta["shapes"][side][0]
+        R, ridx = np.unique(rows, return_inverse=True)
+        K, kidx = np.unique(cols, return_inverse=True)
+        if min(len(R), len(K)) > max(n * MAX_RANK1_FRACTION, 1):
+            return None
+        inv = self.array(f"inv-{side}", "r+")
+        X = np.array(inv)
+        sign, log_abs = self.meta["logdet"][side]
+        if len(R) <= len(K):
+            # M + e_i v^T for each changed row i, v the change in that row
+            V = np.zeros((len(R), n))
+            np.add.at(V, (ridx, cols), d)
+            updates = [(i, v, None) for i, v in zip(R.tolist(), V)]
+        else:
+            # M + u e_j^T for each changed column j
+            U = np.zeros((n, len(K)))
+            np.add.at(U, (rows, kidx), d)
+            updates = [(j, None, u) for j, u in zip(K.tolist(), U.T)]
+        for k, v, u in updates:
+            if u is None:
+                w = v @ X
+                f = 1 + w[k]
+                if abs(f) < SINGULAR_FACTOR:
+                    return None
+                X -= np.outer(X[:, k], w / f)
+            else:
+                z = X @ u
+                f = 1 + z[k]
+                if abs(f) < SINGULAR_FACTOR:
+                    return None
+                X -= np.outer(z / f, X[k])
+            sign *= np.sign(f)
+            log_abs += np.log(abs(f))
+
+        x = rng.standard_normal(n)
+        drift = float(np.linalg.norm(self.array(side) @ (X @ x) - x) / np.linalg.norm(x))
+        if not drift <= tolerance:
+            return None
+        inv[:] = X
+        inv.flush()
+        self.meta["logdet"][side] = [float(sign), float(log_abs)]
+        return drift
+
+    def result(self, op):
+        """The current result of `op`: an array, or a dict for det."""
+        side = inverse_side(op)
+        if side is None:
+            return self.array(op)
+        if op.startswith("det"):
+            return det_value(*self.meta["logdet"][side])
+        if not self.has_inverse(side):
+            raise ValueError("Singular matrix")
+        return self.array(f"inv-{side}")
+
+    def describe(self, report=None, stale=()):
+        """The response to a change: per result, what changed in it, or
+        "recomputed" when the client should fetch it again."""
+        out = {}
+        for op in self.meta["operations"]:
+            side = inverse_side(op)
+            entry = (report or {}).get(op) or {"update": "recomputed" if (side or op) in stale else "unchanged"}
+            if side and op.startswith("det"):
+                entry = dict(entry, **self.result(op))
+            elif side and not self.has_inverse(side):
+                entry = dict(entry, error="Singular matrix")
+            out[op] = entry
+        return {"id": os.path.basename(self.directory), "version": self.meta["version"], "results": out}
+
+
+class DeltaSessions:
+    """The directory holding delta sessions, one subdirectory each. Sessions
+    unused for `ttl` seconds are deleted when a new one is created."""
+
+    def __init__(self, root, ttl=3600):
+        self.root = root
+        self.ttl = ttl
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, sid):
+        if not isinstance(sid, str) or not REF_RE.fullmatch(sid):
+            raise KeyError(sid)
+        return os.path.join(self.root, sid)
+
+    def create(self, A, B, operations):
+        """Stores the operands of a new session and returns its id; the
+        results are built with recompute() by the caller."""
+        self.expire()
+        sid = uuid.uuid4().hex
+        part = os.path.join(self.root, sid + ".part")
+        os.makedirs(part)
+        mats = {"A": A, "B": B}
+        for side in "AB":
+            _save(os.path.join(part, f"{side}.npy"), np.asarray(mats[side], dtype=np.float64))
+        session = DeltaSession(part, {"operations": list(operations), "version": 0, "dirty": True,
+                                      "shapes": {side: list(np.shape(mats[side])) for side in "AB"},
+                                      "logdet": {}, "created": time.time()})
+        session.save_meta()
+        os.replace(part, self.path(sid))
+        return sid
+
+    @contextmanager
+    def open(self, sid, exclusive=False):
+        """Yields the session `sid` under a shared (or exclusive) lock;
+        raises KeyError if it does not exist."""
+        path = self.path(sid)
+        try:
+            lock = open(os.path.join(path, "meta.json.lock"), "a")
+        except FileNotFoundError:
+            raise KeyError(sid)
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                with open(os.path.join(path, "meta.json")) as f:
+                    meta = json.load(f)
+            except FileNotFoundError:
+                raise KeyError(sid)  # deleted while waiting for the lock
+            os.utime(path)
+            yield DeltaSession(path, meta)
+
+    def delete(self, sid):
+        try:
+            with self.open(sid, exclusive=True) as session:
+                shutil.rmtree(session.directory)
+            return True
+        except KeyError:
+            return False
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    if name.endswith(".part"):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        self.delete(name)
+            except (FileNotFoundError, KeyError):
+                pass
@@ -0,0 +1,167 @@
+import itertools
+import math
+from fractions import Fraction
+
+import numpy as np
+
+# ---------- Exact rational arithmetic ----------
+# With "exact": true, add, sub, mul, det and inverse are computed on rationals
+# and return fractions as strings ("6", "-3/4"). A matrix M is held as an
+# integer matrix N and one common denominator d, M = N / d, so the kernels
+# only ever work on integers:
+#   add/sub  rescale both to lcm(dA, dB) and add the numerators
+#   mul      (NA @ NB) / (dA * dB)
+#   det      det(N) / d**n, with det(N) from fraction-free Bareiss elimination
+#   inverse  d * adj(N) / det(N): Bareiss on [N | I], then back substitution
+# Bareiss divides exactly by the previous pivot at every step, so entries stay
+# integers bounded by minors of N. Integer matrices are int64 NumPy arrays as
+# long as no product can overflow and switch to object arrays of Python ints
+# (arbitrary precision) from the step where one could.
+INT64_SAFE = 2**31  # |a|, |b|, |c|, |d| below this keep a*b - c*d within int64
+
+def _cell_fraction(cell):
+    if isinstance(cell, float):
+        # the decimal the client wrote, not the binary expansion of the float
+        return Fraction(repr(cell))
+    return Fraction(str(cell).strip())
+
+def _int_array(values, shape):
+    try:
+        return np.array(values, dtype=np.int64).reshape(shape)
+    except OverflowError:
+        arr = np.empty(len(values), dtype=object)
+        arr[:] = values
+        return arr.reshape(shape)
+
+def integer_matrix(name, M):
+    """Parses a list-of-rows matrix (or ndarray) into (N, d), an integer matrix
+    and a positive common denominator with M = N / d."""
+    if isinstance(M, np.ndarray):
+        shape, cells = M.shape, M.ravel().tolist()
+    else:
+        shape, cells = (len(M), len(M[0])), list(itertools.chain.from_iterable(M))
+    try:
+        fracs = [_cell_fraction(cell) for cell in cells]
+    except (ValueError, TypeError, OverflowError, ZeroDivisionError):
+        raise ValueError(f"Exact mode needs finite numbers or fractions in matrix {name}.")
+    d = math.lcm(*(f.denominator for f in fracs))
+    return _int_array([f.numerator * (d // f.denominator) for f in fracs], shape), d
+
+def _widen(M, bound=INT64_SAFE):
+    """M as it is if all its entries are below `bound` in magnitude, otherwise
+    as an object array of Python ints."""
+    if M.dtype == object or (M.size and np.abs(M).max() >= bound):
+        return M.astype(object)
+    return M
+
+def _scaled(N, factor):
+    if N.dtype != object and factor < INT64_SAFE:
+        N = _widen(N, 2**62 // factor)
+    else:
+        N = N.astype(object)
+    return N * factor
+
+def fraction_strings(num, den):
+    """The fractions num / den (num an integer array or scalar, den a non-zero
+    int) in lowest terms, as strings."""
+    num = np.asarray(num)
+    if den < 0:
+        num, den = -num, -den
+    if num.dtype == np.int64 and den < 2**63:
+        g = np.gcd(num, np.int64(den))
+    else:
+        num = num.astype(object)
+        g = np.frompyfunc(math.gcd, 2, 1)(num, den)
+    p, q = num // g, den // g
+    out = [str(a) if b == 1 else f"{a}/{b}"
+           for a, b in zip(np.ravel(p).tolist(), np.ravel(np.broadcast_to(q, np.shape(p))).tolist())]
+    if num.ndim == 0:
+        return out[0]
+    return np.array(out, dtype=object).reshape(num.shape).tolist()
+
+def bareiss(M):
+    """
+    Fraction-free forward elimination on the integer matrix M (n x m,
+    m >= n), on a copy. The leading n x n block becomes upper triangular
+    with sign * det in its last pivot. Returns (M, sign), or (None, 0) if
+    that block is singular.
+    """
+    n = M.shape[0]
+    M = M.copy()
+    prev, sign = 1, 1
+    for k in range(n):
+        if M[k, k] == 0:
+            nz = np.flatnonzero(M[k + 1:, k] != 0)
+            if not len(nz):
+                return None, 0
+            p = k + 1 + int(nz[0])
+            M[[k, p]] = M[[p, k]]
+            sign = -sign
+        if M.dtype != object and np.abs(M[k:, k:]).max() >= INT64_SAFE:
+            M = M.astype(object)
+        pivot = M[k, k]
+        M[k + 1:, k:] = (M[k + 1:, k:] * pivot - M[k + 1:, k:k + 1] * M[k, k:]) // prev
+        prev = pivot
+    return M, sign
+
+# ---------- Kernels ----------
+# Each takes (N, d) pairs and returns JSON-ready fraction strings.
+def exact_add(A, B, sign=1):
+    (NA, dA), (NB, dB) = A, B
+    L = math.lcm(dA, dB)
+    SA, SB = _scaled(NA, L // dA), _scaled(NB, L // dB)
+    if SA.dtype == object or SB.dtype == object:
+        SA, SB = SA.astype(object), SB.astype(object)
+    return fraction_strings(SA + SB if sign > 0 else SA - SB, L)
+
+def exact_mul(A, B):
+    (NA, dA), (NB, dB) = A, B
+    if NA.dtype == object or NB.dtype == object:
+        NA, NB = NA.astype(object), NB.astype(object)
+    elif NA.size and NB.size:
+        bound = int(np.abs(NA).max()) * int(np.abs(NB).max()) * NA.shape[1]
+        if bound >= 2**63:
+            NA, NB = NA.astype(object), NB.astype(object)
+    return fraction_strings(NA @ NB, dA * dB)
+
+def exact_det(A):
+    N, d = A
+    n = N.shape[0]
+    M, sign = bareiss(N)
+    if M is None:
+        return "0"
+    return fraction_strings(sign * M[n - 1, n - 1], d ** n)
+
+def exact_inv(A):
+    N, d = A
+    n = N.shape[0]
+    eye = np.eye(n, dtype=np.int64).astype(N.dtype)
+    M, _ = bareiss(np.hstack([N, eye]))
+    if M is None:
+        raise ValueError("Singular matrix")
+    # [U | Y] with U^-1 Y = N^-1. X = D * N^-1 (D the last pivot) is an
+    # integer matrix, so each row of U X = D Y divides out exactly.
+    U, Y = M[:, :n].astype(object), M[:, n:].astype(object)
+    D = U[n - 1, n - 1]
+    X = np.empty((n, n), dtype=object)
+    for i in range(n - 1, -1, -1):
+        rhs = D * Y[i]
+        if i < n - 1:
+            rhs -= U[i, i + 1:] @ X[i + 1:]
+        X[i] = rhs // U[i, i]
+    return fraction_strings(X * d if d != 1 else X, int(D))
+
+EXACT_KERNELS = {
+    "add": exact_add,
+    "sub": lambda A, B: exact_add(A, B, -1),
+    "mul": exact_mul,
+    "det-a": exact_det,
+    "det-b": exact_det,
+    "inv-a": exact_inv,
+    "inv-b": exact_inv,
+}
+
+def run_exact(op, mats):
+    """Runs an exact kernel on (N, d) pairs. Top-level so that it can run in a
+    worker pool process."""
+    return EXACT_KERNELS[op](*mats)
@@ -0,0 +1,351 @@
+import atexit
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+INSERT_SQL = ("INSERT INTO history (operation, matrixA, matrixB, result, created_at) "
+              "VALUES (?,?,?,?,?)")
+
+# ---------- Blobs ----------
+# The matrixA, matrixB and result columns of history hold the hash of a row
+# in the blobs table, which stores each distinct value once, zlib-compressed,
+# with a count of the history cells pointing at it. Lists that are
+# rectangular and of a single scalar type (floats, ints, strings, bools) are
+# stored as the raw bytes of an array plus its dtype and shape; anything else
+# (decompositions, sparse payloads, scalars) as JSON text. Both decode back to
+# exactly the JSON the value was saved as. Databases written before blobs are
+# converted once, by migrate().
+BLOB_SCHEMA_VERSION = 1
+BLOB_COMPRESSION = 6
+BLOBS_SCHEMA = """
+  CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    codec TEXT NOT NULL,
+    dtype TEXT,
+    shape TEXT,
+    data BLOB NOT NULL,
+    refs INTEGER NOT NULL
+  )
+"""
+_SCALAR_DTYPES = {float: np.float64, int: np.int64, bool: np.bool_, str: np.str_}
+_KIND_DTYPES = {"f": np.float64, "i": np.int64, "b": np.bool_, "U": np.str_}
+
+
+def _as_array(value):
+    """The value as an ndarray if it round-trips through one unchanged, else None."""
+    if isinstance(value, np.ndarray):
+        # stored like the list it stands for, so that both share a blob
+        dtype = _KIND_DTYPES.get(value.dtype.kind)
+        return value.astype(dtype, copy=False) if dtype and value.ndim in (1, 2) and value.size else None
+    if not isinstance(value, list) or not value:
+        return None
+    nested = isinstance(value[0], list)
+    if nested and not all(isinstance(row, list) for row in value):
+        return None
+    flat = list(itertools.chain.from_iterable(value)) if nested else value
+    types = set(map(type, flat))
+    if len(types) != 1:
+        return None
+    kind = types.pop()
+    if kind not in _SCALAR_DTYPES or (kind is str and "\0" in "".join(flat)):
+        return None
+    try:
+        arr = np.array(value, dtype=_SCALAR_DTYPES[kind])
+    except (ValueError, TypeError, OverflowError):
+        return None
+    return arr if arr.ndim == (2 if nested else 1) else None
+
+
+def encode_blob(value):
+    """Returns (hash, codec, dtype, shape, raw bytes) for a history value
+    (JSON-serializable, or an ndarray standing for its tolist())."""
+    arr = _as_array(value)
+    if arr is None and isinstance(value, np.ndarray):
+        value = value.tolist()
+    if arr is None:
+        codec, dtype, shape, raw = "json", None, None, json.dumps(value).encode()
+    else:
+        codec, dtype, shape, raw = "array", arr.dtype.str, json.dumps(arr.shape), arr.tobytes()
+    h = hashlib.blake2b(f"{codec}:{dtype}:{shape}:".encode(), digest_size=16)
+    h.update(raw)
+    return h.hexdigest(), codec, dtype, shape, raw
+
+
+def decode_blob(codec, dtype, shape, data):
+    """A stored blob as an ndarray ("array" codec) or as the JSON value."""
+    raw = zlib.decompress(data)
+    if codec == "json":
+        return json.loads(raw)
+    return np.frombuffer(raw, dtype=np.dtype(dtype)).reshape(json.loads(shape))
+
+
+def decode_blob_json(codec, dtype, shape, data):
+    """The JSON text of a stored blob."""
+    raw = zlib.decompress(data)
+    if codec == "json":
+        return raw.decode()
+    return json.dumps(np.frombuffer(raw, dtype=np.dtype(dtype)).reshape(json.loads(shape)).tolist())
+
+
+def utc_timestamp(offset=0):
+    """Current time, moved by `offset` seconds, in the format SQLite's
+    CURRENT_TIMESTAMP uses."""
+    return (datetime.now(timezone.utc) + timedelta(seconds=offset)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class HistoryStore:
+    """
+    SQLite access for the history table.
+
+    Every thread keeps one open connection for reads (sqlite3 caches the
+    prepared statements per connection), the database runs in WAL mode so
+    readers never wait for the writer, and inserts go through a single
+    writer connection per process that commits in groups. Rows are queued
+    in memory; the first thread to find no commit in progress writes
+    everything queued (up to `flush_rows` rows per transaction) while the
+    threads that queue rows meanwhile wait for it. So a lone insert is
+    committed at once, concurrent inserts share a transaction, and the
+    write lock of the database is only held while a group is written,
+    never while rows are waiting. Inserts return once their rows are
+    committed, with their ids.
+
+    Matrices are kept in the deduplicated blobs table (see above); the JSON
+    text of recently read blobs is cached up to `blob_cache_bytes`, which
+    never goes stale since a hash always names the same content.
+    """
+
+    def __init__(self, path, flush_rows=64, timeout=30, blob_cache_bytes=32 * 2**20):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.timeout = timeout
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._writer = None
+        self._writer_pid = None
+        self._queue = deque()
+        self._queued = threading.Condition()
+        self._flushing = False
+        self.blob_cache_bytes = blob_cache_bytes
+        self._blob_cache = OrderedDict()
+        self._blob_cache_size = 0
+        self._blob_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def connect(self):
+        """Opens a new connection configured like the pooled ones."""
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def connection(self):
+        """Returns the calling thread's connection, opening it on first use."""
+        # connections must not cross a fork (gunicorn --preload)
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.conn = self.connect()
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _writer_conn(self):
+        if self._writer_pid != os.getpid():
+            self._writer = self.connect()
+            self._writer_pid = os.getpid()
+        return self._writer
+
+    @contextmanager
+    def transaction(self):
+        """Runs a block of writes on the writer connection in one transaction
+        of its own, committed at the end or rolled back on error."""
+        with self._write_lock:
+            conn = self._writer_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def migrate(self):
+        """Creates the blobs table and moves history rows that still hold JSON
+        text into it. Safe to run from several processes at once."""
+        with self.transaction() as conn:
+            conn.execute(BLOBS_SCHEMA)
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= BLOB_SCHEMA_VERSION:
+                return
+            last = 0
+            while True:
+                rows = conn.execute("SELECT id, matrixA, matrixB, result FROM history WHERE id > ? "
+                                    "ORDER BY id LIMIT 500", (last,)).fetchall()
+                if not rows:
+                    break
+                conn.executemany("UPDATE history SET matrixA=?, matrixB=?, result=? WHERE id=?",
+                                 [tuple(self._put_blob(conn, json.loads(v)) for v in row[1:]) + (row[0],)
+                                  for row in rows])
+                last = rows[-1][0]
+            conn.execute(f"PRAGMA user_version = {BLOB_SCHEMA_VERSION}")
+
+    def _put_blob(self, conn, value):
+        key, codec, dtype, shape, raw = encode_blob(value)
+        # an existing blob only gains a reference, new content is compressed once
+        if not conn.execute("UPDATE blobs SET refs = refs + 1 WHERE hash=?", (key,)).rowcount:
+            conn.execute("INSERT INTO blobs (hash, codec, dtype, shape, data, refs) VALUES (?,?,?,?,?,1)",
+                         (key, codec, dtype, shape, zlib.compress(raw, BLOB_COMPRESSION)))
+        return key
+
+    def blob_json(self, key, conn=None):
+        """The JSON text stored under `key`."""
+        with self._blob_lock:
+            text = self._blob_cache.get(key)
+            if text is not None:
+                self._blob_cache.move_to_end(key)
+                return text
+        row = (conn or self.connection()).execute(
+            "SELECT codec, dtype, shape, data FROM blobs WHERE hash=?", (key,)).fetchone()
+        text = decode_blob_json(*row) if row else "null"
+        if len(text) <= self.blob_cache_bytes:
+            with self._blob_lock:
+                if key not in self._blob_cache:
+                    self._blob_cache[key] = text
+                    self._blob_cache_size += len(text)
+                while self._blob_cache_size > self.blob_cache_bytes:
+                    self._blob_cache_size -= len(self._blob_cache.popitem(last=False)[1])
+        return text
+
+    def blob_value(self, key, conn=None):
+        """The value stored under `key`, decoded with decode_blob()."""
+        row = (conn or self.connection()).execute(
+            "SELECT codec, dtype, shape, data FROM blobs WHERE hash=?", (key,)).fetchone()
+        return decode_blob(*row) if row else None
+
+    def import_rows(self, rows, batch=500):
+        """
+        Inserts (operation, A, B, result, created_at) rows, all in one
+        transaction, with one executemany per `batch` rows. Ids are not
+        taken from the rows: each gets the next one from the table's own
+        sequence, so imported entries never collide with existing ones (or
+        reuse the ids of deleted ones). Returns (count, first id, last id).
+        """
+        count, rows = 0, iter(rows)
+        with self.transaction() as conn:
+            for chunk in iter(lambda: list(itertools.islice(rows, batch)), []):
+                blobs, entries = {}, []
+                for op, *values, ts in chunk:
+                    keys = []
+                    for value in values:
+                        key, *blob = encode_blob(value)
+                        if key in blobs:
+                            blobs[key][-1] += 1
+                        else:
+                            blobs[key] = [*blob, 1]
+                        keys.append(key)
+                    entries.append((op, *keys, ts))
+                existing = {k for k, in conn.execute(
+                    f"SELECT hash FROM blobs WHERE hash IN ({','.join('?' * len(blobs))})", list(blobs))}
+                conn.executemany("UPDATE blobs SET refs = refs + ? WHERE hash=?",
+                                 [(blobs[k][-1], k) for k in existing])
+                conn.executemany("INSERT INTO blobs (hash, codec, dtype, shape, data, refs) VALUES (?,?,?,?,?,?)",
+                                 [(k, codec, dtype, shape, zlib.compress(raw, BLOB_COMPRESSION), n)
+                                  for k, (codec, dtype, shape, raw, n) in blobs.items() if k not in existing])
+                conn.executemany(INSERT_SQL, entries)
+                count += len(entries)
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='history'").fetchone()
+        # AUTOINCREMENT ids of one write transaction are consecutive
+        last = row[0] if row and count else None
+        return count, (last - count + 1 if last else None), last
+
+    def delete(self, where="", params=()):
+        """Deletes the history rows matching `where` (all of them by default)
+        and drops the blobs no other row refers to. Returns the row count."""
+        with self.transaction() as conn:
+            if not where:
+                conn.execute("DELETE FROM blobs")
+                return conn.execute("DELETE FROM history").rowcount
+            refs = Counter(itertools.chain.from_iterable(
+                conn.execute(f"SELECT matrixA, matrixB, result FROM history {where}", params)))
+            count = conn.execute(f"DELETE FROM history {where}", params).rowcount
+            conn.executemany("UPDATE blobs SET refs = refs - ? WHERE hash=?", [(n, k) for k, n in refs.items()])
+            conn.executemany("DELETE FROM blobs WHERE hash=? AND refs <= 0", [(k,) for k in refs])
+            return count
+
+    def insert_many(self, rows):
+        """
+        Inserts (operation, A, B, result) rows, with A, B and result as
+        JSON-serializable values, and returns (id, created_at) for each of
+        them once they are committed.
+        """
+        entry = {"rows": list(rows), "ts": utc_timestamp()}
+        with self._queued:
+            self._queue.append(entry)
+            while self._flushing and "ids" not in entry and "error" not in entry:
+                self._queued.wait()
+            lead = "ids" not in entry and "error" not in entry
+            if lead:
+                self._flushing = True
+        if lead:
+            try:
+                self._write_queued()
+            finally:
+                with self._queued:
+                    self._flushing = False
+                    self._queued.notify_all()
+        if "error" in entry:
+            raise entry["error"]
+        return [(nid, entry["ts"]) for nid in entry["ids"]]
+
+    def _write_queued(self):
+        """Commits the queued rows, `flush_rows` at a time, until none are left."""
+        while True:
+            with self._queued:
+                batch, count = [], 0
+                while self._queue and count < self.flush_rows:
+                    batch.append(self._queue.popleft())
+                    count += len(batch[-1]["rows"])
+            if not batch:
+                return
+            done = []
+            try:
+                with self.transaction() as conn:
+                    for entry in batch:
+                        # a bad row only fails the insert_many call it came with
+                        conn.execute("SAVEPOINT entry")
+                        try:
+                            ids = [conn.execute(INSERT_SQL, (op, *(self._put_blob(conn, v) for v in values),
+                                                             entry["ts"])).lastrowid
+                                   for op, *values in entry["rows"]]
+                        except Exception as e:
+                            conn.execute("ROLLBACK TO entry")
+                            done.append((entry, "error", e))
+                        else:
+                            done.append((entry, "ids", ids))
+                        conn.execute("RELEASE entry")
+            except Exception as e:
+                done = [(entry, "error", e) for entry in batch]
+            with self._queued:
+                for entry, key, value in done:
+                    entry[key] = value
+                self._queued.notify_all()
+
+    def insert(self, row):
+        return self.insert_many([row])[0]
+
+    def write(self, sql, params=()):
+        """Runs a single write statement (DELETE, UPDATE, DDL) and commits it."""
+        with self.transaction() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def flush(self):
+        """Waits until the rows queued by other threads are committed."""
+        with self._queued:
+            while self._flushing or self._queue:
+                self._queued.wait()
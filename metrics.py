@@ -0,0 +1,371 @@
+import atexit
+import fcntl
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# ---------- Metrics ----------
+# Counters, gauges and histograms kept in memory per process. Every process
+# (gunicorn worker) writes a snapshot of its own values to
+# <dir>/<pid>-<start>.json at most every `flush_seconds`, the start time
+# telling apart processes that got the same pid, and whichever worker
+# answers /metrics sums the snapshots of all of them. The snapshot of a
+# worker that has exited (its pid is gone, or taken by a newer snapshot) has
+# its counters and histograms added to <dir>/retired.json and is removed, so
+# counters never go backwards and the directory does not grow with every
+# restart; gauges are only reported for live processes. Empty the directory
+# when deploying to start from zero.
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(v):
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class Metrics:
+    def __init__(self, directory=None, flush_seconds=5):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._kinds = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._reset()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._started = time.time_ns()
+        self._values = {}
+        self._last_flush = 0.0
+
+    # declarations: name -> (type, help, buckets)
+    def counter(self, name, help):
+        self._kinds[name] = ("counter", help, None)
+
+    def gauge(self, name, help):
+        self._kinds[name] = ("gauge", help, None)
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS):
+        self._kinds[name] = ("histogram", help, tuple(buckets))
+
+    def _check_pid(self):
+        # values recorded before a fork (gunicorn --preload) belong to the parent
+        if self._pid != os.getpid():
+            self._reset()
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._check_pid()
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self._check_pid()
+            self._values[(name, _labels(labels))] = value
+
+    def observe(self, name, value, labels=None):
+        buckets = self._kinds[name][2]
+        key = (name, _labels(labels))
+        with self._lock:
+            self._check_pid()
+            h = self._values.get(key)
+            if h is None:
+                # per-bucket counts (not cumulative), then sum and count
+                h = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    h[i] += 1
+                    break
+            h[-2] += value
+            h[-1] += 1
+
+    # ---------- Request timings ----------
+    def begin_request(self):
+        """Starts collecting stage timings for Server-Timing on this thread."""
+        self._local.timings = Counter()
+
+    def end_request(self):
+        timings, self._local.timings = getattr(self._local, "timings", None), None
+        return timings or Counter()
+
+    @contextmanager
+    def stage(self, name, histogram="matrix_stage_duration_seconds"):
+        """Times the block into the per-stage histogram and, during a request,
+        into its Server-Timing entries."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.observe(histogram, elapsed, {"stage": name})
+            timings = getattr(self._local, "timings", None)
+            if timings is not None:
+                timings[name] += elapsed
+
+    # ---------- Aggregation ----------
+    def snapshot(self):
+        with self._lock:
+            self._check_pid()
+            return [[name, list(labels), value] for (name, labels), value in self._values.items()]
+
+    def flush(self):
+        if not self.directory or self._pid != os.getpid():
+            return
+        self._write(os.path.join(self.directory, f"{self._pid}-{self._started}.json"), self.snapshot())
+        self._last_flush = time.monotonic()
+
+    @staticmethod
+    def _write(path, entries):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _add(merged, name, labels, value):
+        key = (name, tuple(map(tuple, labels)))
+        if isinstance(value, list):
+            prev = merged.get(key) or [0] * len(value)
+            merged[key] = [a + b for a, b in zip(prev, value)]
+        else:
+            merged[key] = merged.get(key, 0) + value
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+
+    def collect(self):
+        """Values summed over all processes: {(name, labels): value}."""
+        if not self.directory:
+            return {(name, tuple(map(tuple, labels))): value for name, labels, value in self.snapshot()}
+        self.flush()
+        snapshots = {}
+        for path in glob.glob(os.path.join(self.directory, "[0-9]*.json")):
+            pid, _, started = os.path.basename(path)[:-len(".json")].partition("-")
+            snapshots[path] = (int(pid), int(started or 0))
+        newest = {}
+        for pid, started in snapshots.values():
+            newest[pid] = max(newest.get(pid, started), started)
+        dead = [path for path, (pid, started) in snapshots.items() if started < newest[pid] or not _pid_alive(pid)]
+        if dead:
+            self._retire(dead)
+        merged = {}
+        for name, labels, value in self._read(self._retired_path) or []:
+            self._add(merged, name, labels, value)
+        for path in snapshots:
+            if path not in dead:
+                for name, labels, value in self._read(path) or []:
+                    self._add(merged, name, labels, value)
+        return merged
+
+    @property
+    def _retired_path(self):
+        return os.path.join(self.directory, "retired.json")
+
+    def _retire(self, paths):
+        """Adds the counters and histograms of these snapshots of exited
+        processes to retired.json and removes them."""
+        with open(os.path.join(self.directory, "retired.lock"), "w") as lock:
+            # one worker at a time, or two could add the same snapshot
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = {}
+            for name, labels, value in self._read(self._retired_path) or []:
+                self._add(totals, name, labels, value)
+            folded = []
+            for path in paths:
+                entries = self._read(path)
+                if entries is None and not os.path.exists(path):
+                    continue  # another worker retired it first
+                for name, labels, value in entries or []:
+                    if self._kinds.get(name, ("counter",))[0] != "gauge":
+                        self._add(totals, name, labels, value)
+                folded.append(path)
+            if folded:
+                self._write(self._retired_path, [[name, list(labels), value]
+                                                 for (name, labels), value in totals.items()])
+                for path in folded:
+                    os.remove(path)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        values = self.collect()
+        lines = []
+        for name, (kind, help, buckets) in self._kinds.items():
+            series = sorted((labels, v) for (n, labels), v in values.items() if n == name)
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, v in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(v)}")
+                    continue
+                total = 0
+                for bound, n in zip(buckets + ("+Inf",), v[:-2] + [v[-1] - sum(v[:-2])]):
+                    total += n
+                    le = bound if bound == "+Inf" else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', str(le))])} {total}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(v[-2])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {v[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+# ---------- Sampling profiler ----------
+# Turned on at runtime for one endpoint (POST /profile): while it is on, every
+# request to that endpoint registers its thread, and a sampler thread records
+# the Python stack of the registered threads every `interval` seconds. The
+# setting is kept in <dir>/profile.json so every worker picks it up, and the
+# samples of each worker in <dir>/profile-<pid>.json. Samples are "folded"
+# stacks (root;...;leaf count), the input format of flame graph tools.
+class SamplingProfiler:
+    def __init__(self, directory):
+        self.directory = directory
+        self._config = None
+        self._config_mtime = None
+        self._session = None
+        self._threads = set()
+        self._samples = Counter()
+        self._sampler = None
+        self._lock = threading.Lock()
+
+    @property
+    def _config_path(self):
+        return os.path.join(self.directory, "profile.json")
+
+    def configure(self, endpoint, seconds, interval):
+        """Profiles `endpoint` for the next `seconds` (0 turns profiling off)."""
+        config = {"endpoint": endpoint, "interval": interval, "until": time.time() + seconds,
+                  "session": f"{os.getpid()}-{time.time()}"}
+        tmp = self._config_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(config, f)
+        os.replace(tmp, self._config_path)
+        for path in glob.glob(os.path.join(self.directory, "profile-*.json")):
+            os.remove(path)
+        return config
+
+    def config(self):
+        try:
+            mtime = os.stat(self._config_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if mtime != self._config_mtime:
+            try:
+                with open(self._config_path) as f:
+                    self._config = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self._config_mtime = mtime
+        return self._config
+
+    def _active(self, endpoint=None):
+        config = self.config()
+        if not config or time.time() > config["until"]:
+            return None
+        if endpoint is not None and config["endpoint"] != endpoint:
+            return None
+        return config
+
+    def enter(self, endpoint):
+        """Registers the calling thread if `endpoint` is being profiled."""
+        config = self._active(endpoint)
+        if config is None:
+            return False
+        with self._lock:
+            if config["session"] != self._session:
+                self._session = config["session"]
+                self._samples.clear()
+            self._threads.add(threading.get_ident())
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._run, args=(config["interval"],),
+                                                 name="profiler", daemon=True)
+                self._sampler.start()
+        return True
+
+    def leave(self):
+        with self._lock:
+            self._threads.discard(threading.get_ident())
+        self.flush()
+
+    def _run(self, interval):
+        while self._active() is not None:
+            with self._lock:
+                threads = set(self._threads)
+            if threads:
+                frames = sys._current_frames()
+                stacks = [self._fold(frames[t]) for t in threads if t in frames]
+                with self._lock:
+                    self._samples.update(stacks)
+            time.sleep(interval)
+        self.flush()
+
+    @staticmethod
+    def _fold(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def flush(self):
+        with self._lock:
+            if not self._samples:
+                return
+            data = {"session": self._session, "samples": dict(self._samples)}
+        path = os.path.join(self.directory, f"profile-{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    def folded(self):
+        """The samples of the current session from all workers, folded."""
+        self.flush()
+        config = self.config() or {}
+        total = Counter()
+        for path in glob.glob(os.path.join(self.directory, "profile-*.json")):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data.get("session") == config.get("session"):
+                total.update(data["samples"])
+        return "".join(f"{stack} {n}\n" for stack, n in total.most_common())
@@ -0,0 +1,214 @@
+import numpy as np
+
+# ---------- Operation registry ----------
+# Every operation served by /calculate and /calculate-batch is declared here
+# once: the operands it reads, its shape checks, extra parameters, and a NumPy
+# kernel. Kernels accept stacks of matrices (n, rows, cols) as well as single
+# matrices unless registered with stackable=False, so the batch endpoint can
+# evaluate a whole group of jobs with one call. Each operation also estimates
+# its floating-point work from the operand shapes, which decides whether a
+# request is computed inline or handed to the worker pool. Registering an
+# operation only stores references, nothing is computed at import.
+
+def whole_number(value):
+    """int(value), refusing fractions and booleans that int() would quietly
+    turn into another number (2.7 -> 2, True -> 1)."""
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"{value!r} is not a whole number")
+    return int(value)
+
+class Operation:
+    def __init__(self, name, label, operands, kernel, checks=(), params=None, stackable=True, cached=True,
+                 cost=None):
+        self.name = name
+        self.label = label
+        self.operands = operands
+        self.kernel = kernel
+        self.checks = checks
+        self.params = params or {}
+        self.stackable = stackable
+        self.cached = cached
+        self.cost = cost or elementwise
+
+    def read_params(self, source):
+        """Reads this operation's parameters from a dict-like source (JSON body,
+        query string or batch job), falling back to their defaults."""
+        out = {}
+        for name, (kind, default) in self.params.items():
+            convert = whole_number if kind is int else kind
+            try:
+                out[name] = convert(source.get(name, default))
+            except (TypeError, ValueError):
+                raise ValueError(f"Parameter {name} must be of type {kind.__name__}")
+        return out
+
+    def validate(self, *mats):
+        """Returns an error message, or None if the operands fit this operation."""
+        named = dict(zip(self.operands, mats))
+        for name, M in named.items():
+            if M.ndim != 2 or 0 in M.shape:
+                return f"Matrix {name} must not be empty"
+        for check in self.checks:
+            error = check(named)
+            if error:
+                return error
+        return None
+
+    def flops(self, *mats, **params):
+        """Rough number of floating-point operations for these operands, or
+        for all of them when given stacks of matrices."""
+        count = mats[0].shape[0] if mats[0].ndim == 3 else 1
+        return count * self.cost(*(M.shape[-2:] for M in mats), **params)
+
+    def cache_name(self, params):
+        return self.name + "".join(f";{k}={v}" for k, v in sorted(params.items()))
+
+    def __call__(self, *mats, **params):
+        return self.kernel(*mats, **params)
+
+    def describe(self):
+        return {"name": self.name, "label": self.label, "operands": self.operands,
+                "params": {k: {"type": kind.__name__, "default": default}
+                           for k, (kind, default) in self.params.items()}}
+
+OPERATIONS = {}
+
+def register(name, label, operands, kernel, checks=(), params=None, stackable=True, cached=True, cost=None):
+    OPERATIONS[name] = Operation(name, label, operands, kernel, checks, params, stackable, cached, cost)
+
+def get_operation(name):
+    return OPERATIONS.get(name)
+
+# ---------- Checks ----------
+# A check takes the operands by name and returns an error message or None.
+def same_shape(what):
+    return lambda m: None if m["A"].shape == m["B"].shape else f"Matrix sizes must match for {what}"
+
+def square(name, what):
+    return lambda m: None if m[name].shape[0] == m[name].shape[1] else f"Matrix {name} must be square {what}"
+
+def symmetric(name, what):
+    return lambda m: None if np.allclose(m[name], m[name].T) else f"Matrix {name} must be symmetric {what}"
+
+def inner_dims(m):
+    return None if m["A"].shape[1] == m["B"].shape[0] else "For multiplication: cols(A) must equal rows(B)"
+
+def solve_dims(m):
+    return None if m["A"].shape[0] == m["B"].shape[0] else "To solve AX = B, rows(A) must equal rows(B)"
+
+# ---------- Costs ----------
+# Textbook operation counts from the operand shapes (rows, cols); constant
+# factors only need to be right within a small multiple.
+def elementwise(*shapes, **params):
+    return shapes[0][0] * shapes[0][1]
+
+def matmul_cost(a, b):
+    return 2 * a[0] * a[1] * b[1]
+
+def square_cost(a):
+    return matmul_cost(a, a)
+
+def power_cost(a, k):
+    # repeated squaring: about two products per bit of k
+    return square_cost(a) * 2 * max(abs(k).bit_length(), 1)
+
+def cubic(factor):
+    return lambda a, **params: factor * a[0] * a[1] * min(a)
+
+def solve_cost(a, b):
+    return 2 * a[0] ** 3 // 3 + 2 * a[0] ** 2 * b[1]
+
+# ---------- Kernels ----------
+def transpose(M):
+    return np.swapaxes(M, -1, -2)
+
+def trace(M):
+    return np.trace(M, axis1=-2, axis2=-1)
+
+def qr(M):
+    Q, R = np.linalg.qr(M)
+    return {"Q": Q, "R": R}
+
+def svd(M):
+    U, S, Vt = np.linalg.svd(M)
+    return {"U": U, "S": S, "Vt": Vt}
+
+def eig(M):
+    # eigh is faster and stays real for symmetric input
+    if np.allclose(M, M.T):
+        values, vectors = np.linalg.eigh(M)
+    else:
+        values, vectors = np.linalg.eig(M)
+    return {"values": values, "vectors": vectors}
+
+def lu(M):
+    """LU factorization with partial pivoting, M = P @ L @ U. Each elimination
+    step updates the whole trailing submatrix at once."""
+    n = M.shape[0]
+    U = np.array(M, dtype=np.float64)
+    L = np.eye(n)
+    perm = np.arange(n)
+    for k in range(n - 1):
+        p = k + int(np.argmax(np.abs(U[k:, k])))
+        if p != k:
+            U[[k, p]] = U[[p, k]]
+            L[[k, p], :k] = L[[p, k], :k]
+            perm[[k, p]] = perm[[p, k]]
+        if U[k, k] != 0:
+            f = U[k + 1:, k] / U[k, k]
+            L[k + 1:, k] = f
+            U[k + 1:, k:] -= np.outer(f, U[k, k:])
+            U[k + 1:, k] = 0.0
+    return {"P": np.eye(n)[:, perm], "L": L, "U": U}
+
+def result_to_json(res):
+    """Converts a kernel result (array, scalar or dict of them) to JSON-ready values.
+    Complex arrays with a non-zero imaginary part become {"real": ..., "imag": ...}."""
+    if isinstance(res, dict):
+        return {k: v if isinstance(v, (str, list)) else result_to_json(v) for k, v in res.items()}
+    res = np.asarray(res)
+    if np.iscomplexobj(res):
+        if not res.imag.any():
+            return res.real.tolist()
+        return {"real": res.real.tolist(), "imag": res.imag.tolist()}
+    return res.tolist()
+
+def take(res, i):
+    """The i-th item of a result computed on a stack of matrices."""
+    if isinstance(res, dict):
+        return {k: v[i] for k, v in res.items()}
+    return res[i]
+
+# ---------- Registrations ----------
+# Listed in the order the Streamlit client shows them.
+register("add", "Addition", "AB", np.add, [same_shape("addition")])
+register("sub", "Subtraction", "AB", np.subtract, [same_shape("subtraction")])
+register("mul", "Multiplication", "AB", np.matmul, [inner_dims], cost=matmul_cost)
+register("det-a", "$|A|$", "A", np.linalg.det, [square("A", "to calculate the determinant")], cost=cubic(2 / 3))
+register("det-b", "$|B|$", "B", np.linalg.det, [square("B", "to calculate the determinant")], cost=cubic(2 / 3))
+register("a2", "A$^2$", "A", lambda A: np.matmul(A, A), [square("A", "for A^2")], cost=square_cost)
+register("b2", "B$^2$", "B", lambda B: np.matmul(B, B), [square("B", "for B^2")], cost=square_cost)
+# a transpose is a view, cheaper than hashing its operand
+register("ta", "T(A)", "A", transpose, cached=False)
+register("tb", "T(B)", "B", transpose, cached=False)
+register("solve", "Solve AX=B", "AB", np.linalg.solve, [square("A", "to solve AX = B"), solve_dims],
+         cost=solve_cost)
+
+for _side in "AB":
+    _s = _side.lower()
+    # matrix_power uses repeated squaring: O(log k) products instead of k - 1
+    register(f"pow-{_s}", f"{_side}$^k$", _side, lambda M, k: np.linalg.matrix_power(M, k),
+             [square(_side, f"for {_side}^k")], params={"k": (int, 2)}, cost=power_cost)
+    register(f"inv-{_s}", f"{_side}$^{{-1}}$", _side, np.linalg.inv, [square(_side, "to calculate the inverse")],
+             cost=cubic(2))
+    register(f"rank-{_s}", f"rank({_side})", _side, np.linalg.matrix_rank, cost=cubic(4))
+    register(f"trace-{_s}", f"tr({_side})", _side, trace, [square(_side, "to calculate the trace")])
+    register(f"lu-{_s}", f"LU({_side})", _side, lu, [square(_side, "for LU decomposition")], stackable=False,
+             cost=cubic(2 / 3))
+    register(f"qr-{_s}", f"QR({_side})", _side, qr, cost=cubic(4))
+    register(f"chol-{_s}", f"Cholesky({_side})", _side, np.linalg.cholesky,
+             [square(_side, "for Cholesky decomposition"), symmetric(_side, "for Cholesky decomposition")],
+             cost=cubic(1 / 3))
+    register(f"eig-{_s}", f"eig({_side})", _side, eig, [square(_side, "for eigen decomposition")], stackable=False,
+             cost=cubic(10))
+    register(f"svd-{_s}", f"SVD({_side})", _side, svd, cost=cubic(12))
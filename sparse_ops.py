@@ -0,0 +1,124 @@
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+# ---------- Sparse matrices ----------
+# Besides a list of rows, an operand of /calculate may be sent as
+#   {"format": "coo", "shape": [m, n], "row": [...], "col": [...], "data": [...]}
+#   {"format": "csr", "shape": [m, n], "indptr": [...], "indices": [...], "data": [...]}
+# add, sub, mul, transpose and solve then run on CSR matrices without ever
+# building the dense array. The server picks the representation from the
+# measured density: large dense input that is mostly zeros is computed sparse,
+# and sparse input that is mostly non-zero is densified.
+SPARSE_MAX_DENSITY = 0.05    # sparse kernels win below this fill ratio
+DENSIFY_MIN_DENSITY = 0.3    # sparse input above this is computed dense
+SPARSE_MIN_DIM = 256         # below this, dense BLAS is always fast enough
+MAX_DENSE_CELLS = 25_000_000  # sparse input is never densified beyond this
+
+def _solve(A, B):
+    # a singular A comes back as NaNs (dense B) or a RuntimeError (sparse B);
+    # both fail like np.linalg.solve does, with a LinAlgError (a ValueError)
+    try:
+        X = spla.spsolve(A.tocsc(), B)
+    except RuntimeError as e:
+        raise np.linalg.LinAlgError("Singular matrix") from e
+    if not np.isfinite(X.data if sp.issparse(X) else X).all():
+        raise np.linalg.LinAlgError("Singular matrix")
+    # spsolve flattens single-column right-hand sides
+    return X.reshape(B.shape) if not sp.issparse(X) else X
+
+SPARSE_KERNELS = {
+    "add": lambda A, B: A + B,
+    "sub": lambda A, B: A - B,
+    "mul": lambda A, B: A @ B,
+    "ta": lambda A: A.T.tocsr(),
+    "tb": lambda B: B.T.tocsr(),
+    "solve": _solve,
+}
+
+def is_sparse_payload(value):
+    return isinstance(value, dict) and "format" in value
+
+def issparse(M):
+    return sp.issparse(M)
+
+def density(M):
+    if sp.issparse(M):
+        return M.nnz / max(M.shape[0] * M.shape[1], 1)
+    return np.count_nonzero(M) / max(M.size, 1)
+
+def parse_sparse(name, payload, convert_cells):
+    """Builds a CSR matrix from a COO or CSR payload. `convert_cells` turns the
+    data list into float64 and returns (values, bad_indices), like the dense
+    parser does for cells."""
+    fmt = str(payload.get("format", "")).lower()
+    try:
+        m, n = (int(d) for d in payload["shape"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Sparse matrix {name} needs a shape [rows, cols].")
+    if m <= 0 or n <= 0:
+        raise ValueError(f"Sparse matrix {name} must not be empty")
+
+    data = payload.get("data", [])
+    if not isinstance(data, list):
+        raise ValueError(f"Sparse matrix {name}: data must be a list.")
+    values, bad = convert_cells(data)
+    if bad:
+        shown = ", ".join(f"'{data[i]}' at entry {i + 1}" for i in bad[:10])
+        raise ValueError(f"Invalid input in sparse matrix {name}: {shown}. Please use valid numbers.")
+
+    try:
+        if fmt == "coo":
+            row = np.asarray(payload.get("row", []), dtype=np.int64)
+            col = np.asarray(payload.get("col", []), dtype=np.int64)
+            if not (len(row) == len(col) == len(values)):
+                raise ValueError("row, col and data must have the same length")
+            if len(row) and (row.min() < 0 or row.max() >= m or col.min() < 0 or col.max() >= n):
+                raise ValueError("index out of range")
+            M = sp.coo_matrix((values, (row, col)), shape=(m, n)).tocsr()
+        elif fmt == "csr":
+            indptr = np.asarray(payload.get("indptr", []), dtype=np.int64)
+            indices = np.asarray(payload.get("indices", []), dtype=np.int64)
+            M = sp.csr_matrix((values, indices, indptr), shape=(m, n))
+            M.check_format(full_check=True)
+        else:
+            raise ValueError(f"unknown format '{fmt}', use 'coo' or 'csr'")
+    except ValueError as e:
+        raise ValueError(f"Sparse matrix {name}: {e}")
+    M.sum_duplicates()
+    return M
+
+def to_payload(M):
+    """The compact CSR form used in responses and in history."""
+    M = sp.csr_matrix(M)
+    M.eliminate_zeros()
+    return {"format": "csr", "shape": list(M.shape), "indptr": M.indptr.tolist(),
+            "indices": M.indices.tolist(), "data": M.data.tolist()}
+
+def choose_sparse(op, mats):
+    """Decides whether `op` on these operands (dense arrays or CSR matrices)
+    should run on sparse kernels, from the operands' size and density."""
+    if op not in SPARSE_KERNELS:
+        return False
+    if any(sp.issparse(M) for M in mats):
+        # sent sparse: stay sparse unless it is mostly non-zero and small enough to densify
+        return not all(density(M) > DENSIFY_MIN_DENSITY and M.shape[0] * M.shape[1] <= MAX_DENSE_CELLS
+                       for M in mats)
+    return (min(min(M.shape) for M in mats) >= SPARSE_MIN_DIM
+            and all(density(M) <= SPARSE_MAX_DENSITY for M in mats))
+
+def to_sparse(mats):
+    return tuple(sp.csr_matrix(M) for M in mats)
+
+def to_dense(mats):
+    out = []
+    for M in mats:
+        if sp.issparse(M):
+            if M.shape[0] * M.shape[1] > MAX_DENSE_CELLS:
+                raise ValueError("This operation needs a dense matrix and the sparse operand is too large to densify.")
+            M = M.toarray()
+        out.append(M)
+    return tuple(out)
+
+def run_sparse(op, mats):
+    return SPARSE_KERNELS[op](*to_sparse(mats))
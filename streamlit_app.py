@@ -1,9 +1,14 @@
 import streamlit as st
 import requests
 import numpy as np
+import pandas as pd
+import csv
 import json
 from datetime import datetime
 import os
+import io
+import time
+from fractions import Fraction
 
 st.set_page_config(page_title="Matrix Calculator (Streamlit)", layout="wide")
 
@@ -13,6 +18,51 @@ API_BASE = "https://matrix-calculator-ul85.onrender.com"
 st.sidebar.header("Navigation")
 page = st.sidebar.radio("Go to", ["Calculator", "History"])
 
+NPY_MIMETYPE = "application/x-npy"
+MAX_CELL_INPUTS = 5   # up to 5x5 a matrix is edited one text box per cell
+MAX_DIM = 1000
+TABLE_CELLS = 100     # larger results are shown as a scrollable table
+PAGE_ROWS = 200       # rows per page of a large result
+HISTORY_TTL = 60
+OPERATIONS_TTL = 3600
+PARAM_TYPES = {"int": int, "float": float}
+
+@st.cache_resource
+def http_session():
+    """
+    One keep-alive connection pool for every rerun and browser session,
+    instead of a new connection (and TLS handshake) per request.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+api = http_session()
+
+@st.cache_data(ttl=OPERATIONS_TTL, show_spinner=False)
+def fetch_operations():
+    """
+    The operations the server offers, by name, in the order it lists them:
+    label, operands, parameters, and whether each has an exact kernel and a
+    float32 one. Asked from GET /operations rather than imported, so the
+    client does not need the server's modules (or scipy).
+    """
+    res = api.get(f"{API_BASE}/operations", timeout=30)
+    res.raise_for_status()
+    return {op["name"]: op for op in res.json()}
+
+@st.cache_data(ttl=HISTORY_TTL, show_spinner=False)
+def fetch_history(limit):
+    """
+    The newest `limit` history entries. Cached for HISTORY_TTL seconds, and
+    cleared after a calculation or a delete.
+    """
+    res = api.get(f"{API_BASE}/history", params={"limit": limit}, timeout=5)
+    res.raise_for_status()
+    return res.json()
+
 def resize_matrix(mat, r, c):
     """
     Safely resizes or creates a matrix with a given number of rows and columns,
@@ -34,22 +84,195 @@ def resize_matrix(mat, r, c):
         new_mat.append(new_row)
     return new_mat
 
-# Map internal operation names to display names
-op_display_map = {
-    "add": "Addition",
-    "sub": "Subtraction",
-    "mul": "Multiplication",
-    "a2": "A$^2$",
-    "b2": "B$^2$",
-    "ta": "T(A)",
-    "tb": "T(B)",
-    "det-a": "$|A|$",
-    "det-b": "$|B|$",
-}
+def read_matrix_file(upload):
+    """
+    Reads an uploaded CSV or .npy file into a list of rows of strings.
+    """
+    if upload.name.lower().endswith(".npy"):
+        M = np.load(io.BytesIO(upload.getvalue()), allow_pickle=False)
+        if M.ndim != 2 or M.dtype.kind not in "biuf":
+            raise ValueError("the .npy file must hold a 2-D numeric array")
+        return M.astype(str).tolist()
+    text = upload.getvalue().decode("utf-8-sig")
+    rows = [[cell.strip() for cell in row] for row in csv.reader(io.StringIO(text)) if any(c.strip() for c in row)]
+    if not rows or any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError("every row must have the same number of cells")
+    return rows
+
+def matrix_input(name):
+    """
+    Size inputs and an editor for matrix `name`, kept in st.session_state[name]:
+    one text box per cell for small matrices, a table editor for larger ones,
+    and a CSV/.npy upload. The version counter changes whenever the matrix is
+    replaced (resize or upload) so the editors start again from it.
+    """
+    version_key, rows_key, cols_key = f"{name}-version", f"rows{name}_size", f"cols{name}_size"
+    st.session_state.setdefault(version_key, 0)
+    st.session_state.setdefault(rows_key, 3)
+    st.session_state.setdefault(cols_key, 3)
+
+    upload = st.file_uploader(f"Load {name} from a CSV or .npy file", type=["csv", "npy"], key=f"upload-{name}")
+    if upload is not None and st.session_state.get(f"{name}-file") != upload.file_id:
+        st.session_state[f"{name}-file"] = upload.file_id
+        try:
+            mat = read_matrix_file(upload)
+            if max(len(mat), len(mat[0])) > MAX_DIM:
+                raise ValueError(f"at most {MAX_DIM} rows and columns are supported")
+        except (ValueError, UnicodeDecodeError) as e:
+            st.error(f"Cannot read {upload.name}: {e}")
+        else:
+            st.session_state[name] = mat
+            st.session_state[rows_key], st.session_state[cols_key] = len(mat), len(mat[0])
+            st.session_state[version_key] += 1
+
+    size_row_col1, size_row_col2 = st.columns([1,1])
+    with size_row_col1:
+        st.write("Size row:")
+        rows = st.number_input("", min_value=1, max_value=MAX_DIM, key=rows_key, label_visibility="collapsed")
+    with size_row_col2:
+        st.write("Size column:")
+        cols = st.number_input("", min_value=1, max_value=MAX_DIM, key=cols_key, label_visibility="collapsed")
+
+    mat = st.session_state.get(name)
+    if mat is None or len(mat) != rows or len(mat[0]) != cols:
+        st.session_state[name] = resize_matrix(mat or [], rows, cols)
+        st.session_state[version_key] += 1
+    version = st.session_state[version_key]
+
+    st.write(f"Matrix: {name}")
+    if rows <= MAX_CELL_INPUTS and cols <= MAX_CELL_INPUTS:
+        for i in range(rows):
+            row_cols = st.columns(cols)
+            for j in range(cols):
+                key = f"{name}-{i}-{j}-{version}"
+                current_value = st.session_state[name][i][j]
+                st.session_state[name][i][j] = row_cols[j].text_input("", value=current_value, key=key)
+        return
+
+    # the editor keeps its edits relative to the data it was created with
+    source = st.session_state.get(f"{name}-source")
+    if source is None or source[0] != version:
+        frame = pd.DataFrame(st.session_state[name], columns=[str(j + 1) for j in range(cols)])
+        source = st.session_state[f"{name}-source"] = (version, frame)
+    edited = st.data_editor(source[1], key=f"editor-{name}-{version}", use_container_width=True)
+    st.session_state[name] = edited.astype(str).values.tolist()
+
+def to_float_matrix(mat):
+    """
+    Converts a matrix of strings such as '2', '-1.5' or '3/4' into a float array.
+    """
+    return np.array([[float(Fraction(v.strip())) for v in row] for row in mat], dtype=np.float64)
+
+def encode_npy(*arrays):
+    """
+    Concatenates the .npy encoding of each array, the binary body /calculate accepts.
+    """
+    buf = io.BytesIO()
+    for arr in arrays:
+        np.save(buf, arr, allow_pickle=False)
+    return buf.getvalue()
+
+def decode_npy(data):
+    """
+    Decodes a single .npy array returned by the API.
+    """
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+JOB_POLL_SECONDS = 0.5
+
+def run_job(payload):
+    """
+    Runs a calculation as a server-side job and polls it until it finishes,
+    so a long calculation is never cut off by a request timeout.
+    Returns (ok, data) with data in the shape /calculate responds with.
+    """
+    resp = api.post(f"{API_BASE}/jobs", json=payload, timeout=10)
+    if not resp.ok:
+        return False, resp.json()
+    job_id = resp.json()["id"]
+    bar = st.progress(0.0, text="Queued…")
+    while True:
+        resp = api.get(f"{API_BASE}/jobs/{job_id}", timeout=10)
+        job = resp.json()
+        if not resp.ok or job["status"] in ("done", "error"):
+            break
+        bar.progress(job["progress"], text=job["status"].capitalize() + "…")
+        time.sleep(JOB_POLL_SECONDS)
+    bar.empty()
+    if job.get("status") == "done" and "error" not in job:
+        return True, {"result": job["result"], "id": job["entry_id"], "time": job["time"]}
+    return False, {"error": job.get("error", "Unknown API error")}
+
+def show_matrix(M, key):
+    """
+    Displays a matrix: as a static table when small, otherwise as a
+    scrollable table showing PAGE_ROWS rows per page.
+    """
+    M = np.asarray(M)
+    if M.ndim != 2 or M.size <= TABLE_CELLS:
+        st.table(M)
+        return
+    if np.iscomplexobj(M):
+        M = M.astype(str)
+    pages = -(-M.shape[0] // PAGE_ROWS)
+    start = 0
+    if pages > 1:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key=f"page-{key}")
+        start = (page - 1) * PAGE_ROWS
+    stop = min(start + PAGE_ROWS, M.shape[0])
+    st.caption(f"{M.shape[0]}×{M.shape[1]} matrix, rows {start + 1}–{stop}")
+    st.dataframe(pd.DataFrame(M[start:stop], index=range(start + 1, stop + 1), columns=range(1, M.shape[1] + 1)),
+                 use_container_width=True)
+
+def show_result(result, key="result"):
+    """
+    Displays a result returned by the API: a number, a matrix, a complex
+    array ({"real", "imag"}) or a decomposition (a dict of those). `key`
+    tells apart the page selectors of several results on one page.
+    """
+    if isinstance(result, dict) and result.get("format") == "csr":
+        m, n = result["shape"]
+        st.caption(f"Sparse {m}×{n} matrix, {len(result['data'])} non-zeros")
+        rows = np.repeat(np.arange(m), np.diff(result["indptr"]))
+        if m * n <= 10000:
+            dense = np.zeros((m, n))
+            dense[rows, result["indices"]] = result["data"]
+            show_matrix(dense, key)
+        else:
+            st.dataframe({"row": rows[:1000], "col": result["indices"][:1000], "value": result["data"][:1000]})
+    elif isinstance(result, dict) and set(result) == {"real", "imag"}:
+        show_matrix(np.array(result["real"]) + 1j * np.array(result["imag"]), key)
+    elif isinstance(result, dict):
+        for part, value in result.items():
+            st.markdown(f"**{part}**")
+            show_result(value, f"{key}-{part}")
+    elif isinstance(result, (float, int)):
+        st.write(result)
+    else:
+        show_matrix(result, key)
+
+# Map internal operation names to display names and back, from the server's registry
+try:
+    OPERATIONS = fetch_operations()
+except requests.RequestException as e:
+    st.error(f"Could not load the list of operations from the server: {e}")
+    st.stop()
+op_display_map = {name: operation["label"] for name, operation in OPERATIONS.items()}
+api_op_map = {operation["label"]: name for name, operation in OPERATIONS.items()}
 
 
 if page == "Calculator":
     st.title("Matrix Calculator")
+
+    st.sidebar.subheader("Calculator Options")
+    use_binary = st.sidebar.checkbox("Binary transfer (.npy)", value=False,
+                                     help="Send matrices and receive results as NumPy .npy buffers instead of JSON")
+    use_exact = st.sidebar.checkbox("Exact fractions", value=False,
+                                    help="Compute addition, subtraction, multiplication, determinants and inverses "
+                                         "exactly and show the result as fractions")
+    use_single = st.sidebar.checkbox("Single precision", value=False,
+                                     help="Compute products and determinants in float32: about 7 significant "
+                                          "digits, faster on large matrices")
     
     # Left column for inputs
     left_col = st.columns([1])[0]
@@ -59,66 +282,31 @@ if page == "Calculator":
         
         op = st.radio(
             "Choose operation",
-            ("Addition", "Subtraction", "Multiplication", "$|A|$", "$|B|$", "A$^2$", "B$^2$", "T(A)", "T(B)"),
+            tuple(api_op_map),
             key="operation_selector",
             horizontal=True
         )
+
+        # Extra parameters the operation declares, e.g. k for A^k
+        op_params = {}
+        for name, spec in OPERATIONS[api_op_map[op]]["params"].items():
+            kind = PARAM_TYPES[spec["type"]]
+            op_params[name] = kind(st.number_input(name, value=spec["default"], step=1, key=f"param-{name}"))
+        if use_exact and OPERATIONS[api_op_map[op]]["exact"]:
+            op_params["exact"] = "true"
+        elif use_single and "float32" in OPERATIONS[api_op_map[op]]["precisions"]:
+            op_params["precision"] = "float32"
         
         st.markdown("---") 
 
         st.subheader("Matrix A")
-        
-        size_row_col1, size_row_col2 = st.columns([1,1])
-        with size_row_col1:
-            st.write("Size row:")
-            rowsA = st.number_input("", min_value=1, max_value=5, value=3, key="rowsA_size", label_visibility="collapsed")
-        
-        with size_row_col2:
-            st.write("Size column:")
-            colsA = st.number_input("", min_value=1, max_value=5, value=3, key="colsA_size", label_visibility="collapsed")
-
-        st.write("Matrix: A")
-        if "A" not in st.session_state:
-            st.session_state.A = resize_matrix([], rowsA, colsA)
-        else:
-            if len(st.session_state.A) != rowsA or (rowsA > 0 and len(st.session_state.A[0]) != colsA):
-                st.session_state.A = resize_matrix(st.session_state.A, rowsA, colsA)
-
-        for i in range(rowsA):
-            cols = st.columns(colsA)
-            for j in range(colsA):
-                key = f"A-{i}-{j}"
-                current_value = st.session_state.A[i][j]
-                new_val = cols[j].text_input("", value=current_value, key=key)
-                st.session_state.A[i][j] = new_val
+        matrix_input("A")
 
         st.markdown("---") 
 
         # The conditional statement is removed to always display Matrix B
         st.subheader("Matrix B")
-        
-        size_row_col1_B, size_row_col2_B = st.columns([1,1])
-        with size_row_col1_B:
-            st.write("Size row:")
-            rowsB = st.number_input("", min_value=1, max_value=5, value=3, key="rowsB_size", label_visibility="collapsed")
-        with size_row_col2_B:
-            st.write("Size column:")
-            colsB = st.number_input("", min_value=1, max_value=5, value=3, key="colsB_size", label_visibility="collapsed")
-        
-        st.write("Matrix: B") 
-        if "B" not in st.session_state:
-            st.session_state.B = resize_matrix([], rowsB, colsB)
-        else:
-            if len(st.session_state.B) != rowsB or (rowsB > 0 and len(st.session_state.B[0]) != colsB):
-                st.session_state.B = resize_matrix(st.session_state.B, rowsB, colsB)
-        
-        for i in range(rowsB):
-            cols = st.columns(colsB)
-            for j in range(colsB):
-                key = f"B-{i}-{j}"
-                current_value = st.session_state.B[i][j]
-                new_val = cols[j].text_input("", value=current_value, key=key)
-                st.session_state.B[i][j] = new_val
+        matrix_input("B")
         
         st.markdown("---") 
 
@@ -126,29 +314,35 @@ if page == "Calculator":
     cols = st.columns([1, 1, 1])
     with cols[1]:
         if st.button("Calculate", use_container_width=True):
-            api_op_map = {
-                "Addition": "add",
-                "Subtraction": "sub",
-                "Multiplication": "mul",
-                "A$^2$": "a2",
-                "B$^2$": "b2",
-                "T(A)": "ta",
-                "T(B)": "tb",
-                "$|A|$": "det-a",
-                "$|B|$": "det-b"
-            }
             api_op = api_op_map.get(op)
             
             if api_op:
-                payload = {"A": st.session_state.A, "B": st.session_state.B, "operation": api_op}
                 try:
-                    resp = requests.post(f"{API_BASE}/calculate", json=payload, timeout=10)
-                    data = resp.json()
-                    if resp.ok:
+                    if use_binary:
+                        try:
+                            body = encode_npy(to_float_matrix(st.session_state.A), to_float_matrix(st.session_state.B))
+                        except (ValueError, ZeroDivisionError) as e:
+                            st.error(f"Invalid matrix input: {e}")
+                            st.stop()
+                        resp = api.post(f"{API_BASE}/calculate", params={"operation": api_op, **op_params}, data=body,
+                                        headers={"Content-Type": NPY_MIMETYPE, "Accept": NPY_MIMETYPE}, timeout=10)
+                        # decompositions come back as JSON even when .npy is accepted
+                        if resp.ok and resp.headers.get("Content-Type", "").startswith(NPY_MIMETYPE):
+                            data = {"result": decode_npy(resp.content).tolist(),
+                                    "id": resp.headers.get("X-Entry-Id"),
+                                    "time": resp.headers.get("X-Entry-Time")}
+                        else:
+                            data = resp.json()
+                        ok = resp.ok
+                    else:
+                        payload = {"A": st.session_state.A, "B": st.session_state.B, "operation": api_op, **op_params}
+                        ok, data = run_job(payload)
+                    if ok:
                         st.session_state.last_result = data["result"]
                         st.session_state.last_id = data.get("id")
                         st.session_state.last_time = data.get("time")
                         st.session_state.last_op_type = op # Store the operation type for display
+                        fetch_history.clear()
                         st.success("Operation successful — saved in history")
                     else:
                         st.error(data.get("error","Unknown API error"))
@@ -164,45 +358,46 @@ if page == "Calculator":
     if "last_result" in st.session_state:
         st.markdown("<h2 style='text-align:center; color:#00a3e0;'>YOUR INPUT</h2>", unsafe_allow_html=True)
         
-        # Display inputs based on the operation type
-        if st.session_state.last_op_type in ["Addition", "Subtraction", "Multiplication"]:
+        # Display the inputs the operation used
+        last_operands = OPERATIONS[api_op_map[st.session_state.last_op_type]]["operands"]
+        if last_operands == "AB":
             input_cols = st.columns(2)
             with input_cols[0]:
                 st.markdown("### Matrix A:")
                 try:
-                    st.table(np.array(st.session_state.A))
+                    show_matrix(np.array(st.session_state.A), "input-A")
                 except Exception:
                     st.text(str(st.session_state.A))
             with input_cols[1]:
                 st.markdown("### Matrix B:")
                 try:
-                    st.table(np.array(st.session_state.B))
+                    show_matrix(np.array(st.session_state.B), "input-B")
                 except Exception:
                     st.text(str(st.session_state.B))
-        elif st.session_state.last_op_type in ["A$^2$", "T(A)", "$|A|$"]:
+        elif last_operands == "A":
             st.markdown("### Matrix A:")
             try:
-                st.table(np.array(st.session_state.A))
+                show_matrix(np.array(st.session_state.A), "input-A")
             except Exception:
                 st.text(str(st.session_state.A))
-        elif st.session_state.last_op_type in ["B$^2$", "T(B)", "$|B|$"]:
+        elif last_operands == "B":
             st.markdown("### Matrix B:")
             try:
-                st.table(np.array(st.session_state.B))
+                show_matrix(np.array(st.session_state.B), "input-B")
             except Exception:
                 st.text(str(st.session_state.B))
                 
         # Display the operation and result
         st.markdown("<h2 style='text-align:center; color:#00a3e0;'>ANSWER</h2>", unsafe_allow_html=True)
         
-        if isinstance(st.session_state.last_result, (float, int)):
-            # If the result is a single number (determinant), write it directly
+        if isinstance(st.session_state.last_result, (float, int)) and api_op_map[st.session_state.last_op_type].startswith("det-"):
+            # If the result is a determinant, write it directly
             st.markdown(f"### Determinant of {st.session_state.last_op_type.replace('$', '').replace('|', '')}")
             st.write(st.session_state.last_result)
         else:
-            # Otherwise, it's a matrix and can be displayed as a table
+            # Otherwise it's a number, a matrix or a decomposition
             st.markdown(f"### Result of {st.session_state.last_op_type} operation")
-            st.table(np.array(st.session_state.last_result))
+            show_result(st.session_state.last_result)
             
     else:
         st.write("_No result yet_")
@@ -214,12 +409,14 @@ elif page == "History":
     history_limit = st.sidebar.slider("Number of history entries to show", min_value=1, max_value=20, value=5)
 
     if st.sidebar.button("Refresh history"):
+        fetch_history.clear()
         st.rerun()
 
     history = []
     try:
-        res = requests.get(f"{API_BASE}/history?limit={history_limit}", timeout=5)
-        history = res.json() if res.ok else []
+        history = fetch_history(history_limit)
+    except requests.HTTPError:
+        history = []
     except Exception as e:
         st.error(f"Cannot fetch history: {e}")
         history = []
@@ -233,23 +430,19 @@ elif page == "History":
             # Use the existence of matrix data to decide what to display
             if h["A"] and h["B"]:
                 st.write("Matrix A:")
-                st.table(np.array(h["A"]))
+                show_result(h["A"], f"{h['id']}-A")
                 st.write("Matrix B:")
-                st.table(np.array(h["B"]))
+                show_result(h["B"], f"{h['id']}-B")
             elif h["A"] and not h["B"]:
                 st.write("Matrix A:")
-                st.table(np.array(h["A"]))
+                show_result(h["A"], f"{h['id']}-A")
             elif not h["A"] and h["B"]:
                 st.write("Matrix B:")
-                st.table(np.array(h["B"]))
+                show_result(h["B"], f"{h['id']}-B")
 
             st.write("Result:")
             try:
-                # Handle single float result from determinant in history as well
-                if isinstance(h["result"], (float, int)):
-                    st.write(h["result"])
-                else:
-                    st.table(np.array(h["result"]))
+                show_result(h["result"], f"{h['id']}-result")
             except Exception:
                 st.text(str(h["result"]))
 
@@ -266,7 +459,7 @@ elif page == "History":
 
             if cols[1].button(f"Export {h['id']}", key=f"export-{h['id']}"):
                 try:
-                    r = requests.get(f"{API_BASE}/export-entry/{h['id']}", timeout=5)
+                    r = api.get(f"{API_BASE}/export-entry/{h['id']}", timeout=5)
                     if r.ok:
                         data = r.json()
                         st.download_button(label="Download JSON", data=json.dumps(data, indent=2), file_name=f"entry_{h['id']}.json", mime="application/json")
@@ -277,9 +470,10 @@ elif page == "History":
 
             if cols[2].button(f"Delete {h['id']}", key=f"del-{h['id']}"):
                 try:
-                    r = requests.post(f"{API_BASE}/delete-entry/{h['id']}", timeout=5)
+                    r = api.post(f"{API_BASE}/delete-entry/{h['id']}", timeout=5)
                     if r.ok:
                         st.success("Deleted")
+                        fetch_history.clear()
                         st.rerun()
                     else:
                         st.error("Delete failed")
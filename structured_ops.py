@@ -0,0 +1,278 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+from scipy.linalg import blas, lapack
+
+from exact_ops import bareiss
+
+# ---------- Structured matrices ----------
+# Before mul, a2/b2 and det-a/det-b run on dense operands, each operand is
+# looked at once, in O(n^2) against the O(n^3) of the operation, and the
+# operation goes to a kernel for what was found:
+#   diagonal     products scale the rows or columns of the other operand,
+#                determinants multiply the diagonal
+#   triangular   products with BLAS trmm (half the multiplications of a dense
+#                product) from BLAS_MIN_DIM, determinants multiply the diagonal
+#   banded       a band of w diagonals with w * BAND_RATIO <= n: products run
+#                one small gemm per block of rows, on the columns its band
+#                touches, determinants come from LAPACK's banded LU (gbtrf)
+#   symmetric    A^2 = A @ A.T with BLAS syrk, which computes one triangle,
+#                from BLAS_MIN_DIM
+#   integer      determinants up to INTEGER_DET_MAX_DIM by fraction-free
+#                elimination (see exact_ops), so |[[1, 2], [3, 4]]| is -2
+#                and not -2.0000000000000004
+#   dense        products with BLAS gemm, determinants from an LU factorization
+# Determinants multiply their pivots as they are unless that overflows or
+# underflows along the way; then they add up logarithms (like slogdet), and a
+# determinant beyond the float64 range comes back as {"sign", "log_abs"}, as
+# delta sessions report theirs, instead of inf or 0. "precision": "float32"
+# computes dense, triangular, banded and symmetric products and LU
+# determinants in single precision: about 7 significant digits, at about
+# twice the speed. Results are float64 either way.
+STRUCTURED_OPS = {"mul": "AB", "a2": "A", "b2": "B", "det-a": "A", "det-b": "B"}
+BAND_RATIO = 8
+BLAS_MIN_DIM = 256  # below this, a plain gemm is as fast as trmm or syrk
+BAND_BLOCK = 32
+MIRROR_BLOCK = 256
+INTEGER_DET_MAX_DIM = 20
+PRECISIONS = {"float64": np.float64, "float32": np.float32}
+
+Structure = namedtuple("Structure", "kind lower upper symmetric integer")
+Plan = namedtuple("Plan", "op kernel dtype structures flops")
+
+
+def detect(M, symmetric=False, integer=False):
+    """The Structure of the dense matrix M: its kind, its lower and upper
+    bandwidth, and (only when asked for, else None) whether it is symmetric
+    and whether all its entries are integers."""
+    n, m = M.shape
+    # beyond 2**53 not every integer is a float64, and int64 overflows soon after
+    is_int = bool(np.abs(M).max() < 2**53 and np.array_equal(M, np.rint(M))) if integer else None
+    if n != m:
+        return Structure("dense", n - 1, m - 1, False if symmetric else None, is_int)
+    # a non-zero corner settles a bandwidth without reading the rest
+    lower = n - 1 if M[-1, 0] != 0 else None
+    upper = n - 1 if M[0, -1] != 0 else None
+    if lower is None or upper is None:
+        nz = M != 0
+        rows = np.flatnonzero(nz.any(axis=1))
+        if not len(rows):
+            lower = upper = 0
+        if lower is None:
+            lower = max(int((rows - nz[rows].argmax(axis=1)).max()), 0)
+        if upper is None:
+            upper = max(int((m - 1 - nz[rows, ::-1].argmax(axis=1) - rows).max()), 0)
+    if lower == upper == 0:
+        kind = "diagonal"
+    elif lower == 0:
+        kind = "upper-triangular"
+    elif upper == 0:
+        kind = "lower-triangular"
+    elif (lower + upper + 1) * BAND_RATIO <= n:
+        kind = "banded"
+    else:
+        kind = "dense"
+    is_sym = None
+    if symmetric:
+        # the first row against the first column rules most matrices out in O(n)
+        is_sym = bool(kind == "diagonal" or lower == upper and np.array_equal(M[0], M[:, 0])
+                      and np.array_equal(M, M.T))
+    return Structure(kind, lower, upper, is_sym, is_int)
+
+
+def _narrow(s, n):
+    return (s.lower + s.upper + 1) * BAND_RATIO <= n
+
+
+def _triangular(s):
+    return s.kind in ("diagonal", "upper-triangular", "lower-triangular")
+
+
+def plan(op, mats, precision="float64"):
+    """Picks the kernel for `op` on these dense operands. Returns a Plan with
+    the kernel name, the dtype it computes in, the operand structures and
+    its estimated floating-point work."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of: {', '.join(PRECISIONS)}")
+    if op.startswith("det"):
+        M, = mats
+        n = M.shape[0]
+        s = detect(M, integer=n <= INTEGER_DET_MAX_DIM)
+        if _triangular(s):
+            kernel, dtype, flops = "diagonal-product", "float64", n
+        elif s.integer:
+            kernel, dtype, flops = "bareiss", "float64", n ** 3
+        elif _narrow(s, n):
+            kernel, dtype, flops = "banded-lu", precision, 2 * n * s.lower * (s.lower + s.upper + 1)
+        else:
+            kernel, dtype, flops = "lu", precision, 2 * n ** 3 // 3
+        return Plan(op, kernel, dtype, {op[-1].upper(): s}, flops)
+
+    if op == "mul":
+        A, B = mats
+        sa, sb = detect(A), detect(B)
+        structures = {"A": sa, "B": sb}
+    else:
+        A = B = mats[0]
+        sa = sb = detect(A, symmetric=True)
+        structures = {op[0].upper(): sa}
+    (m, k), p = A.shape, B.shape[1]
+    if sa.kind == "diagonal":
+        kernel, precision, flops = "diagonal-left", "float64", k * p
+    elif sb.kind == "diagonal":
+        kernel, precision, flops = "diagonal-right", "float64", m * k
+    elif sa.kind != "dense" and _narrow(sa, m):
+        kernel, flops = "banded-left", 2 * m * p * (sa.lower + sa.upper + 1)
+    elif sb.kind != "dense" and _narrow(sb, k):
+        kernel, flops = "banded-right", 2 * m * p * (sb.lower + sb.upper + 1)
+    elif _triangular(sa) and m >= BLAS_MIN_DIM:
+        kernel, flops = "trmm-left", m * k * p
+    elif _triangular(sb) and k >= BLAS_MIN_DIM:
+        kernel, flops = "trmm-right", m * k * p
+    elif op != "mul" and sa.symmetric and m >= BLAS_MIN_DIM:
+        kernel, flops = "syrk", m * m * k
+    else:
+        kernel, flops = "gemm", 2 * m * k * p
+    return Plan(op, kernel, precision, structures, flops)
+
+
+def describe(p):
+    """The JSON form of a plan, reported with the result."""
+    structures = {}
+    for name, s in p.structures.items():
+        info = {"kind": s.kind, "bandwidth": [s.lower, s.upper]}
+        if s.symmetric is not None:
+            info["symmetric"] = s.symmetric
+        if s.integer is not None:
+            info["integer"] = s.integer
+        structures[name] = info
+    return {"kernel": p.kernel, "precision": p.dtype, "structure": structures}
+
+
+# ---------- Kernels ----------
+def _from_log(sign, log_abs):
+    """sign * exp(log_abs), or {"sign", "log_abs"} when that is beyond the
+    float64 range."""
+    with np.errstate(over="ignore", under="ignore"):
+        value = sign * np.exp(log_abs)
+    if np.isfinite(value) and value != 0:
+        return float(value)
+    return {"sign": int(sign), "log_abs": float(log_abs)}
+
+
+def _product(d, sign=1.0):
+    """sign times the product of the entries of d, through logarithms if
+    multiplying them in order overflows or underflows before the end."""
+    with np.errstate(over="ignore", under="ignore"):
+        value = sign * np.prod(d)
+    if not np.isfinite(value) and np.isfinite(d).all() or value == 0 and d.all():
+        return _from_log(sign * np.prod(np.sign(d)), np.sum(np.log(np.abs(d))))
+    return float(value)
+
+
+def _pivot_sign(piv):
+    """Sign of the row permutation of 0-based LAPACK pivots."""
+    return -1.0 if np.count_nonzero(piv != np.arange(len(piv))) % 2 else 1.0
+
+
+def det_lu(M):
+    # |M| = |M.T|, and M.T is already in the column-major order LAPACK wants
+    lu, piv, info = lapack.get_lapack_funcs("getrf", (M,))(M.T)
+    if info > 0:
+        return 0.0
+    return _product(np.diagonal(lu).astype(np.float64), _pivot_sign(piv))
+
+
+def det_banded(M, lower, upper):
+    # LAPACK band storage: M[i, j] in ab[lower + upper + i - j, j], with
+    # `lower` more rows on top for the fill-in of pivoting
+    n = M.shape[0]
+    ab = np.zeros((2 * lower + upper + 1, n), dtype=M.dtype)
+    for offset in range(-lower, upper + 1):
+        ab[lower + upper - offset, max(offset, 0):n + min(offset, 0)] = np.diagonal(M, offset)
+    lu, piv, info = lapack.get_lapack_funcs("gbtrf", (ab,))(ab, lower, upper)
+    if info > 0:
+        return 0.0
+    return _product(lu[lower + upper].astype(np.float64), _pivot_sign(piv))
+
+
+def det_integer(M):
+    reduced, sign = bareiss(M.astype(np.int64))
+    if reduced is None:
+        return 0.0
+    value = sign * reduced[-1, -1]
+    try:
+        return float(value)
+    except OverflowError:
+        return _from_log(1 if value > 0 else -1, math.log(abs(value)))
+
+
+def banded_matmul(A, B, lower, upper):
+    """A @ B for a square A with nothing outside `lower` diagonals below and
+    `upper` diagonals above its main diagonal."""
+    n = A.shape[0]
+    step = max(BAND_BLOCK, lower + upper + 1)
+    C = np.empty((n, B.shape[1]), dtype=np.result_type(A, B))
+    for i in range(0, n, step):
+        j0, j1 = max(i - lower, 0), min(i + step + upper, n)
+        np.matmul(A[i:i + step, j0:j1], B[j0:j1], out=C[i:i + step])
+    return C
+
+
+def triangular_matmul(T, M, lower, right=False):
+    """T @ M (or M @ T with `right`) for a triangular T. BLAS works on
+    column-major arrays, so it computes the transposed product, whose
+    transpose is the result in row-major order without any copy."""
+    trmm = blas.get_blas_funcs("trmm", (T, M))
+    return trmm(1.0, T.T, M.T, side=int(not right), lower=int(not lower)).T
+
+
+def symmetric_square(A):
+    """A @ A for a symmetric A, as A @ A.T with syrk. syrk only fills the
+    upper triangle, which is copied to the lower one a block at a time."""
+    C = blas.get_blas_funcs("syrk", (A,))(1.0, A.T, trans=1)
+    n = C.shape[0]
+    for i in range(0, n, MIRROR_BLOCK):
+        j = i + MIRROR_BLOCK
+        C[j:, i:j] = C[i:j, j:].T
+        block = C[i:j, i:j]
+        block += np.triu(block, 1).T
+    # symmetric, so the transpose is the same matrix in row-major order
+    return C.T
+
+
+def run_structured(p, mats):
+    """Computes a plan on its operands; results are float64."""
+    dtype = PRECISIONS[p.dtype]
+    mats = tuple(np.asarray(M, dtype=dtype) for M in mats)
+    s = next(iter(p.structures.values()))
+    if p.kernel == "diagonal-product":
+        return _product(np.diagonal(mats[0]))
+    if p.kernel == "bareiss":
+        return det_integer(mats[0])
+    if p.kernel == "banded-lu":
+        return det_banded(mats[0], s.lower, s.upper)
+    if p.kernel == "lu":
+        return det_lu(mats[0])
+
+    A, B = mats if len(mats) == 2 else mats * 2
+    sa, sb = (p.structures["A"], p.structures["B"]) if p.op == "mul" else (s, s)
+    if p.kernel == "diagonal-left":
+        C = np.diagonal(A)[:, None] * B
+    elif p.kernel == "diagonal-right":
+        C = A * np.diagonal(B)
+    elif p.kernel == "banded-left":
+        C = banded_matmul(A, B, sa.lower, sa.upper)
+    elif p.kernel == "banded-right":
+        # (A @ B).T = B.T @ A.T, and B.T has the bandwidths of B swapped
+        C = banded_matmul(B.T, A.T, sb.upper, sb.lower).T
+    elif p.kernel == "trmm-left":
+        C = triangular_matmul(A, B, sa.upper == 0)
+    elif p.kernel == "trmm-right":
+        C = triangular_matmul(B, A, sb.upper == 0, right=True)
+    elif p.kernel == "syrk":
+        C = symmetric_square(A)
+    else:
+        C = A @ B
+    return np.ascontiguousarray(C, dtype=np.float64)
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py opens its history database, matrix and session directories at
+# import: point them at a scratch directory so the repository's own
+# history.db is never touched.
+SCRATCH = tempfile.mkdtemp(prefix="matrix-tests-")
+for _var, _name in (("HISTORY_DB", "history.db"), ("MATRIX_DIR", "matrices"), ("SESSION_DIR", "sessions"),
+                    ("METRICS_DIR", "metrics")):
+    os.environ[_var] = os.path.join(SCRATCH, _name)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def client():
+    from app import app
+    return app.test_client()
@@ -0,0 +1,23 @@
+import pytest
+
+SINGULAR = [["1", "2"], ["2", "4"]]
+IDENTITY = [["1", "0"], ["0", "1"]]
+NOT_POSITIVE = [["1", "2"], ["2", "1"]]
+
+
+@pytest.mark.parametrize("operation,bad,good", [
+    ("solve", {"A": SINGULAR, "B": [["1"], ["1"]]}, {"A": IDENTITY, "B": [["3"], ["4"]]}),
+    ("inv-a", {"A": SINGULAR}, {"A": IDENTITY}),
+    ("chol-a", {"A": NOT_POSITIVE}, {"A": IDENTITY}),
+])
+def test_one_failing_item_does_not_fail_its_group(client, operation, bad, good):
+    resp = client.post("/calculate-batch", json={"jobs": [
+        {"operation": operation, **bad},
+        {"operation": operation, **good},
+    ]})
+    assert resp.status_code == 200
+    first, second = resp.get_json()["results"]
+    assert "error" in first
+    assert "error" not in second
+    expected = {"solve": [[3.0], [4.0]], "inv-a": [[1.0, 0.0], [0.0, 1.0]], "chol-a": [[1.0, 0.0], [0.0, 1.0]]}
+    assert second["result"] == expected[operation]
@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+import app
+from compute_pool import ComputePool, WorkerDied
+
+
+def test_dead_worker_is_replaced():
+    pool = ComputePool(workers=1, timeout=30, retry_after=3)
+    try:
+        with pytest.raises(WorkerDied) as e:
+            pool.call(os._exit, 1)
+        assert e.value.retry_after == 3
+        assert pool.call(abs, -2) == 2
+    finally:
+        pool.shutdown()
+
+
+def test_dead_worker_is_a_503(client, monkeypatch):
+    def die(*args):
+        raise WorkerDied(5)
+
+    monkeypatch.setattr(app, "compute", die)
+    resp = client.post("/calculate", json={"operation": "inv-a", "A": [["1", "2"], ["3", "5"]]})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "5"
@@ -0,0 +1,14 @@
+import pytest
+
+from app import CalculationError, parse_delta
+
+
+def test_cells_are_parsed_last_value_winning():
+    rows, cols, values = parse_delta("A", [[0, 1, "1/2"], [2.0, 0, 3], [0, 1, "4"]])
+    assert list(zip(rows.tolist(), cols.tolist(), values.tolist())) == [(0, 1, 4.0), (2, 0, 3.0)]
+
+
+@pytest.mark.parametrize("cell", [[1.5, 0, 1], [0, True, 1], [0, "x", 1], [0, 0, "1/0"], [0, 0, "inf"]])
+def test_bad_cells_are_rejected(cell):
+    with pytest.raises(CalculationError):
+        parse_delta("A", [cell])
@@ -0,0 +1,28 @@
+import io
+
+import numpy as np
+import pytest
+
+from app import read_npy_arrays
+
+
+def npy(*arrays):
+    buf = io.BytesIO()
+    for arr in arrays:
+        np.save(buf, arr)
+    return buf.getvalue()
+
+
+def test_reads_concatenated_arrays():
+    A, B = np.arange(6.0).reshape(2, 3), np.eye(3, dtype=np.int32)
+    got = read_npy_arrays(npy(A, B))
+    assert [M.tolist() for M in got] == [A.tolist(), B.tolist()]
+
+
+@pytest.mark.parametrize("cut", [1, 6, 7, 8, 9, 20, -1])
+def test_truncated_body_is_a_client_error(client, cut):
+    body = npy(np.eye(2))[:cut]
+    with pytest.raises(ValueError):
+        read_npy_arrays(body)
+    resp = client.post("/calculate?operation=det-a", data=body, content_type="application/x-npy")
+    assert resp.status_code == 400
@@ -0,0 +1,19 @@
+import pytest
+
+from app import parse_matrices
+
+
+def test_fractions_and_numbers():
+    A, B = parse_matrices(A=[["1", "3/4"], [" -1 / 8 ", "2.5"]], B=[[1, "1/2"], [2.5, "4"]])
+    assert A.tolist() == [[1.0, 0.75], [-0.125, 2.5]]
+    assert B.tolist() == [[1.0, 0.5], [2.5, 4.0]]
+
+
+def test_bad_cells_are_reported_with_their_position():
+    with pytest.raises(ValueError) as e:
+        parse_matrices(A=[["1/2", "1/0"], ["x", "1/2/3"]], B=[["nan", "2"]])
+    message = str(e.value)
+    for where in ("'1/0' in A at row 1, column 2", "'x' in A at row 2, column 1",
+                  "'1/2/3' in A at row 2, column 2", "'nan' in B at row 1, column 1"):
+        assert where in message
+    assert "'1/2' in" not in message
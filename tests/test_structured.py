@@ -0,0 +1,32 @@
+import numpy as np
+
+from structured_ops import plan, run_structured
+
+
+def test_batch_results_are_not_served_to_structured_kernels(client):
+    A = [["1", "2"], ["3", "4"]]
+    batch = client.post("/calculate-batch", json={"jobs": [{"operation": "det-a", "A": A}]})
+    assert batch.status_code == 200
+    resp = client.post("/calculate", json={"operation": "det-a", "A": A})
+    assert resp.status_code == 200
+    assert resp.get_json()["result"] == -2.0
+
+
+def test_determinant_beyond_float64_range(client):
+    A = [["1e6" if i == j else "0" for j in range(400)] for i in range(400)]
+    resp = client.post("/calculate", json={"operation": "det-a", "A": A})
+    assert resp.status_code == 200
+    assert b"Infinity" not in resp.data
+    result = resp.get_json()["result"]
+    assert result["sign"] == 1
+    assert abs(result["log_abs"] - 400 * np.log(1e6)) < 1e-9 * result["log_abs"]
+
+    rng = np.random.default_rng(0)
+    for M in (np.triu(rng.standard_normal((400, 400))) + 1e3 * np.eye(400),  # diagonal-product
+              np.diag(np.full(400, -1e3)) + np.eye(400, k=1) + np.eye(400, k=-1),  # banded-lu
+              rng.standard_normal((400, 400)) + 1e3 * np.eye(400)):  # lu
+        M[0] *= -1
+        sign, log_abs = np.linalg.slogdet(M)
+        result = run_structured(plan("det-a", (M,)), (M,))
+        assert result["sign"] == sign
+        assert abs(result["log_abs"] - log_abs) < 1e-9 * log_abs